@@ -0,0 +1,94 @@
+# %%
+"""
+Compares the old full `pydicom.dcmread()` of every file against the
+header-only scan of `Reorder.scan_files()`, on a synthetic study.
+
+Run it from the root of the repository:
+
+    python -m Benchmarks.bench_header_scan --slices 5000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import pydicom
+from Modules import out_of_folder
+from Benchmarks import synthetic_study
+
+
+def read_bytes() -> int | None:
+    """
+    Returns the bytes read so far by the current process (Linux only).
+    """
+    try:
+        with open("/proc/self/io", "r") as io_file:
+            for line in io_file:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return None
+
+
+def run_mode(mode: str, root_path: str, dicom_directory: str, results: multiprocessing.Queue) -> None:
+    """
+    Scans the whole study with the given `mode` ("full" or "header"), in a
+    fresh process, so the peak RSS of each mode is not mixed with the other.
+    """
+    start_bytes: int | None = read_bytes()
+    start_time: float = time.perf_counter()
+
+    if mode == "full":
+        for root, dirs, files in sorted(os.walk(f"{root_path}/{dicom_directory}")):
+            for item in files:
+                pydicom.dcmread(f"{root}/{item}").data_element("SeriesTime").value
+    else:
+        out_of_folder.Reorder(root_path, dicom_directory).scan_files()
+
+    end_time: float = time.perf_counter()
+    end_bytes: int | None = read_bytes()
+
+    results.put({"mode": mode,
+                 "seconds": round(end_time - start_time, 3),
+                 "bytes_read": None if start_bytes is None else end_bytes - start_bytes,
+                 "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slices", type=int, default=5000)
+    parser.add_argument("--rows", type=int, default=256)
+    parser.add_argument("--columns", type=int, default=256)
+    parser.add_argument("--output", help="Optional JSON file to save the results.")
+    arguments = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as root_path:
+        print(f"Writing {arguments.slices} synthetic slices...")
+        synthetic_study.make_study(f"{root_path}/study", arguments.slices, arguments.rows, arguments.columns)
+
+        all_results: list[dict] = []
+        for mode in ["full", "header"]:
+            results: multiprocessing.Queue = context.Queue()
+            process = context.Process(target=run_mode, args=(mode, root_path, "study", results))
+            process.start()
+            all_results.append(results.get())
+            process.join()
+
+    for result in all_results:
+        print(f"mode: {result['mode']:6} | seconds: {result['seconds']:8} | "
+              f"bytes read: {result['bytes_read']} | peak RSS (KB): {result['peak_rss_kb']}")
+
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(all_results, output_file, indent=4)
+
+
+# %%
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# %%
+"""
+Measures the whole anonymization of a synthetic batch (the same path as
+main_file.py), and reports files/s, MB/s, peak RSS and the wall time of every
+stage. It also measures the cold start of the command line (`main_file.py
+scan` and `dry-run` on an empty folder, against a bare `python -c pass`). Each
+mode runs in a fresh process, on a fresh copy of the batch:
+
+    pipeline --> `batch.Batch` (extract, index and sort, anonymize, clean up).
+    async    --> `async_pipeline.AsyncPipeline` (only the total time).
+    legacy   --> the original steps one after the other: `Reorder.unzip_file()`,
+                 `Reorder.sort_files()`, `Eraser.anonymize()` and `Reorder.rename_files()`.
+
+Run it from the root of the repository:
+
+    python -m Benchmarks.bench_pipeline --patients 2 --slices 500 --zipped --output new.json
+    python -m Benchmarks.bench_pipeline --patients 2 --slices 500 --zipped --compare new.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from Benchmarks import synthetic_study
+
+MODES: list[str] = ["pipeline", "async", "legacy"]
+PATTERN: str = r"TAG_DATA_HOSPITAL-\d+\Z"
+# The entry point, to measure its cold start:
+MAIN_FILE: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main_file.py")
+
+
+def peak_rss_kb() -> int:
+    """
+    Returns the peak RSS (in KB) of the current process, or of its biggest
+    worker process if that one is bigger.
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def batch_size(root_path: str) -> tuple[int, int]:
+    """
+    Returns (number of DICOM files, total size in bytes) of a batch, counting
+    the uncompressed size of the members of the ZIP files.
+    """
+    file_count: int = 0
+    total_size: int = 0
+
+    for root, dirs, files in os.walk(root_path):
+        for item in files:
+            if item.endswith(".zip"):
+                with zipfile.ZipFile(f"{root}/{item}", "r") as zip_ref:
+                    members: list[zipfile.ZipInfo] = [info for info in zip_ref.infolist() if not info.is_dir()]
+                file_count += len(members)
+                total_size += sum(info.file_size for info in members)
+            elif item.endswith(".dcm"):
+                file_count += 1
+                total_size += os.path.getsize(f"{root}/{item}")
+
+    return file_count, total_size
+
+
+def run_pipeline(root_path: str, workers: int, stages: dict[str, float]) -> int:
+    """
+    Runs `batch.Batch` one patient after the other, timing every stage.
+    """
+    from Modules import batch
+
+    hospital_batch = batch.Batch(root_path, PATTERN, workers=workers, incremental=False)
+    failures: int = 0
+
+    def timed(stage: str, function, *arguments):
+        start_time: float = time.perf_counter()
+        result = function(*arguments)
+        stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - start_time
+        return result
+
+    for patient in timed("find_patients", hospital_batch.find_patients):
+        errors, conveyor = timed("extract_index_sort", hospital_batch.prepare_patient, *patient)
+        if conveyor is None:
+            failures += len(errors)
+            continue
+        errors = timed("anonymize_write", conveyor.run, workers, hospital_batch.ledger)
+        failures += len(timed("cleanup", hospital_batch.finish_patient, conveyor, errors))
+
+    return failures
+
+
+def run_async(root_path: str, workers: int, stages: dict[str, float]) -> int:
+    """
+    Runs `async_pipeline.AsyncPipeline` (its stages overlap, so only the total is timed).
+    """
+    from Modules import async_pipeline
+    from Modules import batch
+
+    return len(async_pipeline.AsyncPipeline(batch.Batch(root_path, PATTERN, workers=workers, incremental=False)).run())
+
+
+def run_legacy(root_path: str, workers: int, stages: dict[str, float]) -> int:
+    """
+    Runs the original steps of main_file.py one after the other, for every patient.
+    """
+    from Modules import anonymizer
+    from Modules import out_of_folder
+
+    failures: int = 0
+
+    for patient in sorted(os.listdir(root_path)):
+        patient_path: str = f"{root_path}/{patient}"
+        wall_e = out_of_folder.Reorder(patient_path, "study", patient)
+
+        for stage, function in [("unzip_file", wall_e.unzip_file), ("sort_files", wall_e.sort_files)]:
+            start_time: float = time.perf_counter()
+            function()
+            stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        failures += len(anonymizer.Eraser(wall_e.root_dir_path, patient).anonymize(workers))
+        stages["anonymize"] = stages.get("anonymize", 0.0) + time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        wall_e.make_directory()
+        wall_e.rename_files()
+        stages["rename_files"] = stages.get("rename_files", 0.0) + time.perf_counter() - start_time
+
+    return failures
+
+
+def run_mode(mode: str, root_path: str, workers: int, results: multiprocessing.Queue) -> None:
+    """
+    Anonymizes the whole batch in `root_path` with the given `mode`, in a
+    fresh process, so the peak RSS of each mode is not mixed with the others.
+    """
+    file_count, total_size = batch_size(root_path)
+    stages: dict[str, float] = {}
+    runner = {"pipeline": run_pipeline, "async": run_async, "legacy": run_legacy}[mode]
+
+    start_time: float = time.perf_counter()
+    failures: int = runner(root_path, workers, stages)
+    seconds: float = time.perf_counter() - start_time
+
+    results.put({"mode": mode,
+                 "files": file_count,
+                 "megabytes": round(total_size / 1e6, 3),
+                 "failures": failures,
+                 "seconds": round(seconds, 3),
+                 "files_per_second": round(file_count / seconds, 1),
+                 "megabytes_per_second": round(total_size / 1e6 / seconds, 2),
+                 "peak_rss_kb": peak_rss_kb(),
+                 "stages": {stage: round(value, 3) for stage, value in stages.items()}})
+
+
+def cold_start(runs: int) -> dict[str, float]:
+    """
+    Returns the best wall time (in seconds, out of `runs`) of every command
+    started in a new interpreter, on an empty folder.
+    """
+    commands: dict[str, list[str]] = {"python": [sys.executable, "-c", "pass"]}
+    startup: dict[str, float] = {}
+
+    with tempfile.TemporaryDirectory() as empty_path:
+        for command in ["scan", "dry-run"]:
+            commands[command] = [sys.executable, MAIN_FILE, command, empty_path]
+
+        for name, command in commands.items():
+            seconds: list[float] = []
+            for _ in range(runs):
+                start_time: float = time.perf_counter()
+                subprocess.run(command, check=True, capture_output=True)
+                seconds.append(time.perf_counter() - start_time)
+            startup[name] = round(min(seconds), 4)
+
+    return startup
+
+
+def compare(all_results: list[dict], baseline_path: str, startup: dict[str, float] | None = None) -> None:
+    """
+    Prints how much faster (or slower) every mode is than in a previous run.
+    """
+    with open(baseline_path, "r") as baseline_file:
+        saved: dict = json.load(baseline_file)
+    baseline: dict[str, dict] = {result["mode"]: result for result in saved["results"]}
+
+    for name, seconds in (startup or {}).items():
+        if name in saved.get("startup", {}):
+            print(f"cold start: {name:8} | seconds: {saved['startup'][name]} --> {seconds}")
+
+    for result in all_results:
+        old: dict | None = baseline.get(result["mode"])
+        if old is None:
+            continue
+        print(f"mode: {result['mode']:8} | files/s: {old['files_per_second']} --> {result['files_per_second']} "
+              f"(x{result['files_per_second'] / old['files_per_second']:.2f}) | "
+              f"peak RSS (KB): {old['peak_rss_kb']} --> {result['peak_rss_kb']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=2)
+    parser.add_argument("--slices", type=int, default=500, help="Slices per patient.")
+    parser.add_argument("--rows", type=int, default=256)
+    parser.add_argument("--columns", type=int, default=256)
+    parser.add_argument("--series", type=int, default=2)
+    parser.add_argument("--compressed", action="store_true", help="RLE compressed pixel data.")
+    parser.add_argument("--zipped", action="store_true", help="Every study inside a ZIP file.")
+    parser.add_argument("--depth", type=int, default=0, help="Nested sequences with personal data in every slice.")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--startup-runs", type=int, default=5, help="Runs to measure the cold start (0 to skip it).")
+    parser.add_argument("--output", help="Optional JSON file to save the results.")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare against.")
+    arguments = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    all_results: list[dict] = []
+
+    with tempfile.TemporaryDirectory() as temporary_path:
+        template: str = f"{temporary_path}/template"
+        print(f"Writing {arguments.patients} x {arguments.slices} synthetic slices...")
+        synthetic_study.make_batch(template, arguments.patients, slices=arguments.slices, rows=arguments.rows,
+                                   columns=arguments.columns, series=arguments.series, compressed=arguments.compressed,
+                                   zipped=arguments.zipped, depth=arguments.depth)
+
+        for mode in arguments.modes:
+            # Every mode removes its sources, so each one gets its own copy:
+            root_path: str = shutil.copytree(template, f"{temporary_path}/{mode}")
+            results: multiprocessing.Queue = context.Queue()
+            process = context.Process(target=run_mode, args=(mode, root_path, arguments.workers, results))
+            process.start()
+            all_results.append(results.get())
+            process.join()
+            shutil.rmtree(root_path)
+
+    for result in all_results:
+        print(f"mode: {result['mode']:8} | seconds: {result['seconds']:8} | files/s: {result['files_per_second']:8} | "
+              f"MB/s: {result['megabytes_per_second']:7} | peak RSS (KB): {result['peak_rss_kb']} | "
+              f"failures: {result['failures']}")
+        for stage, seconds in result["stages"].items():
+            print(f"    {stage:20} {seconds:8} s")
+
+    startup: dict[str, float] = cold_start(arguments.startup_runs) if arguments.startup_runs > 0 else {}
+
+    for name, seconds in startup.items():
+        print(f"cold start: {name:8} | seconds: {seconds}")
+
+    if arguments.compare:
+        compare(all_results, arguments.compare, startup)
+
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump({"arguments": vars(arguments), "results": all_results, "startup": startup}, output_file, indent=4)
+
+
+# %%
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# %%
+"""
+Measures the recursive de-identification of `rules.RuleSet` on datasets with
+deep sequence trees (see `synthetic_study.make_nested_dataset()`). The time
+per element should stay the same no matter how big or deep the tree is.
+
+Run it from the root of the repository:
+
+    python -m Benchmarks.bench_sequences
+"""
+import argparse
+import copy
+import json
+import os
+import time
+from Modules import rules
+from Benchmarks import synthetic_study
+
+PROFILE_PATH: str = "Modules/profiles/basic_profile.json"
+
+
+def count_elements(rule_set: rules.RuleSet, dataset) -> int:
+    """
+    Counts every element in the dataset, including the nested ones.
+    """
+    return sum(len(current) for current in rule_set.walk(dataset))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Optional JSON file to save the results.")
+    arguments = parser.parse_args()
+
+    os.environ.setdefault(rules.SALT_VARIABLE, "benchmark")  # The profile hashes the UIDs.
+    rule_set: rules.RuleSet = rules.RuleSet.from_file(PROFILE_PATH)
+    all_results: list[dict] = []
+
+    for items in arguments.items:
+        for depth in arguments.depths:
+            dataset = synthetic_study.make_nested_dataset(items, depth)
+            elements: int = count_elements(rule_set, dataset)
+            best: float = float("inf")
+
+            for _ in range(arguments.repeat):
+                fresh = copy.deepcopy(dataset)
+                start_time: float = time.perf_counter()
+                rule_set.apply(fresh)
+                best = min(best, time.perf_counter() - start_time)
+
+            result: dict = {"items": items,
+                            "depth": depth,
+                            "elements": elements,
+                            "seconds": round(best, 4),
+                            "microseconds_per_element": round(best / elements * 1e6, 3)}
+            all_results.append(result)
+            print(f"items: {items:6} | depth: {depth:3} | elements: {elements:8} | "
+                  f"seconds: {result['seconds']:8} | us/element: {result['microseconds_per_element']}")
+
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(all_results, output_file, indent=4)
+
+
+# %%
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# %%
+import os
+import shutil
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+CT_IMAGE_STORAGE: str = "1.2.840.10008.5.1.4.1.1.2"
+
+
+def make_personal_item() -> Dataset:
+    """
+    Returns a small dataset with fake personal data, to be nested inside sequences.
+    """
+    item: Dataset = Dataset()
+    item.PatientName = "Doe^John"
+    item.PatientID = "123456789012"
+    item.PatientBirthDate = "19700101"
+    item.InstitutionName = "Synthetic Hospital"
+    return item
+
+
+def make_slice(path: str, series_uid: str, series_time: str, instance_number: int, rows: int, columns: int,
+               series_number: int = 1, compressed: bool = False, depth: int = 0, private_tags: bool = True) -> None:
+    """
+    This function writes a single synthetic CT slice, with fake personal data
+    in all the tags that the `Eraser` class anonymizes, and an empty (zeros)
+    16 bits pixel matrix of `rows` x `columns`. Like almost every real CT/MR
+    file, it also holds a vendor private block.
+
+    Parameters:
+    -----------
+        path (path): Full path of the DICOM file to write.
+        series_uid (str): The `SeriesInstanceUID` of the slice.
+        series_time (str): The `SeriesTime` of the slice.
+        instance_number (int): The `InstanceNumber` of the slice (also used
+                               for its `ImagePositionPatient`).
+        rows (int): Number of rows of the pixel matrix.
+        columns (int): Number of columns of the pixel matrix.
+        series_number (int): The `SeriesNumber` of the slice.
+        compressed (bool): Compress the pixel data (RLE Lossless, encapsulated)
+                           instead of writing it uncompressed.
+        depth (int): How many sequences with personal data are nested inside
+                     the slice ('ReferencedPatientSequence').
+        private_tags (bool): Add the vendor private block: a copy of the name,
+                             a binary header (bigger than the 1 KB that is read
+                             eagerly) and a private sequence.
+
+    Returns:
+    --------
+
+    """
+    file_meta: FileMetaDataset = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset: FileDataset = FileDataset(path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    dataset.SOPClassUID = CT_IMAGE_STORAGE
+    dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    dataset.StudyDate = "20200101"
+    dataset.SeriesTime = series_time
+    dataset.InstitutionName = "Synthetic Hospital"
+    dataset.InstitutionalDepartmentName = "Radiology"
+    dataset.PerformingPhysicianName = "Doe^Jane"
+    dataset.PatientName = "Doe^John"
+    dataset.PatientID = "123456789012"
+    dataset.PatientBirthDate = "19700101"
+    dataset.PatientSex = "M"
+    dataset.SeriesInstanceUID = series_uid
+    dataset.SeriesNumber = series_number
+    dataset.InstanceNumber = instance_number
+    dataset.ImagePositionPatient = [0.0, 0.0, float(instance_number)]
+    dataset.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = "MONOCHROME2"
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 0
+    dataset.PixelData = bytes(rows * columns * 2)
+
+    # A chain of nested sequences, 'depth' levels deep:
+    level: Dataset = dataset
+    for _ in range(depth):
+        child: Dataset = make_personal_item()
+        level.ReferencedPatientSequence = [child]
+        level = child
+
+    if private_tags:
+        block = dataset.private_block(0x0029, "SYNTHETIC VENDOR", create=True)
+        block.add_new(0x01, "LO", "Doe^John")
+        block.add_new(0x02, "OB", bytes(2048))
+        block.add_new(0x03, "SQ", [make_personal_item()])
+
+    if compressed:
+        dataset.compress(RLELossless, encoding_plugin="pydicom")
+
+    dataset.save_as(path, write_like_original=False)
+
+
+def make_nested_dataset(items: int = 100, depth: int = 3, private_tags: bool = True) -> pydicom.Dataset:
+    """
+    This function builds (in memory) a dataset with deep sequence trees, like
+    the ones of enhanced multi-frame images and RT structure sets:\n
+        - 'PerFrameFunctionalGroupsSequence' with `items` frames, each one with
+          a chain of `depth` nested 'ReferencedPatientSequence' holding personal
+          data at every level. \n
+        - 'ROIContourSequence' with `items` contours, each one with its own
+          'ContourSequence'. \n
+        - A private block (with its own private sequence), if `private_tags`.
+
+    Parameters:
+    -----------
+        items (int): Number of frames (and contours).
+        depth (int): How many sequences are nested inside each frame.
+        private_tags (bool): Add vendor private tags to every frame.
+
+    Returns:
+    --------
+        dataset: |pydicom.Dataset| The nested dataset.
+    """
+    dataset: Dataset = make_personal_item()
+    dataset.SeriesTime = "100000"
+    frames: list[Dataset] = []
+    contours: list[Dataset] = []
+
+    for index in range(items):
+        frame: Dataset = Dataset()
+        frame.FrameContentSequence = [Dataset()]
+        frame.FrameContentSequence[0].InStackPositionNumber = index + 1
+
+        # A chain of nested sequences, 'depth' levels deep:
+        level: Dataset = frame
+        for _ in range(depth):
+            child: Dataset = make_personal_item()
+            level.ReferencedPatientSequence = [child]
+            level = child
+
+        if private_tags:
+            block = frame.private_block(0x0009, "SYNTHETIC VENDOR", create=True)
+            block.add_new(0x01, "LO", "Doe^John")
+            block.add_new(0x02, "SQ", [make_personal_item()])
+
+        frames.append(frame)
+
+        contour: Dataset = Dataset()
+        contour.ReferencedROINumber = index + 1
+        contour.ContourSequence = [Dataset()]
+        contour.ContourSequence[0].ContourGeometricType = "CLOSED_PLANAR"
+        contour.ContourSequence[0].ContourData = [float(value) for value in range(30)]
+        contours.append(contour)
+
+    dataset.PerFrameFunctionalGroupsSequence = frames
+    dataset.ROIContourSequence = contours
+
+    return dataset
+
+
+def make_study(root_path: str, slices: int = 5000, rows: int = 256, columns: int = 256, series: int = 1,
+               compressed: bool = False, zipped: bool = False, depth: int = 0, private_tags: bool = True) -> str:
+    """
+    This function creates a synthetic study inside `root_path`, with the same
+    layout the `Reorder` class expects: one sub-directory per series, holding
+    all the slices of that series. All the slices of a series share the same
+    `SeriesTime` (as in real studies).
+
+    Parameters:
+    -----------
+        root_path (path): The directory where the study will be created.
+        slices (int): Total number of slices in the study.
+        rows (int): Number of rows of each slice.
+        columns (int): Number of columns of each slice.
+        series (int): In how many series the slices are split.
+        compressed (bool): Compress the pixel data of every slice (see `make_slice()`).
+        zipped (bool): Pack the study into `{root_path}.zip`, and remove the directory.
+        depth (int): How many sequences with personal data are nested inside each slice.
+        private_tags (bool): Add a vendor private block to each slice (see `make_slice()`).
+
+    Returns:
+    --------
+        root_path (path): The same directory given, now holding the study (or
+                          the ZIP file, if `zipped`).
+    """
+    per_series: int = -(-slices // series)  # Ceiling division.
+    counter: int = 0
+
+    for series_index in range(series):
+        series_dir: str = f"{root_path}/series{series_index:03}"
+        os.makedirs(series_dir, exist_ok=True)
+        series_uid: str = generate_uid()
+        series_time: str = f"{100000 + series_index:06}"
+
+        for instance in range(per_series):
+            if counter == slices:
+                break
+            make_slice(f"{series_dir}/{instance:05}.dcm", series_uid, series_time, instance + 1, rows, columns,
+                       series_index + 1, compressed, depth, private_tags)
+            counter += 1
+
+    if not zipped:
+        return root_path
+
+    shutil.make_archive(root_path, "zip", root_path)
+    shutil.rmtree(root_path)
+
+    return f"{root_path}.zip"
+
+
+def make_batch(root_path: str, patients: int = 2, **study_options) -> str:
+    """
+    This function creates a whole synthetic batch inside `root_path`, with the
+    layout `batch.Batch` expects: `root_path > TAG_DATA_HOSPITAL-N > study`
+    (or `study.zip`).
+
+    Parameters:
+    -----------
+        root_path (path): The main directory of the batch.
+        patients (int): Number of patients.
+        study_options: Passed to `make_study()` for every patient.
+
+    Returns:
+    --------
+        root_path (path): The same directory given, now holding the batch.
+    """
+    for patient in range(1, patients + 1):
+        make_study(f"{root_path}/TAG_DATA_HOSPITAL-{patient}/study", **study_options)
+
+    return root_path
+
+
+# %%
+if __name__ == "__main__":
+    make_study("synthetic_study", slices=10, rows=64, columns=64, series=2)
+    print(pydicom.dcmread("synthetic_study/series000/00000.dcm"))
@@ -1,16 +1,49 @@
 # %%
+import io
 import os
 import pydicom
 import copy
+import logging
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from Modules import memory
+from Modules import metrics
+from Modules import patcher
+from Modules import pseudonymizer
+from Modules import rules
+from Modules.pseudonymizer import PSEUDONYM_TAGS
+
+logger = metrics.get_logger("anonymizer")
+
+# Members of a ZIP file smaller than this are kept in memory, bigger ones are spooled to a temporary file:
+SPOOL_SIZE: int = 64 * 1024 * 1024
+SOP_INSTANCE_UID: int = 0x00080018
+MEDIA_STORAGE_SOP_INSTANCE_UID: int = 0x00020003
+# How many ZIP files each process keeps open (see 'open_archive()'):
+OPEN_ARCHIVES: int = 4
+
+# path --> ((modification time, size, inode), ZIP file) of the ZIP files opened by this process, oldest first:
+ARCHIVES: dict[str, tuple[tuple[int, int, int], zipfile.ZipFile]] = {}
+ARCHIVES_LOCK: threading.Lock = threading.Lock()
 
 
 class Eraser:
     """
     This is a simple program for anonymizing all DICOM files stored in
     a specific directory.
+    \nThe tags in `data_elements` (or in the JSON `profile`, if one is given) are
+    compiled once into a `rules.RuleSet`, and 'PatientName' is always replaced by
+    the `anonymized_name`.
+    \nWith a `pseudonymizer`, the identifiers and UIDs in `pseudonymizer.PSEUDONYM_TAGS`
+    get stable pseudonyms instead (e.g. the same 'PatientID' in every study of the
+    patient), and the File Meta Information is kept in sync with the new 'SOPInstanceUID'.
     """
 
-    def __init__(self, root_path: str, anonymized_name: str) -> None:
+    def __init__(self, root_path: str, anonymized_name: str, profile: str | None = None,
+                 pseudonymizer: pseudonymizer.Pseudonymizer | None = None) -> None:
         self.root_path: str = root_path
         self.anonymized_name: str = anonymized_name
         self.dataset: pydicom.FileDataset = pydicom.FileDataset
@@ -23,9 +56,28 @@ class Eraser:
                                     "PatientBirthDate": "00000000",
                                     "PatientSex": "X"}
         self.missing_tags: list = []
+        # Compiled once, and used for every file (see 'rules.RuleSet'):
+        self.rules: rules.RuleSet = rules.RuleSet.from_file(profile) if profile else rules.RuleSet.from_values(self.data_elements)
+        self.rules.add("PatientName", "replace", self.anonymized_name)
+        self.pseudonymizer: pseudonymizer.Pseudonymizer | None = pseudonymizer
+
+        if self.pseudonymizer is not None:
+            self.rules.pseudonymizer = self.pseudonymizer
+            for keyword in PSEUDONYM_TAGS:
+                self.rules.add(keyword, "pseudonym")
+        # Patch the tags straight in the bytes of the file whenever possible (see 'patcher.Patcher'):
+        self.fast_path: bool = True
+        # How many tags were changed in the last file (for the metrics):
+        self.changed_tags: int = 0
+        # Flush every anonymized file to the disk right after writing it (see 'committer.FSYNC_POLICIES'):
+        self.fsync_files: bool = False
+        # Memory-bounded mode (see 'rewrite_file()'): the biggest file loaded whole, and the memory
+        # ceiling of every process anonymizing files (in bytes, None means no ceiling):
+        self.stream_size: int = memory.STREAM_SIZE
+        self.memory_limit: int | None = None
 
     def __dir__(self) -> None:
-        return ["get_existing_tags", "test", "anonymize"]
+        return ["get_existing_tags", "test", "patch_tags", "replacements", "anonymize_dataset", "flush", "anonymize"]
 
     def get_existing_tags(self, dataset: pydicom.FileDataset) -> dict[str, str]:
         """
@@ -56,7 +108,7 @@ class Eraser:
             if bool(dataset.get(item)) is True:
                 pass
             else:
-                print(f"Missing '{item}' tag. It will still be anonymized though.\n")
+                logger.debug("Missing '%s' tag. It will still be anonymized though.", item)
                 self.missing_tags.append(item)
 
         # Delete the missing tags:
@@ -108,7 +160,84 @@ class Eraser:
         print_tags(existing_tags)
         # --------------- CHECK THE MODIFICATION OF TAGS ---------------
 
-    def anonymize(self) -> None:
+    def patch_tags(self) -> set[int]:
+        """
+        Returns every tag that `replacements()` might change (see `patcher.Patcher.patch()`).
+        """
+        return self.rules.compiled.keys() | {MEDIA_STORAGE_SOP_INSTANCE_UID}
+
+    def replacements(self, dataset: pydicom.FileDataset) -> dict[int, str | None] | None:
+        """
+        This function returns the new values of all the existing tags with
+        personal data in `dataset`, using the `anonymized_name` given when
+        first instantiating the class as the new 'PatientName'. Missing or
+        empty tags are left as they are. \n
+        Only the top level tags are returned, so if anything inside a sequence
+        that is kept has to be changed too, it returns None (the whole file has
+        to be written again). If the 'SOPInstanceUID' changes, the
+        'MediaStorageSOPInstanceUID' of the File Meta Information is changed
+        along with it.
+
+        Parameters:
+        -----------
+            dataset: |pydicom.FileDataset| This is the dataset read
+                     from the DICOM file. Here is where all the tags and
+                     data is stored.
+
+
+        Returns:
+        --------
+            all_tags: |dict| `"key"` --> tags.\n
+                             `"value"` --> the modified names (None if the
+                             tag has to be removed).
+        """
+        changes: dict[int, str | None] = self.rules.changes(dataset)
+
+        if self.rules.has_nested_changes(dataset, changes):
+            return None
+
+        self.changed_tags = len(changes)
+
+        if SOP_INSTANCE_UID in changes and MEDIA_STORAGE_SOP_INSTANCE_UID in getattr(dataset, "file_meta", {}):
+            changes[MEDIA_STORAGE_SOP_INSTANCE_UID] = changes[SOP_INSTANCE_UID]
+
+        return changes
+
+    def anonymize_dataset(self, dataset: pydicom.FileDataset) -> pydicom.FileDataset:
+        """
+        This function replaces the values of all the existing tags with
+        personal data in `dataset`, using the `anonymized_name` given when
+        first instantiating the class as the new 'PatientName'.
+
+        Parameters:
+        -----------
+            dataset: |pydicom.FileDataset| This is the dataset read
+                     from the DICOM file. Here is where all the tags and
+                     data is stored.
+
+
+        Returns:
+        --------
+            dataset: |pydicom.FileDataset| The same dataset, already anonymized.
+        """
+        self.dataset = self.rules.apply(dataset)
+        self.changed_tags = self.rules.changed
+
+        file_meta = getattr(dataset, "file_meta", None)
+        if file_meta is not None and "MediaStorageSOPInstanceUID" in file_meta and "SOPInstanceUID" in dataset:
+            file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+
+        return self.dataset
+
+    def flush(self) -> None:
+        """
+        Writes the pseudonyms made for the last file into the mapping store
+        (see `pseudonymizer.Pseudonymizer.flush()`), if there is one.
+        """
+        if self.pseudonymizer is not None:
+            self.pseudonymizer.flush()
+
+    def anonymize(self, workers: int = 1) -> list[tuple[str, str]]:
         """
         This function anonymizes All the DICOM files inside a directory
         taking the `root_directory` path and the `anonymized_name` given
@@ -116,35 +245,291 @@ class Eraser:
 
         Parameters:
         -----------
-
+            workers (int): Number of processes used to anonymize the files.
+                           With 1 (default), the files are anonymized one
+                           after the other.
 
         Returns:
         --------
-
+            failures: |list| (path, error message) for every file that could
+                      not be anonymized, in the same order as they were walked.
         """
         # ------------ ANONYMIZE ALL DICOM FILES IN THE DIRECTORY ------------
-        counter: int = 0
+        dcm_files: list[str] = []
 
-        for root, dirs, files in os.walk(self.root_path):
-            for item in files:
+        for root, dirs, files in sorted(os.walk(self.root_path)):
+            for item in sorted(files):
                 if os.path.splitext(item)[1] != ".dcm":  # If it is not a DICOM file extension.
-                    print(f"This will not be included '{item}'")
+                    logger.debug("This will not be included '%s'", item)
                 else:
-                    print("Current file: ", item)
-                    counter += 1
-                    self.dataset = pydicom.dcmread(os.path.join(root, item))
+                    dcm_files.append(os.path.join(root, item))
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=memory.limit_memory, initargs=(self.memory_limit,)) as executor:
+                results: list[tuple[str, str | None]] = []
+                # The metrics recorded by the workers are sent back with every result:
+                for result, snapshot in executor.map(metrics.collect,
+                                                     [metrics.METRICS.enabled] * len(dcm_files),
+                                                     [anonymize_file] * len(dcm_files),
+                                                     [self] * len(dcm_files),
+                                                     dcm_files,
+                                                     chunksize=16):
+                    metrics.METRICS.merge(snapshot)
+                    results.append(result)
+        else:
+            results: list[tuple[str, str | None]] = []
+            for dcm_file in dcm_files:
+                logger.debug("Current file: %s", os.path.basename(dcm_file))
+                results.append(anonymize_file(self, dcm_file))
+
+        logger.info("File(s) anonymized: %d", len(dcm_files))
+
+        return [result for result in results if result[1] is not None]
+        # ------------ ANONYMIZE ALL DICOM FILES IN THE DIRECTORY ------------
+
 
-                    all_tags: dict[str, str] = self.get_existing_tags(self.dataset)
+def anonymize_file(eraser: Eraser, dcm_file: str, target: str | None = None) -> tuple[str, str | None]:
+    """
+    This function reads a single DICOM file, anonymizes it with `eraser`, and
+    writes it back (or into `target`, if given). It lives outside of the class
+    so it can be sent to the worker processes. \n
+    The tags are patched straight in the bytes of the file if possible, and
+    only otherwise the whole dataset is written again (see `rewrite_file()`).
+
+    Parameters:
+    -----------
+        eraser: |Eraser| The eraser holding the anonymized values.
+        dcm_file (path): The path of the DICOM file.
+        target (path): Where to write the anonymized file. If not given, the
+                       original file is overwritten.
+
+    Returns:
+    --------
+        result: |tuple| (path, None) if the file was anonymized, or
+                (path, error message) if it failed.
+    """
+    try:
+        bytes_read: int = os.path.getsize(dcm_file)
 
-                    all_tags["PatientName"] = self.anonymized_name
+        if eraser.fast_path and patcher.Patcher().patch(dcm_file, eraser.replacements, eraser.patch_tags(), target):
+            record_file(eraser, True, bytes_read, target or dcm_file)
+            return dcm_file, None
 
-                    for tag in all_tags:
-                        self.dataset.data_element(tag).value = all_tags[tag]
+        rewrite_file(eraser, dcm_file, bytes_read, target or dcm_file)
+        record_file(eraser, False, bytes_read, target or dcm_file)
+    except Exception as error:
+        return dcm_file, repr(error)
 
-                    self.dataset.save_as(os.path.join(root, item), write_like_original=False)
+    return dcm_file, None
 
-                    print(f"\nFile(s) anonymized: {counter}\n")
-        # ------------ ANONYMIZE ALL DICOM FILES IN THE DIRECTORY ------------
+
+def record_file(eraser: Eraser, patched: bool, bytes_read: int, target: str | None = None) -> None:
+    """
+    Records the metrics of a file just anonymized (see `metrics.Metrics`),
+    including the peak memory used for it, and its new pseudonyms (see `Eraser.flush()`). The written file is only counted
+    if its `target` is given (and it is flushed to the disk if `eraser.fsync_files`).
+    """
+    eraser.flush()
+
+    if metrics.METRICS.enabled or logger.isEnabledFor(logging.DEBUG):
+        peak: int = memory.take_peak()
+        metrics.METRICS.peak("file_peak_rss_bytes", peak)
+        logger.debug("Peak memory: %.1f MB | %s", peak / 1e6, target or "(in memory)")
+
+    if eraser.fsync_files and target is not None:
+        descriptor: int = os.open(target, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    if not metrics.METRICS.enabled:
+        return
+
+    metrics.METRICS.count("files_read")
+    metrics.METRICS.count("bytes_read", bytes_read)
+    metrics.METRICS.count("files_patched" if patched else "files_rewritten")
+    metrics.METRICS.count("tags_changed", eraser.changed_tags)
+
+    if target is not None:
+        metrics.METRICS.count("files_written")
+        metrics.METRICS.count("bytes_written", os.path.getsize(target))
+
+
+def rewrite_file(eraser: Eraser, source, file_size: int, target) -> None:
+    """
+    This function anonymizes a DICOM file that cannot be patched, writing
+    the whole dataset again. Files bigger than `eraser.stream_size` are never
+    loaded whole: only their header is, and the pixel data is copied in chunks
+    (see `patcher.Patcher.stream()`). The same happens to smaller files if the
+    memory ceiling of the worker process (`eraser.memory_limit`) is reached.
+
+    Parameters:
+    -----------
+        eraser: |Eraser| The eraser holding the anonymized values.
+        source (path or file): The DICOM file (a file has to be seekable).
+        file_size (int): The size of the DICOM file.
+        target (path or file): Where to write the anonymized file.
+
+    Returns:
+    --------
+
+    """
+    if file_size > eraser.stream_size and stream_file(eraser, source, target):
+        return
+
+    try:
+        if not isinstance(source, str):
+            source.seek(0)
+        dataset: pydicom.FileDataset = eraser.anonymize_dataset(pydicom.dcmread(source))
+        dataset.save_as(target, write_like_original=False)
+    except MemoryError:
+        dataset = None  # Whatever was loaded can go now.
+        logger.warning("Out of memory, streaming the pixel data instead: %s", target if isinstance(target, str) else "(in memory)")
+
+        if not isinstance(target, str):
+            target.seek(0)
+            target.truncate()
+        if not stream_file(eraser, source, target):
+            raise
+
+
+def stream_file(eraser: Eraser, source, target) -> bool:
+    """
+    Rewrites a DICOM file keeping its pixel data out of memory (see
+    `patcher.Patcher.stream()`). It returns False if it has to be loaded whole instead.
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as file_object:
+            streamed: bool = patcher.Patcher().stream(file_object, eraser.anonymize_dataset, target)
+    else:
+        # Only real files can be copied by the kernel (see 'patcher.Patcher.rewrite_header()'):
+        streamed: bool = patcher.Patcher().stream(source, eraser.anonymize_dataset, target, kernel_copy=False)
+
+    if streamed:
+        metrics.METRICS.count("files_streamed")
+
+    return streamed
+
+
+def open_archive(zip_path: str) -> zipfile.ZipFile:
+    """
+    Opens (only once per process) the ZIP file in `zip_path`, so the list of
+    members is not read again for every single file. \n
+        - The ZIP file is opened again (and the old one closed) if it was
+          replaced at the same path, so its old members are never read. \n
+        - Only the last `OPEN_ARCHIVES` ZIP files are kept open.
+    """
+    status: os.stat_result = os.stat(zip_path)
+    signature: tuple[int, int, int] = (status.st_mtime_ns, status.st_size, status.st_ino)
+
+    with ARCHIVES_LOCK:
+        cached: tuple[tuple[int, int, int], zipfile.ZipFile] | None = ARCHIVES.pop(zip_path, None)
+
+        if cached is not None and cached[0] == signature:
+            ARCHIVES[zip_path] = cached  # Now the newest.
+            return cached[1]
+        if cached is not None:
+            cached[1].close()  # Replaced (the members still being read stay open until they are closed).
+
+        while len(ARCHIVES) >= OPEN_ARCHIVES:
+            ARCHIVES.pop(next(iter(ARCHIVES)))[1].close()
+
+        archive: zipfile.ZipFile = zipfile.ZipFile(zip_path, "r")
+        ARCHIVES[zip_path] = (signature, archive)
+
+    return archive
+
+
+def anonymize_member(eraser: Eraser, zip_path: str, member: str, target: str) -> tuple[str, str | None]:
+    """
+    This function does the same as `anonymize_file()`, but reads the DICOM
+    file straight out of a ZIP file. The member is decompressed into memory
+    (or into a temporary file if it is bigger than `SPOOL_SIZE`), so the
+    original file never lands on the disk.
+
+    Parameters:
+    -----------
+        eraser: |Eraser| The eraser holding the anonymized values.
+        zip_path (path): The path of the ZIP file.
+        member (str): The name of the DICOM file inside the ZIP file.
+        target (path): Where to write the anonymized file.
+
+    Returns:
+    --------
+        result: |tuple| (member, None) if the file was anonymized, or
+                (member, error message) if it failed.
+    """
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            with open_archive(zip_path).open(member) as zipped:
+                shutil.copyfileobj(zipped, spool, 1024 * 1024)
+            bytes_read: int = spool.tell()
+            spool.seek(0)
+
+            if eraser.fast_path and patcher.Patcher().patch(spool, eraser.replacements, eraser.patch_tags(), target):
+                record_file(eraser, True, bytes_read, target)
+                return member, None
+
+            rewrite_file(eraser, spool, bytes_read, target)
+            record_file(eraser, False, bytes_read, target)
+    except Exception as error:
+        return member, repr(error)
+
+    return member, None
+
+
+def read_source(zip_path: str | None, dcm_file: str) -> bytes:
+    """
+    Reads the whole content of a DICOM file, from the disk or straight out of
+    the ZIP file in `zip_path` (then `dcm_file` is the name of the member).
+    """
+    if zip_path is None:
+        with open(dcm_file, "rb") as source_file:
+            return source_file.read()
+
+    with open_archive(zip_path).open(dcm_file) as zipped:
+        return zipped.read()
+
+
+def source_size(zip_path: str | None, dcm_file: str) -> int:
+    """
+    Returns the size of a DICOM file (see `read_source()`) without reading it.
+    """
+    if zip_path is None:
+        return os.path.getsize(dcm_file)
+
+    return open_archive(zip_path).getinfo(dcm_file).file_size
+
+
+def anonymize_bytes(eraser: Eraser, data: bytes) -> bytes:
+    """
+    This function anonymizes a DICOM file that is already in memory, and
+    returns the bytes of the anonymized file (nothing is read from or written
+    to the disk). It lives outside of the class so it can be sent to the
+    worker processes.
+
+    Parameters:
+    -----------
+        eraser: |Eraser| The eraser holding the anonymized values.
+        data (bytes): The content of the DICOM file.
+
+    Returns:
+    --------
+        anonymized: |bytes| The content of the anonymized file.
+    """
+    if eraser.fast_path:
+        patched: bytes | None = patcher.Patcher().patch_bytes(data, eraser.replacements, eraser.patch_tags())
+        if patched is not None:
+            record_file(eraser, True, len(data))
+            return patched
+
+    output: io.BytesIO = io.BytesIO()
+
+    rewrite_file(eraser, io.BytesIO(data), len(data), output)
+    record_file(eraser, False, len(data))
+
+    return output.getvalue()
 
 
 # %%
@@ -0,0 +1,347 @@
+# %%
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from Modules import anonymizer
+from Modules import batch
+from Modules import memory
+from Modules import metrics
+from Modules import pipeline
+
+# How many files can wait between two stages:
+QUEUE_SIZE: int = 32
+# How many bytes of files can be in flight, from read to written (a few big files would go past any
+# memory with only 'QUEUE_SIZE'). With a memory ceiling ('batch.Batch.memory_limit'), half of it:
+QUEUE_BYTES: int = 512 * 1024 * 1024
+# How many patients are read at the same time:
+STUDIES: int = 2
+
+logger = metrics.get_logger("async_pipeline")
+
+
+class ByteBudget:
+    """
+    This is a semaphore counted in bytes: every file read takes its size out of
+    the budget (waiting if there is not enough left), and gives it back once
+    it is written (or failed). A file bigger than the whole budget waits until
+    nothing else is in flight, so it can always go through.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit: int = limit
+        self.used: int = 0
+        self.condition: asyncio.Condition = asyncio.Condition()
+
+    async def acquire(self, size: int) -> int:
+        """
+        Waits until `size` bytes fit in the budget, and takes them. It returns
+        what was really taken (at most the whole budget), to be given back with `release()`.
+        """
+        size = min(size, self.limit)
+
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+
+        return size
+
+    async def release(self, size: int) -> None:
+        """
+        Gives back the bytes taken by `acquire()`, waking up the files waiting for them.
+        """
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class Study:
+    """
+    This is the progress of a single patient going through the `AsyncPipeline`:
+    how many of its files are still in flight, and which ones failed.
+    """
+
+    def __init__(self, conveyor: pipeline.Pipeline, jobs: list[tuple[str, str]]) -> None:
+        self.conveyor: pipeline.Pipeline = conveyor
+        self.zip_path: str | None = conveyor.reorder.zip_path if conveyor.reorder.stream_zip else None
+        self.remaining: int = len(jobs)
+        self.order: dict[str, int] = {dcm_file: position for position, (dcm_file, target) in enumerate(jobs)}
+        # (source, target, error message or None) of every file, for the journal:
+        self.results: list[tuple[str, str, str | None]] = []
+        self.done: asyncio.Event = asyncio.Event()
+
+        if self.remaining == 0:
+            self.done.set()
+
+    def source_name(self, dcm_file: str) -> str:
+        """
+        Returns what is shown (and recorded as failed) for a file: the member
+        name when streaming from a ZIP file, otherwise its path.
+        """
+        return dcm_file if self.zip_path is None else self.conveyor.reorder.member_name(dcm_file)
+
+    def finish_file(self, dcm_file: str, target: str, error: str | None = None) -> None:
+        """
+        Records the result of a file, and wakes up the patient when it was the last one.
+        """
+        self.results.append((dcm_file, target, error))
+        self.remaining -= 1
+
+        if self.remaining == 0:
+            self.done.set()
+
+    def failures(self) -> list[tuple[str, str]]:
+        """
+        Returns (file, error message) of every file that failed, in the order of the study.
+        """
+        return [(self.source_name(dcm_file), error) for dcm_file, target, error in sorted(self.results, key=lambda result: self.order[result[0]])
+                if error is not None]
+
+
+class AsyncPipeline:
+    """
+    This program anonymizes every patient of a `batch.Batch` through a chain of
+    stages joined by bounded queues, so the disk and the CPU are never waiting
+    for each other:\n
+     -------------------------------------------------------------------------\n
+        read (ZIP member or file) --> anonymize --> write --> clean up
+     -------------------------------------------------------------------------\n
+        - read: the files are decompressed (or read) by a pool of threads. The
+          files bigger than `stream_size` are not read here: their path goes
+          to the next stage instead (see `anonymizer.anonymize_file()`).\n
+        - anonymize: the bytes go to a pool of processes (see
+          `anonymizer.anonymize_bytes()`), where the tags are patched (or the
+          dataset is written again).\n
+        - write: the anonymized bytes are written by the pool of threads.\n
+        - clean up: once every file of a patient is written, its results are
+          recorded in the journal and its sources are removed (see
+          `batch.Batch.finish_patient()`).\n
+    Up to `studies` patients are read at the same time, so on slow storage (a
+    network share, an USB drive...) the decompression of a patient overlaps
+    the writes of the previous one. Every queue holds at most `queue_size`
+    files, and all the files in flight (read, but still not written) add up to
+    `queue_bytes` at most (see `ByteBudget`), so the memory used does not
+    depend on the size of the studies, nor of their files.
+    """
+
+    def __init__(self, hospital_batch: batch.Batch, queue_size: int = QUEUE_SIZE, studies: int = STUDIES,
+                 io_threads: int = 4, queue_bytes: int | None = None) -> None:
+        self.batch: batch.Batch = hospital_batch
+        self.queue_size: int = queue_size
+        if queue_bytes is None:
+            queue_bytes = QUEUE_BYTES if hospital_batch.memory_limit is None else hospital_batch.memory_limit // 2
+        self.queue_bytes: int = queue_bytes
+        self.studies: int = studies
+        self.io_threads: int = io_threads
+        self.workers: int = hospital_batch.workers
+
+    def __dir__(self) -> None:
+        return ["read_stage", "anonymize_stage", "write_stage", "run_async", "run"]
+
+    async def read_stage(self, patient: tuple[str, str, str], slots: asyncio.Semaphore, budget: ByteBudget,
+                         parse_queue: asyncio.Queue, io_pool: ThreadPoolExecutor) -> list[tuple[str, str]]:
+        """
+        This function gets a patient ready (see `batch.Batch.prepare_patient()`),
+        reads its files one after the other into `parse_queue`, waits for all of
+        them to be written, and then cleans up the patient.
+
+        Parameters:
+        -----------
+            patient: |tuple| (patient path, DICOM directory, anonymized tag).
+            slots: |asyncio.Semaphore| Limits how many patients are read at the same time.
+            budget: |ByteBudget| Limits how many bytes are in flight.
+            parse_queue: |asyncio.Queue| Where the files read go.
+            io_pool: |ThreadPoolExecutor| The threads for the blocking calls.
+
+        Returns:
+        --------
+            failures: |list| (file, error message) of every file that failed.
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        async with slots:
+            failures, conveyor = await loop.run_in_executor(io_pool, self.batch.prepare_patient, *patient)
+
+            if conveyor is None:
+                return failures
+
+            jobs: list[tuple[str, str]] = await loop.run_in_executor(io_pool, conveyor.jobs, self.batch.ledger)
+            study: Study = Study(conveyor, jobs)
+            logger.info("Reading %d file(s): %s", len(jobs), patient[0])
+
+            for dcm_file, target in jobs:
+                reserved: int = 0
+
+                try:
+                    size: int = await loop.run_in_executor(io_pool, anonymizer.source_size, study.zip_path,
+                                                           study.source_name(dcm_file))
+                    # Files bigger than 'stream_size' are never sent whole, the worker reads them itself:
+                    data: bytes | None = None
+                    if size <= conveyor.eraser.stream_size:
+                        reserved = await budget.acquire(size)  # Waits here if too many bytes are in flight.
+                        data = await loop.run_in_executor(io_pool, anonymizer.read_source, study.zip_path,
+                                                          study.source_name(dcm_file))
+                except Exception as error:
+                    await budget.release(reserved)
+                    study.finish_file(dcm_file, target, repr(error))
+                    continue
+
+                # Waits here if the next stages are behind:
+                await parse_queue.put((study, dcm_file, target, data, reserved))
+
+        # The next patient can already be read, while the files of this one are still being written:
+        await study.done.wait()
+
+        failures = study.failures()
+        await loop.run_in_executor(io_pool, conveyor.flush, study.results, self.batch.ledger)
+        logger.info("File(s) anonymized: %d | %s", len(study.results) - len(failures), patient[0])
+        metrics.METRICS.count("files_failed", len(failures))
+
+        return await loop.run_in_executor(io_pool, self.batch.finish_patient, conveyor, failures)
+
+    async def anonymize_stage(self, budget: ByteBudget, parse_queue: asyncio.Queue, write_queue: asyncio.Queue,
+                              cpu_pool: ProcessPoolExecutor) -> None:
+        """
+        This function takes the files out of `parse_queue`, anonymizes them in
+        `cpu_pool`, and puts the anonymized bytes into `write_queue`, until it
+        gets None. The files that were too big to be read (see `read_stage()`)
+        are read, anonymized and written by the worker itself, from their path.
+        The anonymized bytes keep the share of the `budget` of the file read
+        (they are about the same size).
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        while (item := await parse_queue.get()) is not None:
+            study, dcm_file, target, data, reserved = item
+
+            if data is None:
+                staging_target: str = study.conveyor.committer.staging_target(target)
+                task, arguments = (anonymizer.anonymize_file, (dcm_file, staging_target)) if study.zip_path is None else \
+                    (anonymizer.anonymize_member, (study.zip_path, study.source_name(dcm_file), staging_target))
+
+                try:
+                    (source, error), snapshot = await loop.run_in_executor(cpu_pool, metrics.collect, metrics.METRICS.enabled,
+                                                                           task, study.conveyor.eraser, *arguments)
+                    metrics.METRICS.merge(snapshot)
+                except Exception as error:
+                    study.finish_file(dcm_file, target, repr(error))
+                    continue
+
+                study.finish_file(dcm_file, target, error)
+                continue
+
+            try:
+                anonymized, snapshot = await loop.run_in_executor(cpu_pool, metrics.collect, metrics.METRICS.enabled,
+                                                                  anonymizer.anonymize_bytes, study.conveyor.eraser, data)
+                metrics.METRICS.merge(snapshot)
+            except Exception as error:
+                await budget.release(reserved)
+                study.finish_file(dcm_file, target, repr(error))
+                continue
+
+            await write_queue.put((study, dcm_file, target, anonymized, reserved))
+
+    async def write_stage(self, budget: ByteBudget, write_queue: asyncio.Queue, io_pool: ThreadPoolExecutor) -> None:
+        """
+        This function takes the anonymized files out of `write_queue`, and
+        writes them to their final paths, until it gets None. The share of the
+        `budget` of every file is given back once it is written.
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        while (item := await write_queue.get()) is not None:
+            study, dcm_file, target, anonymized, reserved = item
+
+            try:
+                await loop.run_in_executor(io_pool, write_file, study.conveyor.committer.staging_target(target), anonymized,
+                                           study.conveyor.committer.fsync_policy == "file")
+            except Exception as error:
+                study.finish_file(dcm_file, target, repr(error))
+                continue
+            finally:
+                await budget.release(reserved)
+
+            metrics.METRICS.count("files_written")
+            metrics.METRICS.count("bytes_written", len(anonymized))
+
+            study.finish_file(dcm_file, target)
+
+    async def run_async(self) -> list[tuple[str, str]]:
+        """
+        This function anonymizes every patient in the `root_path` of the batch
+        (see the class docstring).
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            failures: |list| (file, error message) of every file that failed, in
+                      the same order the patients were found.
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        parse_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        write_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        slots: asyncio.Semaphore = asyncio.Semaphore(self.studies)
+        budget: ByteBudget = ByteBudget(self.queue_bytes)
+
+        with ThreadPoolExecutor(max_workers=self.io_threads) as io_pool, \
+                ProcessPoolExecutor(max_workers=self.workers, initializer=memory.limit_memory,
+                                    initargs=(self.batch.memory_limit,)) as cpu_pool:
+            patients: list[tuple[str, str, str]] = await loop.run_in_executor(io_pool, self.batch.find_patients)
+
+            # One task per process, so the pool is always busy:
+            anonymizers: list[asyncio.Task] = [asyncio.create_task(self.anonymize_stage(budget, parse_queue, write_queue, cpu_pool))
+                                               for _ in range(self.workers)]
+            writers: list[asyncio.Task] = [asyncio.create_task(self.write_stage(budget, write_queue, io_pool))
+                                           for _ in range(self.io_threads)]
+
+            results: list = await asyncio.gather(*(self.read_stage(patient, slots, budget, parse_queue, io_pool) for patient in patients),
+                                                 return_exceptions=True)
+
+            # Every file went through, so the stages can stop:
+            for _ in anonymizers:
+                await parse_queue.put(None)
+            await asyncio.gather(*anonymizers)
+            for _ in writers:
+                await write_queue.put(None)
+            await asyncio.gather(*writers)
+
+        all_failures: list[tuple[str, str]] = []
+
+        for patient, result in zip(patients, results):
+            if isinstance(result, Exception):
+                all_failures.append((patient[0], repr(result)))
+            else:
+                all_failures += result
+
+        return all_failures
+
+    def run(self) -> list[tuple[str, str]]:
+        """
+        Runs `run_async()` in a new event loop (same interface as `batch.Batch.run()`).
+        """
+        return asyncio.run(self.run_async())
+
+
+def write_file(target: str, data: bytes, fsync: bool = False) -> None:
+    """
+    Writes `data` into `target` (through a temporary file, so a half-written
+    file never has the final name), flushing it to the disk if `fsync`.
+    """
+    temporary: str = f"{target}.writing"
+
+    with open(temporary, "wb") as output:
+        output.write(data)
+        if fsync:
+            output.flush()
+            os.fsync(output.fileno())
+
+    os.replace(temporary, target)
+
+
+# %%
+if __name__ == "__main__":
+    root_path: str = input("What is the root of the directory? ")
+
+    for failure in AsyncPipeline(batch.Batch(root_path, r"TAG_DATA_HOSPITAL-\d+\Z")).run():
+        print(f"FAILED: {failure[0]} | {failure[1]}")
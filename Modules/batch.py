@@ -0,0 +1,370 @@
+# %%
+import os
+import re
+import shutil
+from typing import TYPE_CHECKING
+from concurrent.futures import Future, ProcessPoolExecutor
+from Modules import committer
+from Modules import memory
+from Modules import pseudonymizer
+from Modules import journal
+from Modules import metrics
+
+if TYPE_CHECKING:  # Only for the annotations, they are imported by 'Batch.prepare_patient()' (see there why).
+    from Modules import out_of_folder
+    from Modules import pipeline
+
+# What has to be done with a patient, according to the journal (see 'Batch.plan_patient()'):
+#   new     --> never seen before.
+#   resume  --> an interrupted (or failed) run: only the files still missing are anonymized.
+#   changed --> anonymized before, but its sources changed: it starts all over again.
+#   done    --> already anonymized (and unchanged), nothing to do.
+#   missing --> there are no DICOM files, nor a ZIP file, and it was never anonymized.
+PLAN_ACTIONS: list[str] = ["new", "resume", "changed", "done", "missing"]
+
+logger = metrics.get_logger("batch")
+
+
+class Batch:
+    """
+    This program anonymizes every patient inside a main directory, using the
+    `Eraser`, `Reorder` and `Pipeline` classes. It is shared by the one-shot
+    script (main_file.py) and the watch-folder service (see `watcher.Watcher`).
+    \nThis is the structure of the main directory:\n
+     -------------------------------------------------------------------------\n
+     root_path > TAG_DATA_HOSPITAL-N > dicom_directory (or dicom_directory.zip)
+
+     `root_path`: the directory where all the patients are dropped.\n
+     `TAG_DATA_HOSPITAL-N`: the patient directory (it has to match `dir_name_pattern`),
+                            its name is also the anonymized tag of the patient.\n
+     `dicom_directory`: the directory with the DICOM files inside, or a ZIP file.\n
+     -------------------------------------------------------------------------
+    """
+
+    def __init__(self, root_path: str, dir_name_pattern: str, journal_path: str | None = None, workers: int | None = None,
+                 incremental: bool = True, fast_hash: bool = False, keep_sources: bool = False,
+                 fsync_policy: str = "batch", pseudonymizer: pseudonymizer.Pseudonymizer | None = None,
+                 memory_limit: int | None = None, stream_size: int = memory.STREAM_SIZE, profile: str | None = None,
+                 read_only: bool = False) -> None:
+        self.root_path: str = root_path
+        self.dir_name_pattern: str = dir_name_pattern
+        self.pattern: re.Pattern = re.compile(dir_name_pattern)
+        # Number of processes used for the whole batch. When there are several patients,
+        # they are processed at the same time, otherwise the files of the patient are.
+        self.workers: int = workers or os.cpu_count() or 1
+        # What was already done in previous runs, so an interrupted batch can be resumed (only read,
+        # and never created, with 'read_only', e.g. to scan the patients or for a dry run):
+        self.ledger: journal.Journal = journal.Journal(journal_path or f"{root_path}/.anonymizer_journal.sqlite", read_only)
+        # Incremental mode: only the new (or changed) patients are anonymized (see 'journal.make_fingerprint()').
+        self.incremental: bool = incremental
+        self.fast_hash: bool = fast_hash
+        # Keep the original ZIP files/directories after anonymizing them:
+        self.keep_sources: bool = keep_sources
+        # When the anonymized files are flushed to the disk (see 'committer.FSYNC_POLICIES'):
+        if fsync_policy not in committer.FSYNC_POLICIES:
+            raise ValueError(f"'{fsync_policy}' is not a valid fsync policy. Use one of: {committer.FSYNC_POLICIES}")
+        self.fsync_policy: str = fsync_policy
+        # Stable pseudonyms for the identifiers and UIDs, across patients and runs (optional):
+        self.pseudonymizer: pseudonymizer.Pseudonymizer | None = pseudonymizer
+        # Memory-bounded mode: the ceiling of every worker process (in bytes), and the biggest
+        # file loaded whole (see 'anonymizer.rewrite_file()'):
+        self.memory_limit: int | None = memory_limit
+        self.stream_size: int = stream_size
+        # The JSON profile with the anonymization rules (see 'rules.RuleSet.from_file()'), or None
+        # for the default rules of 'anonymizer.Eraser':
+        self.profile: str | None = profile
+
+    def __dir__(self) -> None:
+        return ["find_patient", "find_patients", "source_path", "plan_patient", "prepare_patient", "finish_patient",
+                "process_patient", "run"]
+
+    def find_patient(self, root_paths: str, directories: list[str], files: list[str]) -> tuple[str, str, str] | None:
+        """
+        This function checks if a directory is a patient directory, and finds
+        its DICOM directory (or ZIP file).
+
+        Parameters:
+        -----------
+            root_paths (path): The directory to check.
+            directories: |list| The names of the directories inside it.
+            files: |list| The names of the files inside it.
+
+        Returns:
+        --------
+            patient: |tuple| (patient path, DICOM directory, anonymized tag), or
+                     None if it is not a patient directory. The DICOM directory
+                     is "" if there are no sources left.
+        """
+        if self.pattern.search(root_paths) is None:
+            return None
+
+        anonymized_tag: str = os.path.basename(root_paths)
+
+        # The directory of the anonymized tag might already be there, from an interrupted run (and
+        # the hidden staging directories of the 'committer.Committer' too):
+        source_directories: list[str] = sorted(directory for directory in directories
+                                               if directory != anonymized_tag and not directory.startswith("."))
+        zip_files: list[str] = sorted(item for item in files if os.path.splitext(item)[1] == ".zip")
+
+        if len(source_directories) > 0:  # There are no ZIP files, only a directory.
+            dicom_directory: str = source_directories[0]
+        elif len(zip_files) > 0:  # There is only a ZIP files and no directories.
+            dicom_directory: str = os.path.splitext(zip_files[0])[0]
+        else:  # Only the anonymized files are left.
+            dicom_directory: str = ""
+
+        return root_paths, dicom_directory, anonymized_tag
+
+    def find_patients(self) -> list[tuple[str, str, str]]:
+        """
+        This function walks the `root_path` tree, and returns every patient
+        directory (see `find_patient()`). The walk does not go inside the patient
+        directories (nothing else can match there).
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            patients: |list| (patient path, DICOM directory, anonymized tag) of
+                      every patient.
+        """
+        patients: list[tuple[str, str, str]] = []
+
+        for root_paths, directories, files in os.walk(self.root_path):
+            patient: tuple[str, str, str] | None = self.find_patient(root_paths, directories, files)
+
+            if patient is not None:
+                patients.append(patient)
+                directories[:] = []  # Do not walk the DICOM directories of the patient.
+
+        return patients
+
+    def source_path(self, root_paths: str, dicom_directory: str) -> str:
+        """
+        Returns the ZIP file of the patient if there is one, otherwise its DICOM directory.
+        """
+        if os.path.isfile(f"{root_paths}/{dicom_directory}.zip"):
+            return f"{root_paths}/{dicom_directory}.zip"
+
+        return f"{root_paths}/{dicom_directory}"
+
+    def plan_patient(self, root_paths: str, dicom_directory: str) -> tuple[str, str | None]:
+        """
+        This function decides what has to be done with a patient, only reading
+        the journal (nothing is changed, so it is also used by a dry run).
+
+        Parameters:
+        -----------
+            root_paths (path): The patient directory.
+            dicom_directory (str): The name of the DICOM directory (or ZIP file).
+
+        Returns:
+        --------
+            action: |str| One of `PLAN_ACTIONS`.
+            fingerprint: |str| The fingerprint of the sources (see
+                         `journal.make_fingerprint()`), or None if it is not
+                         needed (not incremental, or no sources).
+        """
+        state: str | None = self.ledger.patient_state(root_paths)
+
+        if not dicom_directory:
+            return ("done" if state in ("anonymized", "cleaned") else "missing"), None
+
+        if not self.incremental:
+            if state == "cleaned":
+                return "done", None
+            return ("new" if state is None else "resume"), None
+
+        fingerprint: str = journal.make_fingerprint(self.source_path(root_paths, dicom_directory), self.fast_hash)
+        saved_fingerprint: str | None = self.ledger.fingerprint(root_paths)
+
+        if saved_fingerprint == fingerprint and state in ("anonymized", "cleaned"):
+            return "done", fingerprint
+        if saved_fingerprint not in (None, fingerprint):
+            return "changed", fingerprint
+
+        return ("new" if state is None else "resume"), fingerprint
+
+    def prepare_patient(self, root_paths: str, dicom_directory: str,
+                        anonymized_tag: str) -> tuple[list[tuple[str, str]], "pipeline.Pipeline | None"]:
+        """
+        This function gets a single patient ready to be anonymized: checks the
+        journal (patients already anonymized by a previous run are skipped),
+        extracts the ZIP file if needed, and builds the study index.
+
+        Parameters:
+        -----------
+            root_paths (path): The patient directory.
+            dicom_directory (str): The name of the DICOM directory (or ZIP file).
+            anonymized_tag (str): The anonymized tag of the patient.
+
+        Returns:
+        --------
+            failures: |list| (path, error message) if the patient cannot be anonymized.
+            conveyor: |pipeline.Pipeline| The pipeline of the patient, or None if
+                      there is nothing to do.
+        """
+        # Imported here, so finding and planning the patients (e.g. a dry run) does not load pydicom:
+        from Modules import anonymizer
+        from Modules import out_of_folder
+        from Modules import pipeline
+
+        action, fingerprint = self.plan_patient(root_paths, dicom_directory)
+
+        if action == "missing":
+            return [(root_paths, "There are no DICOM files, nor a ZIP file, to anonymize.")], None
+        if action == "done":
+            if not dicom_directory:
+                if self.ledger.patient_state(root_paths) == "anonymized":
+                    # Interrupted while removing the original files, which are already gone:
+                    self.ledger.mark_patient(root_paths, "cleaned")
+            else:
+                logger.info("Already anonymized: %s", root_paths)
+                metrics.METRICS.count("patients_skipped")
+            return [], None
+
+        # If there is a ZIP file, the DICOM files are read straight out of it, without extracting them:
+        stream_zip: bool = self.source_path(root_paths, dicom_directory).endswith(".zip")
+        reset: bool = action == "changed"
+
+        if reset:
+            # A new (or changed) study for the same patient, nothing from the previous one is valid:
+            self.ledger.reset_patient(root_paths)
+        if fingerprint is not None:
+            self.ledger.mark_fingerprint(root_paths, fingerprint)
+        # The verification has to know which tags hold pseudonyms (see 'verifier.Verifier.make_rules()'):
+        self.ledger.mark_pseudonymized(root_paths, self.pseudonymizer is not None)
+
+        # ------------------------------------------------
+        men_in_black: anonymizer.Eraser = anonymizer.Eraser(root_paths, anonymized_tag, self.profile, self.pseudonymizer)
+        men_in_black.memory_limit = self.memory_limit
+        men_in_black.stream_size = self.stream_size
+
+        wall_e: out_of_folder.Reorder = out_of_folder.Reorder(root_paths, dicom_directory, anonymized_tag, stream_zip)
+
+        conveyor: pipeline.Pipeline = pipeline.Pipeline(men_in_black, wall_e, committer.Committer(wall_e, self.fsync_policy))
+        # ------------------------------------------------
+        if reset:  # The files of the previous study still waiting to be committed are not valid either.
+            shutil.rmtree(conveyor.committer.staging_path, ignore_errors=True)
+
+        wall_e.unzip_file()
+        self.ledger.mark_patient(root_paths, "extracted")
+
+        wall_e.check_files_order()
+        self.ledger.mark_patient(root_paths, "sorted")
+
+        return [], conveyor
+
+    def finish_patient(self, conveyor: "pipeline.Pipeline", failures: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        """
+        This function records how the patient ended and, only if every file was
+        anonymized without errors, publishes the anonymized files (see
+        `committer.Committer.publish()`) and then, once every file is in the
+        output, removes its original files.
+        If anything failed, the anonymized files are kept in the staging
+        directory, so the next run only retries the failed ones.
+
+        Parameters:
+        -----------
+            conveyor: |pipeline.Pipeline| The pipeline of the patient.
+            failures: |list| (path, error message) of every file that failed.
+
+        Returns:
+        --------
+            failures: |list| The same failures (or the patient itself, if it could not be published).
+        """
+        wall_e: out_of_folder.Reorder = conveyor.reorder
+        root_paths: str = wall_e.root_path
+
+        if failures:
+            self.ledger.mark_patient(root_paths, "failed", f"{len(failures)} file(s) could not be anonymized.")
+            return failures
+
+        # The sources are only removed once the whole output is committed:
+        if not conveyor.committer.publish():
+            message: str = "The anonymized files are incomplete, nothing was published."
+            self.ledger.mark_patient(root_paths, "failed", message)
+            return [(root_paths, message)]
+
+        self.ledger.mark_patient(root_paths, "anonymized")
+
+        wall_e.clear_index()
+
+        if self.keep_sources:
+            return failures
+
+        with metrics.METRICS.timer("cleanup"):
+            if os.path.isdir(wall_e.root_dir_path):
+                shutil.rmtree(wall_e.root_dir_path)
+            if wall_e.stream_zip:
+                os.remove(wall_e.zip_path)
+
+        self.ledger.mark_patient(root_paths, "cleaned")
+
+        return failures
+
+    def process_patient(self, root_paths: str, dicom_directory: str, anonymized_tag: str, file_workers: int = 1) -> list[tuple[str, str]]:
+        """
+        This function anonymizes and sorts all the DICOM files of a single
+        patient (see `prepare_patient()` and `finish_patient()`).
+
+        Parameters:
+        -----------
+            root_paths (path): The patient directory.
+            dicom_directory (str): The name of the DICOM directory (or ZIP file).
+            anonymized_tag (str): The anonymized tag of the patient.
+            file_workers (int): Number of processes used for the files of the patient.
+
+        Returns:
+        --------
+            failures: |list| (path, error message) of every file that failed.
+        """
+        failures, conveyor = self.prepare_patient(root_paths, dicom_directory, anonymized_tag)
+
+        if conveyor is None:
+            return failures
+
+        failures = conveyor.run(file_workers, self.ledger)  # Anonymizes and renames every file, reading it only once.
+
+        return self.finish_patient(conveyor, failures)
+
+    def run(self) -> list[tuple[str, str]]:
+        """
+        This function anonymizes every patient in `root_path`. The patients are
+        processed at the same time when there are several of them, otherwise
+        the files of the single patient are.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            failures: |list| (path, error message) of every file that failed, in
+                      the same order the patients were found.
+        """
+        patients: list[tuple[str, str, str]] = self.find_patients()
+        all_failures: list[tuple[str, str]] = []
+
+        patient_workers: int = max(1, min(self.workers, len(patients)))
+        file_workers: int = max(1, self.workers // patient_workers)
+
+        if patient_workers == 1:
+            for patient in patients:
+                all_failures += self.process_patient(*patient, file_workers)
+        else:
+            with ProcessPoolExecutor(max_workers=patient_workers, initializer=memory.limit_memory,
+                                     initargs=(self.memory_limit,)) as executor:
+                futures: list[Future] = [executor.submit(metrics.collect, metrics.METRICS.enabled, self.process_patient,
+                                                         *patient, file_workers) for patient in patients]
+
+                # Collected in the same order the patients were found, not in the order they finish:
+                for patient, future in zip(patients, futures):
+                    try:
+                        failures, snapshot = future.result()
+                        metrics.METRICS.merge(snapshot)
+                        all_failures += failures
+                    except Exception as error:
+                        all_failures.append((patient[0], repr(error)))
+
+        return all_failures
@@ -0,0 +1,214 @@
+# %%
+import os
+import shutil
+import ctypes
+import ctypes.util
+from typing import TYPE_CHECKING
+from Modules import metrics
+
+if TYPE_CHECKING:  # Only for the annotations: 'out_of_folder' loads pydicom, which committing does not need.
+    from Modules import out_of_folder
+
+# When the anonymized files are flushed to the disk (fsync):
+#   none  --> never, the operating system decides (fastest, not safe against power cuts).
+#   batch --> once for every batch of files, right before recording them in the journal.
+#   file  --> right after writing every single file (slowest).
+FSYNC_POLICIES: list[str] = ["none", "batch", "file"]
+# Linux 'renameat2()' flags (see 'man 2 rename'):
+AT_FDCWD: int = -100
+RENAME_EXCHANGE: int = 2
+
+logger = metrics.get_logger("committer")
+
+
+def sync_path(path: str) -> None:
+    """
+    Flushes a file (or a directory, so the names inside it are durable) to the disk.
+    """
+    descriptor: int = os.open(path, os.O_RDONLY)
+
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def sync_filesystem(path: str) -> bool:
+    """
+    Flushes everything written to the file system holding `path` to the disk,
+    in a single call (Linux 'syncfs()', through `ctypes`), instead of one
+    fsync per file. It returns False if the system cannot do it.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        descriptor: int = os.open(path, os.O_RDONLY)
+    except (AttributeError, OSError):
+        return False
+
+    try:
+        return libc.syncfs(descriptor) == 0
+    except AttributeError:  # Not Linux, or an old C library.
+        return False
+    finally:
+        os.close(descriptor)
+
+
+def exchange_paths(path: str, other_path: str) -> bool:
+    """
+    Swaps two paths in a single atomic step (Linux 'renameat2()' with
+    RENAME_EXCHANGE, through `ctypes`). It returns False if the system cannot
+    do it, and then nothing was changed.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        result: int = libc.renameat2(AT_FDCWD, os.fsencode(path), AT_FDCWD, os.fsencode(other_path), RENAME_EXCHANGE)
+    except (AttributeError, OSError):  # Not Linux, or an old C library.
+        return False
+
+    return result == 0
+
+
+class Committer:
+    """
+    This program makes the output of a patient appear all at once: the
+    anonymized files are written into a hidden staging directory, next to the
+    final one (so it is on the same file system), and once every file is there
+    the staging directory is renamed to `{anonymized_tag}` in a single step.
+    \nIf a run is interrupted, the `{anonymized_tag}` directory is never left
+    half-populated, and the original files are only removed after the commit
+    (see `batch.Batch.finish_patient()`). How often the files are flushed to
+    the disk is chosen with `fsync_policy` (see `FSYNC_POLICIES`).
+    """
+
+    def __init__(self, reorder: "out_of_folder.Reorder", fsync_policy: str = "batch") -> None:
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"'{fsync_policy}' is not a valid fsync policy. Use one of: {FSYNC_POLICIES}")
+
+        self.reorder: out_of_folder.Reorder = reorder
+        self.fsync_policy: str = fsync_policy
+        self.final_path: str = f"{reorder.root_path}/{reorder.anonymized_tag}"
+        self.staging_path: str = f"{reorder.root_path}/.{reorder.anonymized_tag}.staging"
+        # The names of all the files the patient must end up with (see 'pipeline.Pipeline.jobs()'):
+        self.expected: set[str] | None = None
+
+    def __dir__(self) -> None:
+        return ["prepare", "staging_target", "sync", "missing_files", "publish"]
+
+    def prepare(self) -> None:
+        """
+        Creates the staging directory (it is kept if it is already there, from an interrupted run).
+        """
+        os.makedirs(self.staging_path, exist_ok=True)
+
+    def staging_target(self, target: str) -> str:
+        """
+        Returns where the file with the final path `target` is written until the commit.
+        """
+        return f"{self.staging_path}/{os.path.basename(target)}"
+
+    def sync(self, staging_targets: list[str]) -> None:
+        """
+        This function flushes a batch of files written into the staging
+        directory (and the directory itself) to the disk, if the policy is
+        'batch'. With 'file' they were already flushed by the workers, and with
+        'none' they are never flushed. \n
+            - The whole file system is flushed at once (see `sync_filesystem()`),
+              which costs about the same as a single fsync. \n
+            - Where that is not possible, every file is flushed on its own.
+
+        Parameters:
+        -----------
+            staging_targets: |list| The paths of the files written.
+
+        Returns:
+        --------
+
+        """
+        if self.fsync_policy != "batch" or not staging_targets:
+            return
+
+        with metrics.METRICS.timer("fsync"):
+            if not sync_filesystem(self.staging_path):
+                for staging_target in staging_targets:
+                    if os.path.isfile(staging_target):
+                        sync_path(staging_target)
+            sync_path(self.staging_path)
+
+    def missing_files(self, path: str) -> set[str] | None:
+        """
+        Returns the names of the expected files (see `expected`) that are not
+        in the directory `path`, or None when they are not known.
+        """
+        found: set[str] = set(os.listdir(path)) if os.path.isdir(path) else set()
+
+        return None if self.expected is None else self.expected - found
+
+    def publish(self) -> bool:
+        """
+        This function commits the output of the patient: the staging directory
+        becomes the `{anonymized_tag}` directory. \n
+            - Nothing is published if any of the `expected` files is missing
+              from the staging directory, or if it is empty and the
+              `{anonymized_tag}` directory is not. \n
+            - If there is no `{anonymized_tag}` directory yet, it is a single
+              rename. \n
+            - If there is one (e.g. from an older run), both directories are
+              swapped in a single step (Linux), or one after the other
+              otherwise, and then the old one is removed.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            published (bool): True if the `{anonymized_tag}` directory holds
+                              every expected file, so the sources can be removed.
+        """
+        if not os.path.isdir(self.staging_path):  # Already published (if nothing is missing).
+            return not self.missing_files(self.final_path) and os.path.isdir(self.final_path)
+
+        missing: set[str] | None = self.missing_files(self.staging_path)
+
+        if missing:
+            logger.error("Not committed, %d anonymized file(s) missing: %s", len(missing), self.final_path)
+            return False
+        if not os.listdir(self.staging_path) and os.path.isdir(self.final_path) and os.listdir(self.final_path):
+            logger.error("Not committed, nothing was anonymized: %s", self.final_path)
+            return False
+
+        with metrics.METRICS.timer("commit"):
+            if self.fsync_policy != "none":
+                sync_path(self.staging_path)
+
+            if not os.path.exists(self.final_path):
+                os.rename(self.staging_path, self.final_path)
+            else:
+                old_path: str = f"{self.reorder.root_path}/.{self.reorder.anonymized_tag}.old"
+                shutil.rmtree(old_path, ignore_errors=True)
+
+                if exchange_paths(self.staging_path, self.final_path):
+                    os.rename(self.staging_path, old_path)  # Now holding the old files.
+                else:
+                    os.rename(self.final_path, old_path)
+                    os.rename(self.staging_path, self.final_path)
+
+                shutil.rmtree(old_path)
+
+            if self.fsync_policy != "none":
+                sync_path(self.reorder.root_path)  # The rename itself is durable.
+
+        logger.info("Committed: %s", self.final_path)
+
+        return True
+
+
+# %%
+if __name__ == "__main__":
+    from Modules import out_of_folder
+
+    root_path: str = input("What is the root of the directory? ")
+    dicom_directory: str = input("What is the name of the DICOM directory? ")
+    anonymized_tag: str = input("What is the anonymized tag? ")
+
+    wall_e = out_of_folder.Reorder(root_path, dicom_directory, anonymized_tag)
+    wall_e.rename_files(Committer(wall_e))
@@ -0,0 +1,325 @@
+# %%
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import urllib.parse
+
+# States of a patient, in the order they are reached:
+#   extracted  --> the ZIP file was extracted (or is ready to be streamed).
+#   sorted     --> the study index was built.
+#   anonymized --> every file was anonymized and written with its final name.
+#   cleaned    --> the original files were removed. Nothing else to do.
+#   failed     --> at least one file could not be anonymized (the sources are kept).
+PATIENT_STATES: list[str] = ["extracted", "sorted", "anonymized", "cleaned", "failed"]
+# States of a single file:
+#   anonymized --> written with its final name.
+#   failed     --> could not be anonymized (it is tried again in the next run).
+FILE_STATES: list[str] = ["anonymized", "failed"]
+# Bytes hashed at the beginning and at the end of a file, for the fast hash of the fingerprints:
+HASH_SIZE: int = 1024 * 1024
+TABLES: list[str] = ["CREATE TABLE IF NOT EXISTS patients (patient TEXT PRIMARY KEY, state TEXT, error TEXT, updated REAL)",
+                     "CREATE TABLE IF NOT EXISTS files (patient TEXT, source TEXT, target TEXT, state TEXT, error TEXT, "
+                     "updated REAL, PRIMARY KEY (patient, source))",
+                     "CREATE TABLE IF NOT EXISTS fingerprints (patient TEXT PRIMARY KEY, fingerprint TEXT, updated REAL)",
+                     "CREATE TABLE IF NOT EXISTS pseudonymized (patient TEXT PRIMARY KEY, updated REAL)"]
+
+
+def make_fingerprint(source_path: str, fast_hash: bool = False) -> str:
+    """
+    This function summarizes the content of a patient source (a ZIP file or a
+    directory) without reading it: its size and modification time (for a
+    directory, the number of files, their total size and the newest
+    modification time of all of them). \n
+    With `fast_hash`, the first and last MB of every file are hashed too, so
+    a file rewritten with the same size and time is also noticed.
+
+    Parameters:
+    -----------
+        source_path (path): The ZIP file or the DICOM directory.
+        fast_hash (bool): Also hash the beginning and the end of every file.
+
+    Returns:
+    --------
+        fingerprint: |str| The fingerprint of the source.
+    """
+    file_count: int = 0
+    total_size: int = 0
+    newest_mtime: int = 0
+    digest = hashlib.blake2b(digest_size=16)
+    stack: list[str] = [source_path] if os.path.isdir(source_path) else []
+    paths: list[tuple[str, os.stat_result]] = [] if stack else [(source_path, os.stat(source_path))]
+
+    while stack:  # Only 'stat()', no file is opened (unless 'fast_hash').
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    paths.append((entry.path, entry.stat()))
+
+    for path, stat in sorted(paths):
+        file_count += 1
+        total_size += stat.st_size
+        newest_mtime = max(newest_mtime, stat.st_mtime_ns)
+
+        if fast_hash:
+            with open(path, "rb") as source_file:
+                digest.update(source_file.read(HASH_SIZE))
+                if stat.st_size > 2 * HASH_SIZE:
+                    source_file.seek(-HASH_SIZE, os.SEEK_END)
+                    digest.update(source_file.read(HASH_SIZE))
+
+    fingerprint: str = f"{file_count}:{total_size}:{newest_mtime}"
+
+    return f"{fingerprint}:{digest.hexdigest()}" if fast_hash else fingerprint
+
+
+class Journal:
+    """
+    This program keeps a durable record (a small SQLite database) of what was
+    already done in a batch, for every patient and every file. If a run is
+    interrupted, the next one skips whatever was completed and only retries
+    what was left, or what failed.
+    \nSeveral processes (and threads) can write into the same journal (WAL mode),
+    each one with its own connection.
+    \nWith `read_only` (e.g. a scan or a dry run), the journal is only read, and
+    it is not created if it does not exist yet (every patient is new then).
+    """
+
+    def __init__(self, journal_path: str, read_only: bool = False) -> None:
+        self.journal_path: str = journal_path
+        self.read_only: bool = read_only
+        self.connection: sqlite3.Connection | None = None
+        self.connection_pid: int | None = None
+        # The threads of a process (e.g. the asyncio pipeline) cannot share a connection, each one opens its own:
+        self.connections: threading.local = threading.local()
+
+    def __dir__(self) -> None:
+        return ["connect", "open", "patient_state", "mark_patient", "done_files", "mark_files", "fingerprint",
+                "mark_fingerprint", "pseudonymized", "mark_pseudonymized", "reset_patient"]
+
+    def __getstate__(self) -> dict:
+        # A connection cannot be sent to other processes, each one opens its own.
+        return {"journal_path": self.journal_path, "read_only": self.read_only, "connection": None, "connection_pid": None}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.connections = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        This function opens (only once per process, or per thread) the journal,
+        creating its tables if they do not exist yet.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            connection: |sqlite3.Connection| The connection to the journal.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            if getattr(self.connections, "connection", None) is None:
+                self.connections.connection = self.open()
+            return self.connections.connection
+
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = self.open()
+            self.connection_pid = os.getpid()
+
+        return self.connection
+
+    def open(self) -> sqlite3.Connection:
+        """
+        Opens a new connection to the journal (see `connect()`).
+        """
+        if self.read_only:
+            if os.path.isfile(self.journal_path):
+                uri: str = f"file:{urllib.parse.quote(os.path.abspath(self.journal_path))}?mode=ro"
+                connection: sqlite3.Connection = sqlite3.connect(uri, uri=True, timeout=60)
+            else:  # Nothing was done yet, and nothing is created on the disk:
+                connection: sqlite3.Connection = sqlite3.connect(":memory:")
+                for table in TABLES:
+                    connection.execute(table)
+            connection.execute("PRAGMA query_only=ON")
+            return connection
+
+        connection: sqlite3.Connection = sqlite3.connect(self.journal_path, timeout=60)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Durable once committed to the WAL, without a fsync for every single file:
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with connection:
+            for table in TABLES:
+                connection.execute(table)
+
+        return connection
+
+    def patient_state(self, patient: str) -> str | None:
+        """
+        This function returns the last state recorded for a patient.
+
+        Parameters:
+        -----------
+            patient (path): The path of the patient directory.
+
+        Returns:
+        --------
+            state: |str| One of `PATIENT_STATES`, or None if the patient was never seen.
+        """
+        row = self.connect().execute("SELECT state FROM patients WHERE patient = ?", (patient,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def mark_patient(self, patient: str, state: str, error: str | None = None) -> None:
+        """
+        This function records the new state of a patient.
+
+        Parameters:
+        -----------
+            patient (path): The path of the patient directory.
+            state (str): One of `PATIENT_STATES`.
+            error (str): What went wrong, if the state is 'failed'.
+
+        Returns:
+        --------
+
+        """
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO patients VALUES (?, ?, ?, ?)", (patient, state, error, time.time()))
+
+    def done_files(self, patient: str, locate=None) -> set[str]:
+        """
+        This function returns the targets of all the files of a patient that
+        were already anonymized, and still exist.
+
+        Parameters:
+        -----------
+            patient (path): The path of the patient directory.
+            locate: |function| Optional, returns where a target is really
+                    stored (e.g. `committer.Committer.staging_target()`).
+
+        Returns:
+        --------
+            targets: |set| The paths of the anonymized files.
+        """
+        rows = self.connect().execute("SELECT target FROM files WHERE patient = ? AND state = 'anonymized'", (patient,))
+
+        return {row[0] for row in rows if os.path.isfile(row[0] if locate is None else locate(row[0]))}
+
+    def mark_files(self, patient: str, results: list[tuple[str, str, str | None]]) -> None:
+        """
+        This function records the result of several files at once (a single
+        transaction), so the journal does not slow down the batch.
+
+        Parameters:
+        -----------
+            patient (path): The path of the patient directory.
+            results: |list| (source, target, error message or None) of every file.
+
+        Returns:
+        --------
+
+        """
+        now: float = time.time()
+
+        with self.connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                   [(patient, source, target, "anonymized" if error is None else "failed", error, now)
+                                    for source, target, error in results])
+
+    def fingerprint(self, patient: str) -> str | None:
+        """
+        This function returns the fingerprint of the source last anonymized
+        for a patient (see `make_fingerprint()`).
+
+        Parameters:
+        -----------
+            patient (path): The path of the patient directory.
+
+        Returns:
+        --------
+            fingerprint: |str| The fingerprint, or None if there is none.
+        """
+        row = self.connect().execute("SELECT fingerprint FROM fingerprints WHERE patient = ?", (patient,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def mark_fingerprint(self, patient: str, fingerprint: str) -> None:
+        """
+        This function records the fingerprint of the source anonymized for a patient.
+
+        Parameters:
+        -----------
+            patient (path): The path of the patient directory.
+            fingerprint (str): The fingerprint of the source.
+
+        Returns:
+        --------
+
+        """
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)", (patient, fingerprint, time.time()))
+
+    def pseudonymized(self, patient: str) -> bool:
+        """
+        This function tells if the identifiers and UIDs of a patient were given
+        pseudonyms when it was last anonymized (see `pseudonymizer.Pseudonymizer`).
+
+        Parameters:
+        -----------
+            patient (path): The path of the patient directory.
+
+        Returns:
+        --------
+            pseudonymized: |bool| True if it was anonymized with a pseudonymization key.
+        """
+        row = self.connect().execute("SELECT 1 FROM pseudonymized WHERE patient = ?", (patient,)).fetchone()
+
+        return row is not None
+
+    def mark_pseudonymized(self, patient: str, pseudonymized: bool) -> None:
+        """
+        This function records if a patient is anonymized with a pseudonymization
+        key, so its files can be verified later on (see `verifier.Verifier`).
+
+        Parameters:
+        -----------
+            patient (path): The path of the patient directory.
+            pseudonymized (bool): True if it is anonymized with a pseudonymization key.
+
+        Returns:
+        --------
+
+        """
+        with self.connect() as connection:
+            if pseudonymized:
+                connection.execute("INSERT OR REPLACE INTO pseudonymized VALUES (?, ?)", (patient, time.time()))
+            else:
+                connection.execute("DELETE FROM pseudonymized WHERE patient = ?", (patient,))
+
+    def reset_patient(self, patient: str) -> None:
+        """
+        This function forgets the files of a patient, so a new (or changed)
+        source is anonymized from scratch.
+
+        Parameters:
+        -----------
+            patient (path): The path of the patient directory.
+
+        Returns:
+        --------
+
+        """
+        with self.connect() as connection:
+            connection.execute("DELETE FROM files WHERE patient = ?", (patient,))
+            connection.execute("DELETE FROM patients WHERE patient = ?", (patient,))
+
+
+# %%
+if __name__ == "__main__":
+    journal_path: str = input("What is the path of the journal? ")
+
+    for patient, state, error, updated in Journal(journal_path, read_only=True).connect().execute("SELECT * FROM patients ORDER BY patient"):
+        print(f"patient: {patient} | state: {state} | error: {error} | updated: {time.ctime(updated)}")
@@ -0,0 +1,92 @@
+# %%
+import resource
+from Modules import metrics
+
+# Where Linux keeps the peak RSS of the process (VmHWM), and how it is reset (see 'man 5 proc'):
+STATUS_PATH: str = "/proc/self/status"
+CLEAR_REFS_PATH: str = "/proc/self/clear_refs"
+RESET_PEAK: str = "5"
+# Files bigger than this are never loaded whole when they have to be rewritten: only their header
+# is, and the pixel data is copied in chunks (see 'anonymizer.rewrite_file()'):
+STREAM_SIZE: int = 256 * 1024 * 1024
+
+logger = metrics.get_logger("memory")
+
+
+def limit_memory(limit: int | None) -> None:
+    """
+    This function sets the memory ceiling (in bytes) of the current process:
+    past it, allocations fail with a `MemoryError` (which can be handled)
+    instead of the whole node running out of memory and killing the workers.
+    It is meant as the `initializer` of the worker processes, so the main
+    process (and the journal, the pool itself...) is never limited.
+
+    Parameters:
+    -----------
+        limit (int): The ceiling, in bytes, of the address space of the
+                     process. With None, nothing is changed.
+
+    Returns:
+    --------
+
+    """
+    if limit is None:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)  # It can only be lowered.
+    if soft != limit:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+        logger.debug("Memory ceiling: %.1f MB", limit / 1e6)
+
+
+def peak_memory() -> int:
+    """
+    Returns the peak RSS (in bytes) of the current process since the last
+    `reset_peak()` (or since it started, where it cannot be reset).
+    """
+    try:
+        with open(STATUS_PATH, "r") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:  # Not Linux.
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak() -> bool:
+    """
+    Resets the peak RSS of the current process to its current RSS, so the
+    next `peak_memory()` only covers what came after. It returns False if the
+    system cannot do it.
+    """
+    try:
+        with open(CLEAR_REFS_PATH, "w") as clear_refs:
+            clear_refs.write(RESET_PEAK)
+    except OSError:
+        return False
+
+    return True
+
+
+def take_peak() -> int:
+    """
+    Returns the peak RSS (in bytes) since the last call, and starts measuring again.
+    """
+    peak: int = peak_memory()
+    reset_peak()
+
+    return peak
+
+
+# %%
+if __name__ == "__main__":
+    print(f"Peak memory: {take_peak() / 1e6:.1f} MB")
+    data: bytes = b"x" * 256 * 1024 * 1024
+    print(f"Peak memory: {take_peak() / 1e6:.1f} MB")
+    del data
+    print(f"Peak memory: {take_peak() / 1e6:.1f} MB")
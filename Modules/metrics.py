@@ -0,0 +1,313 @@
+# %%
+import os
+import json
+import time
+import logging
+
+# Every module logs through this logger (or a child of it), instead of printing:
+LOGGER_NAME: str = "patient_anonymizer"
+# Counters recorded by the batch (any other name can be used too):
+#   files_read      --> DICOM files read (from the disk or a ZIP file).
+#   bytes_read      --> size of those files.
+#   files_written   --> anonymized files written.
+#   bytes_written   --> size of the anonymized files.
+#   files_patched   --> files anonymized by patching their bytes (see 'patcher.Patcher').
+#   files_rewritten --> files anonymized by writing the whole dataset again.
+#   files_streamed  --> rewritten files whose pixel data was copied in chunks, never loaded (see 'anonymizer.rewrite_file()').
+#   files_skipped   --> files already anonymized by a previous run.
+#   files_failed    --> files that could not be anonymized.
+#   tags_changed    --> tags replaced, emptied or removed.
+#   patients_skipped --> patients already anonymized (and unchanged).
+#   files_verified  --> anonymized files checked for personal data left (see 'verifier.Verifier').
+COUNTERS: list[str] = ["files_read", "bytes_read", "files_written", "bytes_written", "files_patched", "files_rewritten",
+                       "files_streamed", "files_skipped", "files_failed", "tags_changed", "patients_skipped",
+                       "files_verified"]
+# Peaks recorded by the batch (the highest value seen, not a sum):
+#   file_peak_rss_bytes --> the most memory a worker needed for a single file (see 'memory.take_peak()').
+PEAKS: list[str] = ["file_peak_rss_bytes"]
+# Attributes every log record has, anything else was given through 'extra':
+RECORD_ATTRIBUTES: set[str] = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+
+def get_logger(name: str = "") -> logging.Logger:
+    """
+    Returns the logger of a module (e.g. `get_logger("pipeline")`).
+    """
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Writes every log record as a single JSON line (time, level, logger,
+    message, and any `extra` fields given to the logging call).
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line: dict = {"time": round(record.created, 3),
+                      "level": record.levelname,
+                      "logger": record.name,
+                      "message": record.getMessage()}
+
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                line[key] = value
+
+        return json.dumps(line, default=str)
+
+
+def configure_logging(level: str = "INFO", structured: bool = False) -> None:
+    """
+    This function sends the logs of the whole program to the console.
+
+    Parameters:
+    -----------
+        level (str): The lowest level shown ("DEBUG" shows every single file,
+                     "INFO" only the progress of every patient, "WARNING"...).
+        structured (bool): Write JSON lines instead of plain text.
+
+    Returns:
+    --------
+
+    """
+    handler: logging.StreamHandler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if structured else logging.Formatter("%(message)s"))
+
+    logger: logging.Logger = get_logger()
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+class NullTimer:
+    """
+    Timer used when the metrics are disabled: it does nothing at all.
+    """
+
+    def __enter__(self) -> "NullTimer":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+NULL_TIMER: NullTimer = NullTimer()
+
+
+class Timer:
+    """
+    Adds the wall time of a `with` block to a stage of `Metrics`.
+    """
+
+    def __init__(self, metrics: "Metrics", stage: str) -> None:
+        self.metrics: Metrics = metrics
+        self.stage: str = stage
+        self.start_time: float = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.metrics.add_time(self.stage, time.perf_counter() - self.start_time)
+
+
+class Metrics:
+    """
+    This program keeps the counters (see `COUNTERS`), the peaks (see `PEAKS`)
+    and the time spent in every stage of a run, and exports them as a single summary (JSON, or the
+    Prometheus text-file format).
+    \nIt is disabled by default: then `count()` and `timer()` return right away,
+    so the instrumented code costs (almost) nothing. Every process has its own
+    `METRICS`: the worker processes send theirs back (see `collect()`), and
+    they are merged into the one of the main process.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled: bool = enabled
+        self.counters: dict[str, int] = {}
+        self.peaks: dict[str, int] = {}
+        # key --> stage, value --> [seconds, calls]
+        self.timers: dict[str, list] = {}
+        self.start_time: float = time.time()
+
+    def __dir__(self) -> None:
+        return ["enable", "reset", "count", "peak", "timer", "add_time", "snapshot", "merge", "summary", "to_json",
+                "to_prometheus", "export"]
+
+    def enable(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+
+    def reset(self) -> None:
+        self.counters = {}
+        self.peaks = {}
+        self.timers = {}
+        self.start_time = time.time()
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """
+        Adds `amount` to the counter `name`.
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def peak(self, name: str, value: int) -> None:
+        """
+        Keeps `value` in the peak `name`, if it is the highest one so far.
+        """
+        if self.enabled and value > self.peaks.get(name, 0):
+            self.peaks[name] = value
+
+    def timer(self, stage: str) -> Timer | NullTimer:
+        """
+        Returns a context manager that adds the wall time of its block to `stage`:\n
+            with METRICS.timer("sort"):
+                ...
+        """
+        return Timer(self, stage) if self.enabled else NULL_TIMER
+
+    def add_time(self, stage: str, seconds: float, calls: int = 1) -> None:
+        timer: list = self.timers.setdefault(stage, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += calls
+
+    def snapshot(self) -> dict:
+        """
+        Returns the counters and timers, so they can be sent to another process.
+        """
+        return {"counters": dict(self.counters), "peaks": dict(self.peaks), "timers": {stage: list(timer) for stage, timer in self.timers.items()}}
+
+    def merge(self, snapshot: dict | None) -> None:
+        """
+        Adds the counters and timers of a `snapshot()` (e.g. from a worker process).
+        """
+        if not snapshot:
+            return
+
+        for name, amount in snapshot["counters"].items():
+            self.counters[name] = self.counters.get(name, 0) + amount
+        for name, value in snapshot["peaks"].items():
+            self.peaks[name] = max(self.peaks.get(name, 0), value)
+        for stage, (seconds, calls) in snapshot["timers"].items():
+            self.add_time(stage, seconds, calls)
+
+    def summary(self) -> dict:
+        """
+        This function returns the summary of the run.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            summary: |dict| `"counters"` --> every counter (the ones in
+                     `COUNTERS` are always there).\n
+                     `"peaks"` --> every peak (the highest value of all the
+                     processes).\n
+                     `"stages"` --> seconds and calls of every stage. The time
+                     of the stages run by the worker processes is added up, so
+                     it can be bigger than the wall time.\n
+                     `"wall_seconds"` --> time since the metrics were reset.
+        """
+        counters: dict[str, int] = {name: 0 for name in COUNTERS}
+        counters.update(self.counters)
+        peaks: dict[str, int] = {name: 0 for name in PEAKS}
+        peaks.update(self.peaks)
+
+        return {"started": self.start_time,
+                "wall_seconds": round(time.time() - self.start_time, 3),
+                "counters": counters,
+                "peaks": peaks,
+                "stages": {stage: {"seconds": round(seconds, 6), "calls": calls}
+                           for stage, (seconds, calls) in sorted(self.timers.items())}}
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), indent=4)
+
+    def to_prometheus(self) -> str:
+        """
+        Returns the summary in the Prometheus text-file format (for the
+        node_exporter text-file collector).
+        """
+        summary: dict = self.summary()
+        lines: list[str] = ["# TYPE anonymizer_run_wall_seconds gauge",
+                            f"anonymizer_run_wall_seconds {summary['wall_seconds']}",
+                            "# TYPE anonymizer_run_started_seconds gauge",
+                            f"anonymizer_run_started_seconds {summary['started']}"]
+
+        for name, amount in summary["counters"].items():
+            lines.append(f"# TYPE anonymizer_{name}_total counter")
+            lines.append(f"anonymizer_{name}_total {amount}")
+        for name, value in summary["peaks"].items():
+            lines.append(f"# TYPE anonymizer_{name} gauge")
+            lines.append(f"anonymizer_{name} {value}")
+
+        lines.append("# TYPE anonymizer_stage_seconds gauge")
+        lines += [f'anonymizer_stage_seconds{{stage="{stage}"}} {timer["seconds"]}' for stage, timer in summary["stages"].items()]
+        lines.append("# TYPE anonymizer_stage_calls gauge")
+        lines += [f'anonymizer_stage_calls{{stage="{stage}"}} {timer["calls"]}' for stage, timer in summary["stages"].items()]
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, metrics_path: str) -> None:
+        """
+        This function writes the summary into `metrics_path`: in the Prometheus
+        text-file format if it ends with '.prom', otherwise as JSON. It is
+        written into a temporary file first and then renamed, so a collector
+        never reads a half-written file.
+
+        Parameters:
+        -----------
+            metrics_path (path): Where to write the summary.
+
+        Returns:
+        --------
+
+        """
+        content: str = self.to_prometheus() if metrics_path.endswith(".prom") else self.to_json()
+
+        with open(f"{metrics_path}.tmp", "w") as metrics_file:
+            metrics_file.write(content)
+        os.replace(f"{metrics_path}.tmp", metrics_path)
+
+
+# The metrics of the current process:
+METRICS: Metrics = Metrics()
+
+
+def collect(enabled: bool, function, *arguments) -> tuple:
+    """
+    This function runs `function(*arguments)` in a worker process, and sends
+    back its result together with the metrics it recorded (None if the metrics
+    are disabled). The main process merges them with `METRICS.merge()`.
+
+    Parameters:
+    -----------
+        enabled (bool): If the metrics of the main process are enabled.
+        function: |function| What to run.
+        arguments: The arguments of `function`.
+
+    Returns:
+    --------
+        result: |tuple| (what `function` returned, metrics snapshot or None).
+    """
+    if not enabled:
+        return function(*arguments), None
+
+    METRICS.enable()
+    METRICS.reset()
+    result = function(*arguments)
+    snapshot: dict = METRICS.snapshot()
+    METRICS.reset()
+
+    return result, snapshot
+
+
+# %%
+if __name__ == "__main__":
+    METRICS.enable()
+
+    with METRICS.timer("example"):
+        METRICS.count("files_read", 3)
+
+    print(METRICS.to_json())
+    print(METRICS.to_prometheus())
@@ -1,14 +1,120 @@
 # %%
 import os
+import json
+import logging
 import pydicom
 import zipfile
+from typing import NamedTuple
+from Modules import metrics
+
+try:  # Optional, only used for sorting very big studies (see 'Reorder.sort_files()').
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Only these tags are needed for ordering the files, everything else in the
+# header (and specially the pixel data) is skipped while scanning.
+HEADER_TAGS: list[str] = ["StudyDate", "SeriesTime", "SeriesNumber", "SeriesInstanceUID", "InstanceNumber",
+                          "ImagePositionPatient", "ImageOrientationPatient"]
+# From this number of files on, the study is sorted with 'numpy.lexsort()' (if NumPy is installed):
+LEXSORT_MIN_FILES: int = 50_000
+
+logger = metrics.get_logger("out_of_folder")
+
+
+class FileRecord(NamedTuple):
+    """
+    Compact description of a single DICOM file, built from its header only.
+
+    `path`: full path of the DICOM file.\n
+    `series_time`: value of the `SeriesTime` DICOM tag.\n
+    `series_instance_uid`: value of the `SeriesInstanceUID` DICOM tag ("" if missing).\n
+    `instance_number`: value of the `InstanceNumber` DICOM tag (None if missing).\n
+    `file_size`: size of the file in bytes.\n
+    `study_date`: value of the `StudyDate` DICOM tag ("" if missing).\n
+    `series_number`: value of the `SeriesNumber` DICOM tag (None if missing).\n
+    `slice_position`: position of the slice along the normal of the image plane,
+                      from `ImagePositionPatient` and `ImageOrientationPatient` (None if missing).
+    """
+    path: str
+    series_time: str
+    series_instance_uid: str
+    instance_number: int | None
+    file_size: int
+    study_date: str
+    series_number: int | None
+    slice_position: float | None
+
+
+def slice_position(dataset: pydicom.Dataset) -> float | None:
+    """
+    This function projects `ImagePositionPatient` onto the normal of the image
+    plane (the cross product of the row and column directions in
+    `ImageOrientationPatient`), which gives the position of the slice inside
+    its series, whatever the orientation. Without an orientation, the Z
+    coordinate is used.
+
+    Parameters:
+    -----------
+        dataset: |pydicom.Dataset| The header of the DICOM file.
+
+    Returns:
+    --------
+        position: |float| The position of the slice, or None if it is unknown.
+    """
+    try:
+        position: list[float] = [float(value) for value in dataset.ImagePositionPatient]
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+    if len(position) != 3:
+        return None
+
+    try:
+        row_x, row_y, row_z, column_x, column_y, column_z = [float(value) for value in dataset.ImageOrientationPatient]
+    except (AttributeError, TypeError, ValueError):
+        return position[2]
+
+    normal: tuple[float, float, float] = (row_y * column_z - row_z * column_y,
+                                          row_z * column_x - row_x * column_z,
+                                          row_x * column_y - row_y * column_x)
+
+    return sum(axis * coordinate for axis, coordinate in zip(normal, position))
+
+
+def optional_int(value) -> int | None:
+    """
+    Returns `value` as an integer, or None if it is missing (or not a number).
+    """
+    try:
+        return None if value in (None, "") else int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def sort_key(record: FileRecord) -> tuple:
+    """
+    This function returns the key used to sort the files of a study:\n
+    (StudyDate, SeriesTime, SeriesNumber, SeriesInstanceUID, InstanceNumber, slice position, path).\n
+    Missing numbers go after the present ones, and the path breaks any tie,
+    so two files never share the same key (and the order never depends on
+    the order the files were read in).
+    """
+    return (record.study_date,
+            record.series_time,
+            record.series_number is None, record.series_number or 0,
+            record.series_instance_uid,
+            record.instance_number is None, record.instance_number or 0,
+            record.slice_position is None, record.slice_position or 0.0,
+            record.path)
 
 
 class Reorder:
     """
     This program takes a parent directory, checks if there are any children directories inside, and sorts their
     contents.
-    \nIf the child directory has a ZIP file, it unzips it, removes all the directories that might have been created, and saves all the files in a newly created directory, sorting them according to their `SeriesTime` DICOM tag.
+    \nIf the child directory has a ZIP file, it unzips it, removes all the directories that might have been created, and saves all the files in a newly created directory, sorting them according to their `SeriesTime` DICOM tag (and then their series, instance number and position, see `sort_key()`).
     \nIf there is no ZIP file, then the program checks for an already unziped directory.\n\n
     This is the structure for the directory/ZIP file:\n
      -------------------------------------------------------------------------\n
@@ -22,21 +128,33 @@ class Reorder:
      -------------------------------------------------------------------------
     """
 
-    def __init__(self, root_path, dicom_directory, anonymized_tag="EMPTY_ANONYMIZED_TAG"):
+    def __init__(self, root_path, dicom_directory, anonymized_tag="EMPTY_ANONYMIZED_TAG", stream_zip=False):
         self.dicom_directory: str = dicom_directory
         self.root_path: str = root_path
         self.root_dir_path: str = f"{self.root_path}/{self.dicom_directory}"
         self.anonymized_tag: str = anonymized_tag
-        self.time_stamp_dict: dict[str, str] = {}
+        # When streaming, the DICOM files are read straight out of the ZIP file and never extracted:
+        self.zip_path: str = f"{self.root_path}/{self.dicom_directory}.zip"
+        self.stream_zip: bool = stream_zip
+        # The study index is built once, and reused by every later operation:
+        self.index_path: str = f"{self.root_path}/.{self.dicom_directory}_index.json"
+        self.study_index: list[FileRecord] | None = None
+        self.index_signature: tuple[int, int] | None = None
+        self.index_mtimes: dict[str, int] = {}
 
     def __dir__(self):
-        return ["unzip_file", "make_directory", "sort_files", "check_files_order", "rename_files"]
+        return ["unzip_file", "make_directory", "read_header", "scan_files", "scan_zip", "member_name",
+                "directory_signature", "get_index",
+                "load_index", "save_index", "clear_index", "sort_files", "check_files_order", "rename_files",
+                "number_width", "make_number_tag", "target_path"]
 
     def unzip_file(self) -> None:
         """
         This function creates a new directory in the root, with the same name as the ZIP file
         containing all the DICOM files. Then unzips the ZIP file into this newly created
-        directory
+        directory. \n
+        If the class was instantiated with `stream_zip=True`, nothing is extracted,
+        since the files will be read straight out of the ZIP file.
 
         Parameters:
         -----------
@@ -45,17 +163,21 @@ class Reorder:
         --------
 
         """
+        if self.stream_zip:
+            logger.info("files will be streamed from the ZIP file!")
+            return
+
         self.make_directory(self.dicom_directory)
 
         try:
-            with zipfile.ZipFile(f"{self.root_path}/{self.dicom_directory}.zip", "r") as zip_ref:
+            with metrics.METRICS.timer("extract"), zipfile.ZipFile(f"{self.root_path}/{self.dicom_directory}.zip", "r") as zip_ref:
                 zip_ref.extractall(self.root_dir_path)
-        except FileNotFoundError:
-            pass
+        except FileNotFoundError:  # Already a directory, there is nothing to extract.
+            return
         except OSError:
             raise OSError("You are running Linux paths on Windows native devices.\nTry copying the files to your computer first.")
 
-        print("\nfiles unzziped!\n")
+        logger.info("files unzipped!")
 
     def make_directory(self, new_dir: str = "default") -> None:
         """
@@ -87,80 +209,320 @@ class Reorder:
             except FileExistsError:
                 pass
 
-    def sort_files(self) -> dict[str, str]:
+    def read_header(self, dcm_file: str, file_object=None, file_size: int | None = None) -> FileRecord:
+        """
+        This function reads only the header of a DICOM file, stopping right
+        before the pixel data, and returns the tags needed for sorting it. \n
+            - Only the tags in `HEADER_TAGS` are parsed, the rest of the
+              header elements are skipped. \n
+            - Big values (bigger than 1 KB) are never loaded into memory, so
+              the bytes read from disk stay small no matter how big the
+              file is.
+
+        Parameters:
+        -----------
+            dcm_file (path): Full path of the DICOM file.
+            file_object: An already opened file (e.g. a member of a ZIP file)
+                         to read instead of `dcm_file`. Then `dcm_file` is only
+                         used as the path of the record.
+            file_size (int): The size of `file_object`.
+
+        Returns:
+        --------
+            record: |FileRecord| The compact record of the DICOM file.
+        """
+        dataset: pydicom.Dataset = pydicom.dcmread(file_object or dcm_file,
+                                                   defer_size="1 KB",
+                                                   stop_before_pixels=True,
+                                                   specific_tags=HEADER_TAGS)
+        return FileRecord(path=dcm_file,
+                          series_time=str(dataset.get("SeriesTime", "")),
+                          series_instance_uid=str(dataset.get("SeriesInstanceUID", "")),
+                          instance_number=optional_int(dataset.get("InstanceNumber")),
+                          file_size=os.path.getsize(dcm_file) if file_object is None else file_size,
+                          study_date=str(dataset.get("StudyDate", "")),
+                          series_number=optional_int(dataset.get("SeriesNumber")),
+                          slice_position=slice_position(dataset))
+
+    def scan_files(self, known_files: dict[str, tuple[int, FileRecord]] | None = None) -> list[FileRecord]:
         """
         This function takes the root of the directory (given when the class is
-        instanciated) looks for all the DICOM files in it, saves it in a
-        dictionary, then sorts the files according to the 'SeriesTime' DICOM
-        tag. \n
-            - If there are multiple directories in the main directory, it uses
-              'os.walk()' to naviate the entire tree. \n
-            - The keys of the created dictionary are the series time of each
-              individual DICOM file. \n
-            - The values of the created dictionary are the full path for every
-              DICOM tag.
+        instanciated), looks for all the DICOM files in it (using 'os.walk()'
+        to navigate the entire tree), and reads the header of each one of them
+        with the `read_header()` function. \n
+        The modification time of every file is kept in `self.index_mtimes`,
+        so the records can be saved in the sidecar file afterwards.
 
         Parameters:
         -----------
+            known_files: |dict| Records from a previous scan:\n
+                         `"key"` --> path of the DICOM file.\n
+                         `"value"` --> (modification time, record).\n
+                         If a file has the same modification time and size
+                         than before, its header is not read again.
 
         Returns:
         --------
-            sorted_time_stamp_dict: |dictionary| This dictionary contains all
-            the DICOM files in a specific directory, even if it has multiple
-            sub-directories inside. The files are sorted according to the
-            'SeriesTime', which are stored as keys in the dictionary. The
-            values correspond to the full path of each given key (DICOM file).
-        """
-        # Create a dictionary with the sorted dicom files:
-        #   key   --> 'SeriesTime' tag of the DICOM file.
-        #   value --> path of the DICOM file.
+            records: |list| A list with one `FileRecord` per file found, in
+                     the same order as they were walked.
+        """
+        known_files = known_files or {}
+        records: list[FileRecord] = []
+        self.index_mtimes = {}
+
+        if self.stream_zip:
+            return self.scan_zip(known_files)
+
         for root, dirs, files in sorted(os.walk(self.root_dir_path)):
             for item in files:
                 dcm_file: str = f"{root}/{item}"
-                dataset: pydicom.Dataset = pydicom.dcmread(dcm_file)
-                self.time_stamp_dict[dataset.data_element("SeriesTime").value] = dcm_file
+                stat: os.stat_result = os.stat(dcm_file)
+                known: tuple[int, FileRecord] | None = known_files.get(dcm_file)
 
-        sorted_time_stamp_dict = {key: value for key, value in sorted(self.time_stamp_dict.items(), key=lambda tuple_item: tuple_item[0])}
-        # -------------------------------
-        # Reasoning behind this last line
-        # -------------------------------
+                if known is not None and known[0] == stat.st_mtime_ns and known[1].file_size == stat.st_size:
+                    records.append(known[1])
+                else:
+                    records.append(self.read_header(dcm_file))
 
-        # # Although you might trust that when you use 'sorted()' the first time,
-        # # it sets everything up for the rest of the code. But it actually is not
-        # # completely sorted the way you need it. If the folders have weird naming,
-        # # then the output might not be the one you are looking for.
-        # # Ex: 'token10' goes before 'token2' --> the #2 needs a leading #0 to
-        # # behave the way you want it. 'token02' goes before 'token10'
+                self.index_mtimes[dcm_file] = stat.st_mtime_ns
 
-        # a = {'d': 6, 'a': 3, 'b': 2, 'e': 4, "2": 1, 't': 5}
+        return records
 
-        # # Create a new list with all items sorted according to
-        # # the 2nd item in the tuple --> values:
-        # sorted(a.items(), key=lambda x: x[1])  # Remember, this is how you define 'lambdas'. It is not a 'dict()' anymore.
+    def scan_zip(self, known_files: dict[str, tuple[int, FileRecord]] | None = None) -> list[FileRecord]:
+        """
+        This function does the same as `scan_files()`, but reading the headers
+        straight out of the ZIP file. Only the beginning of every member is
+        decompressed. \n
+            - The path of every record is the path the file would have had if
+              the ZIP file was extracted (see `member_name()`). \n
+            - The CRC of every member is used instead of the modification time.
 
-        # # Create a new list with all items sorted according to
-        # # the 1st item in the tuple --> keys:
-        # sorted(a.items(), key=lambda x: x[0])  # Remember, this is how you define 'lambdas'. It is not a 'dict()' anymore.
+        Parameters:
+        -----------
+            known_files: |dict| Records from a previous scan (see `scan_files()`).
 
-        # # Same as previous one, since it is the default value:
-        # sorted(a.items())
+        Returns:
+        --------
+            records: |list| A list with one `FileRecord` per file in the ZIP file.
+        """
+        known_files = known_files or {}
+        records: list[FileRecord] = []
+        self.index_mtimes = {}
+
+        with zipfile.ZipFile(self.zip_path, "r") as zip_ref:
+            for info in sorted(zip_ref.infolist(), key=lambda info: info.filename):
+                if info.is_dir():
+                    continue
+
+                dcm_file: str = f"{self.root_dir_path}/{info.filename}"
+                known: tuple[int, FileRecord] | None = known_files.get(dcm_file)
+
+                if known is not None and known[0] == info.CRC and known[1].file_size == info.file_size:
+                    records.append(known[1])
+                else:
+                    with zip_ref.open(info) as member:
+                        records.append(self.read_header(dcm_file, member, info.file_size))
+
+                self.index_mtimes[dcm_file] = info.CRC
+
+        return records
+
+    def member_name(self, dcm_file: str) -> str:
+        """
+        This function turns the path of a record read with `scan_zip()` back
+        into the name of the member inside the ZIP file.
+
+        Parameters:
+        -----------
+            dcm_file (path): The path of the record.
+
+        Returns:
+        --------
+            member: |str| The name of the member inside the ZIP file.
+        """
+        return dcm_file[len(self.root_dir_path) + 1:]
+
+    def directory_signature(self) -> tuple[int, int]:
+        """
+        This function walks the directory tree (without opening any file) and
+        returns a small signature of it, used to know if the study index is
+        still valid.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            signature: |tuple| (number of files, newest modification time of
+                       all the directories in nanoseconds). When streaming
+                       from a ZIP file: (-1, modification time of the ZIP file).
+        """
+        file_count: int = 0
+        newest_mtime: int = 0
+
+        if self.stream_zip:  # The ZIP file itself takes the place of the directory.
+            return -1, os.stat(self.zip_path).st_mtime_ns
+
+        for root, dirs, files in os.walk(self.root_dir_path):
+            file_count += len(files)
+            newest_mtime = max(newest_mtime, os.stat(root).st_mtime_ns)
+
+        return file_count, newest_mtime
+
+    def get_index(self) -> list[FileRecord]:
+        """
+        This function returns the study index of the patient: the records of
+        all the DICOM files in the directory. \n
+            - The index is only built once, and reused while the number of
+              files and the modification time of the directories stay the
+              same. \n
+            - If there is no index in memory, the sidecar file saved by a
+              previous run is used instead. \n
+            - If the directory changed, only the new or modified files are
+              read again.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            study_index: |list| One `FileRecord` per DICOM file.
+        """
+        signature: tuple[int, int] = self.directory_signature()
 
-        # # What is left is to use dictionary comprehension:
-        # {key: value for key,value in sorted(a.items(), key=lambda x: x[1])}
+        if self.study_index is not None and self.index_signature == signature:
+            return self.study_index
 
-        # # Now, no matter how scrambled you data is, or if you do not use 'sorted'
-        # # initially, everything will be sorted correctly ALWAYS.
-        # ---------------------------------------------------------------------
-        return sorted_time_stamp_dict
+        saved_signature, known_files = self.load_index()
+
+        if saved_signature == signature:
+            self.study_index = [record for mtime, record in known_files.values()]
+            self.index_mtimes = {path: mtime for path, (mtime, record) in known_files.items()}
+        else:
+            with metrics.METRICS.timer("index"):
+                self.study_index = self.scan_files(known_files)
+                self.save_index(signature)
+
+        self.index_signature = signature
+
+        return self.study_index
+
+    def load_index(self) -> tuple[tuple[int, int] | None, dict[str, tuple[int, FileRecord]]]:
+        """
+        This function loads the sidecar file of the study index, if there is one.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            signature: |tuple| The directory signature when the index was saved
+                       (None if there is no valid sidecar file).
+            known_files: |dict| The saved records:\n
+                         `"key"` --> path of the DICOM file.\n
+                         `"value"` --> (modification time, record).
+        """
+        try:
+            with open(self.index_path, "r") as index_file:
+                saved: dict = json.load(index_file)
+
+            known_files: dict[str, tuple[int, FileRecord]] = {item[0]: (item[1], FileRecord(item[0], *item[2:]))
+                                                              for item in saved["files"]}
+            return tuple(saved["signature"]), known_files
+        except (OSError, ValueError, KeyError, TypeError):
+            # No sidecar yet, or a broken one (e.g. the run was killed while saving it).
+            return None, {}
+
+    def save_index(self, signature: tuple[int, int]) -> None:
+        """
+        This function saves the study index into a small JSON sidecar file,
+        next to the DICOM directory. It is first written into a temporary file
+        and then renamed, so an interrupted run never leaves a half-written index.
+
+        Parameters:
+        -----------
+            signature: |tuple| The directory signature of the index.
+
+        Returns:
+        --------
+
+        """
+        saved: dict = {"signature": list(signature),
+                       "files": [[record.path, self.index_mtimes.get(record.path, 0), *record[1:]]
+                                 for record in self.study_index]}
+
+        try:
+            with open(f"{self.index_path}.tmp", "w") as index_file:
+                json.dump(saved, index_file)
+            os.replace(f"{self.index_path}.tmp", self.index_path)
+        except OSError:
+            # The index is only a speed-up, a read-only drive should not stop the run.
+            pass
+
+    def clear_index(self) -> None:
+        """
+        This function forgets the study index, and removes its sidecar file.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+
+        """
+        self.study_index = None
+        self.index_signature = None
+        self.index_mtimes = {}
+
+        try:
+            os.remove(self.index_path)
+        except FileNotFoundError:
+            pass
+
+    def sort_files(self) -> list[FileRecord]:
+        """
+        This function takes the root of the directory (given when the class is
+        instanciated) looks for all the DICOM files in it, and sorts them by
+        (StudyDate, SeriesTime, SeriesNumber, SeriesInstanceUID, InstanceNumber,
+        slice position, path) (see `sort_key()`). \n
+            - The files come from the study index (see `get_index()`), so
+              the headers are only read once, no matter how many times this
+              function is called. \n
+            - Every file is kept, even if all the slices of a series share the
+              same 'SeriesTime'. \n
+            - Big studies (`LEXSORT_MIN_FILES` files or more) are sorted with
+              'numpy.lexsort()' over one array per key, if NumPy is installed.
+              The order is the same either way.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            sorted_records: |list| The `FileRecord` of every DICOM file in the
+            directory, even if it has multiple sub-directories inside, in the
+            order of the study.
+        """
+        records: list[FileRecord] = self.get_index()
+
+        if numpy is None or len(records) < LEXSORT_MIN_FILES:
+            return sorted(records, key=sort_key)
+
+        # 'lexsort()' takes the keys from the last (least important) to the first one:
+        columns: list = [numpy.array(column) for column in zip(*map(sort_key, records))]
+        order = numpy.lexsort(columns[::-1])
+
+        return [records[position] for position in order]
 
     def check_files_order(self) -> None:
         """
         This function first calls the `sort_files()` function, saves the sorted
-        dictionary into a variable, to finally output all the sorted files in
+        records into a variable, to finally output all the sorted files in
         a more readable way:
-            1.- The index of the current DICOM file inside the dictionary. \n
+            1.- The index of the current DICOM file in the sorted study. \n
             2.- The `SeriesTime` time stamp of the given DICOM file. \n
-            3.- The full path of the given DICOM file. \n
+            3.- Its `SeriesNumber` and `InstanceNumber`. \n
+            4.- The full path of the given DICOM file. \n
 
         Parameters:
         -----------
@@ -169,16 +531,20 @@ class Reorder:
         --------
 
         """
-        sorted_time_stamp_dict: dict[str, str] = self.sort_files()
+        sorted_records: list[FileRecord] = self.sort_files()
+
+        if not logger.isEnabledFor(logging.DEBUG):  # Nothing would be shown, so the loop is skipped.
+            return
         # ---------------------- This is for sanity check: ----------------------
-        for counter, item in enumerate(sorted_time_stamp_dict.items()):
-            print(f"index: {counter} | time_stamp: {item[0]} | root: {item[1]}")
+        for counter, record in enumerate(sorted_records):
+            logger.debug("index: %d | time_stamp: %s | series: %s | instance: %s | root: %s",
+                         counter, record.series_time, record.series_number, record.instance_number, record.path)
 
-    def rename_files(self) -> None:
+    def rename_files(self, committer=None) -> None:
         """
         This function first calls the `sort_files()` function, saves the sorted
-        dictionary into a variable, and then uses the values for as a starting
-        point for renaming each file. \n
+        records into a variable, and then uses them as a starting point for
+        renaming each file. \n
             - The original name of the file comes from the original path of the file. \n
             - The new name comes from \n
                 > The root of the outer most directory, plus \n
@@ -186,41 +552,81 @@ class Reorder:
                   is also the name given to the newly created directory by the
                   `make_directory()` function, plus \n
                 > An integer series starting at '000', which are the names of all the
-                  sorted DICOM files.
+                  sorted DICOM files (with more digits if the study has more than
+                  1000 files, see `number_width()`). \n
+            - With a `committer`, the files are moved into its staging directory
+              first, and the whole directory is published at once at the end.
 
         Parameters:
         -----------
+            committer: |committer.Committer| Optional, publishes all the files at once.
 
         Returns:
         --------
 
         """
-        def make_number_tag(counter: int) -> str:
-            if len(str(counter)) == 1:
-                tag: str = f"00{counter}"
-            elif len(str(counter)) == 2:
-                tag: str = f"0{counter}"
-            else:
-                tag: str = f"{counter}"
+        sorted_records: list[FileRecord] = self.sort_files()
+        width: int = self.number_width(len(sorted_records))
 
-            return tag
-
-        def make_special_renames(dicom_data: tuple[str, str], tag: str) -> None:
-            if "TEST1" in dicom_data[1]:
-                os.rename(f"{dicom_data[1]}", f"{self.root_path}/{self.anonymized_tag}/{tag}_t1.dcm")
-            elif "TEST2" in dicom_data[1]:
-                os.rename(f"{dicom_data[1]}", f"{self.root_path}/{self.anonymized_tag}/{tag}_t2.dcm")
-            else:
-                os.rename(f"{dicom_data[1]}", f"{self.root_path}/{self.anonymized_tag}/{tag}.dcm")
-
-        sorted_time_stamp_dict: dict[str, str] = self.sort_files()
+        if committer is not None:
+            committer.prepare()
 
         # -----------------------------------------------------------------------------------------------
         # Get the files out of the original directories, and add them to the newly created directory:
-        for counter, dicom in enumerate(sorted_time_stamp_dict.items()):
-            tag = make_number_tag(counter)
+        for counter, record in enumerate(sorted_records):
+            target: str = self.target_path(record.path, counter, width)
+            os.rename(record.path, target if committer is None else committer.staging_target(target))
+
+        if committer is not None:
+            committer.publish()
+
+    def number_width(self, file_count: int) -> int:
+        """
+        Returns how many digits the names of a study with `file_count` files
+        need (at least 3), so the names still sort in the same order as the files.
+        """
+        return max(3, len(str(file_count - 1)))
+
+    def make_number_tag(self, counter: int, width: int = 3) -> str:
+        """
+        This function turns the position of a file in the sorted study into
+        its new name: an integer series starting at '000'.
+
+        Parameters:
+        -----------
+            counter (int): The position of the file in the sorted study.
+            width (int): The number of digits of the name (see `number_width()`).
+
+        Returns:
+        --------
+            tag: |str| The number with leading zeros.
+        """
+        return f"{counter:0{width}d}"
 
-            make_special_renames(dicom, tag)
+    def target_path(self, dcm_file: str, counter: int, width: int = 3) -> str:
+        """
+        This function returns the final path of a DICOM file, inside the
+        directory of the anonymized tag. Files coming from a 'TEST1' or
+        'TEST2' directory keep a '_t1' or '_t2' suffix.
+
+        Parameters:
+        -----------
+            dcm_file (path): The original path of the DICOM file.
+            counter (int): The position of the file in the sorted study.
+            width (int): The number of digits of the name (see `number_width()`).
+
+        Returns:
+        --------
+            target: |str| The new path of the DICOM file.
+        """
+        tag: str = self.make_number_tag(counter, width)
+
+        if "TEST1" in dcm_file:
+            return f"{self.root_path}/{self.anonymized_tag}/{tag}_t1.dcm"
+        elif "TEST2" in dcm_file:
+            return f"{self.root_path}/{self.anonymized_tag}/{tag}_t2.dcm"
+        else:
+            return f"{self.root_path}/{self.anonymized_tag}/{tag}.dcm"
 
 
 # %%
@@ -0,0 +1,557 @@
+# %%
+import io
+import os
+import mmap
+import struct
+import pydicom
+from typing import Callable
+from pydicom.datadict import dictionary_VR
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import read_dataset
+from pydicom.filewriter import write_dataset
+
+# Explicit VR elements with these VRs use a 4 bytes length field (after 2 reserved bytes):
+LONG_LENGTH_VRS: set[str] = {"OB", "OD", "OF", "OL", "OV", "OW", "SQ", "SV", "UC", "UN", "UR", "UT", "UV"}
+# Only string values can be patched, everything else goes through the full rewrite:
+STRING_VRS: set[str] = {"AE", "AS", "CS", "DA", "DS", "DT", "IS", "LO", "LT", "PN", "SH", "ST", "TM", "UC", "UI", "UR", "UT"}
+UNDEFINED_LENGTH: int = 0xFFFFFFFF
+# The File Meta Information always starts with its group length, right after the preamble and 'DICM':
+META_START: int = 132
+GROUP_LENGTH_HEADER: bytes = b"\x02\x00\x00\x00UL\x04\x00"
+# The fragments of encapsulated pixel data are items, ended by a sequence delimiter:
+ITEM_TAG: int = 0xFFFEE000
+SEQUENCE_DELIMITER_TAG: int = 0xFFFEE0DD
+
+
+class Patcher:
+    """
+    This program changes the values of a few DICOM tags straight in the bytes
+    of the file, without decoding and encoding the whole dataset again (and
+    specially, without touching the pixel data).
+    \nThe header is parsed once (stopping before the pixel data) to find where
+    the value of each tag starts, and how long it is:\n
+        - If the new value fits in the old one, it is padded to the same length
+          and written over the old bytes (through `mmap` when patching in place).\n
+        - Otherwise, only the header is rewritten (with the new lengths), and
+          the rest of the file is copied by the kernel (`os.copy_file_range`).
+          Removed tags (e.g. the private ones) are simply cut out of it.\n
+        - Files that cannot be patched safely (big endian, deflated, new values
+          for tags inside undefined lengths, non-string values, elements after
+          the pixel data...) are left to the full rewrite, which can also keep
+          the pixel data out of memory (see `stream()`).
+    """
+
+    def __init__(self, chunk_size: int = 16 * 1024 * 1024) -> None:
+        self.chunk_size: int = chunk_size
+
+    def __dir__(self) -> None:
+        return ["locate", "pixel_data_end", "encode", "plan", "patch", "patch_bytes", "rewrite_header", "stream",
+                "write_trailing", "copy_rest"]
+
+    def locate(self, dataset: pydicom.FileDataset, tags: set[int],
+               end: int) -> dict[int, tuple[int, int, int, int, int, str]] | None:
+        """
+        This function finds where each tag in `tags` (and every private tag) is
+        stored inside the file. It has to be called before accessing any of the
+        tags, since pydicom forgets the offsets once the values are decoded.
+
+        Parameters:
+        -----------
+            dataset: |pydicom.FileDataset| The dataset read from the file, still
+                     not decoded.
+            tags: |set| The tags to look for.
+            end (int): Where pydicom stopped reading the dataset (the start of
+                       the pixel data, or the end of the file).
+
+        Returns:
+        --------
+            offsets: |dict| `"key"` --> tag.\n
+                     `"value"` --> (element offset, element end, value offset,
+                     value length, size of the length field, VR).\n
+                     Missing tags are not included. The tags of the File Meta
+                     Information (group 0002) are looked for too. It returns
+                     None if the file cannot be patched.
+        """
+        transfer_syntax = dataset.file_meta.get("TransferSyntaxUID")
+
+        if transfer_syntax is None or transfer_syntax.is_deflated or not transfer_syntax.is_little_endian:
+            return None
+
+        offsets: dict[int, tuple[int, int, int, int, int, str]] = {}
+        # (element offset, tag, value offset, value length, VR) of every element of the dataset:
+        elements: list[tuple[int, int, int, int, str]] = []
+
+        for tag in dataset.keys():
+            item = dataset.get_item(tag)
+            # A few elements (e.g. the sequences of undefined length) are decoded while reading, the rest stays raw:
+            value_tell: int | None = getattr(item, "value_tell", getattr(item, "file_tell", None))
+
+            if value_tell is None:
+                return None
+
+            vr: str | None = item.VR
+
+            if vr is None:  # Implicit VR.
+                try:
+                    vr = dictionary_VR(tag)
+                except KeyError:  # Unknown private tag.
+                    vr = "UN"
+
+            # The decoded elements do not keep their length, only the next element tells where they end:
+            length: int = getattr(item, "length", UNDEFINED_LENGTH)
+            header_size: int = 12 if not transfer_syntax.is_implicit_VR and vr in LONG_LENGTH_VRS else 8
+            elements.append((value_tell - header_size, tag, value_tell, length, vr))
+
+        elements.sort()
+
+        # Each element ends where the next one starts (so even the sequences of undefined length can be cut out):
+        for index, (offset, tag, value_tell, length, vr) in enumerate(elements):
+            element_end: int = elements[index + 1][0] if index + 1 < len(elements) else end
+
+            if length != UNDEFINED_LENGTH and value_tell + length != element_end:
+                return None  # The elements are not where they should be.
+            if tag in tags or tag.is_private:
+                length_size: int = 4 if transfer_syntax.is_implicit_VR or vr in LONG_LENGTH_VRS else 2
+                offsets[tag] = (offset, element_end, value_tell, length, length_size, vr)
+
+        # The File Meta Information is always explicit VR:
+        for tag in dataset.file_meta.keys() & tags:
+            raw = dataset.file_meta.get_item(tag)
+
+            if not hasattr(raw, "value_tell"):
+                return None
+
+            length_size: int = 4 if raw.VR in LONG_LENGTH_VRS else 2
+            offsets[tag] = (raw.value_tell - (12 if length_size == 4 else 8), raw.value_tell + raw.length,
+                            raw.value_tell, raw.length, length_size, raw.VR)
+
+        return offsets
+
+    def pixel_data_end(self, file_object, position: int, transfer_syntax: pydicom.uid.UID) -> int | None:
+        """
+        This function finds where the pixel data element ends, only reading
+        the headers of the element (and of its fragments, if encapsulated).
+
+        Parameters:
+        -----------
+            file_object (file): The DICOM file, opened for reading.
+            position (int): Where the pixel data element starts (or the end of
+                            the file, if there is no pixel data).
+            transfer_syntax: |pydicom.uid.UID| The transfer syntax of the file.
+
+        Returns:
+        --------
+            end (int): The offset right after the pixel data element. Anything
+                       between it and the end of the file (e.g. trailing private
+                       tags or padding) has to be anonymized too. It returns None
+                       if the element is broken.
+        """
+        byte_order: str = "<" if transfer_syntax.is_little_endian else ">"
+        file_object.seek(position)
+        header: bytes = file_object.read(8)
+
+        if not header:  # No pixel data.
+            return position
+        if len(header) < 8:
+            return None
+
+        if transfer_syntax.is_implicit_VR:
+            length: int = struct.unpack(f"{byte_order}L", header[4:])[0]
+            position += 8
+        else:  # The VR of the pixel data (OB, OW, OF, OD) always has a 4 bytes length field:
+            length_field: bytes = file_object.read(4)
+            if len(length_field) < 4:
+                return None
+            length = struct.unpack(f"{byte_order}L", length_field)[0]
+            position += 12
+
+        if length != UNDEFINED_LENGTH:
+            return position + length
+
+        # Encapsulated: skip the fragments (items) until the sequence delimiter.
+        while True:
+            file_object.seek(position)
+            item: bytes = file_object.read(8)
+
+            if len(item) < 8:
+                return None
+
+            group, element, length = struct.unpack(f"{byte_order}HHL", item)
+            position += 8
+
+            if (group << 16 | element) == SEQUENCE_DELIMITER_TAG:
+                return position
+            if (group << 16 | element) != ITEM_TAG or length == UNDEFINED_LENGTH:
+                return None
+
+            position += length
+
+    def encode(self, value: str, vr: str, length: int) -> bytes | None:
+        """
+        This function encodes a new value, padding it to an even length (and
+        to `length`, if it is shorter).
+
+        Parameters:
+        -----------
+            value (str): The new value.
+            vr (str): The VR of the tag.
+            length (int): The length of the old value.
+
+        Returns:
+        --------
+            encoded: |bytes| The encoded value, or None if it is not plain ASCII
+                     (the character set of the file would be needed).
+        """
+        try:
+            encoded: bytes = str(value).encode("ascii")
+        except UnicodeEncodeError:
+            return None
+
+        padding: bytes = b"\0" if vr == "UI" else b" "
+
+        if len(encoded) < length:
+            encoded += padding * (length - len(encoded))
+        if len(encoded) % 2:
+            encoded += padding
+
+        return encoded
+
+    def plan(self, file_object, replacements_for: Callable[[pydicom.FileDataset], dict[int, str | None]],
+             tags: set[int]) -> list[tuple[int, int, bytes]] | None:
+        """
+        This function parses the header of a DICOM file (stopping before the
+        pixel data) and builds the bytes that have to be changed.
+
+        Parameters:
+        -----------
+            file_object (file): The DICOM file, opened for reading.
+            replacements_for: |function| See `patch()`.
+            tags: |set| Every tag that `replacements_for` might change.
+
+        Returns:
+        --------
+            patches: |list| (offset of the length field, old length + length
+                     field size, new length field + new value), sorted by
+                     offset (or (offset of the element, size of the element,
+                     nothing) for the removed tags). It returns None if the
+                     file cannot be patched.
+        """
+        file_object.seek(0)
+        dataset: pydicom.FileDataset = pydicom.dcmread(file_object, defer_size="1 KB", stop_before_pixels=True)
+        # pydicom stops right at the start of the pixel data element (or at the end of the file):
+        position: int = file_object.tell()
+        offsets: dict[int, tuple[int, int, int, int, int, str]] | None = self.locate(dataset, tags, position)
+
+        if offsets is None:
+            return None
+
+        # The elements after the pixel data are not parsed here, so they cannot be anonymized:
+        pixel_data_end: int | None = self.pixel_data_end(file_object, position, dataset.file_meta.TransferSyntaxUID)
+        file_object.seek(0, os.SEEK_END)
+
+        if pixel_data_end != file_object.tell():
+            return None
+
+        patches: list[tuple[int, int, bytes]] = []
+        meta_growth: int = 0
+
+        replacements: dict[int, str | None] | None = replacements_for(dataset)
+
+        if replacements is None:
+            return None
+
+        for tag, value in replacements.items():
+            if tag not in offsets:
+                return None
+
+            offset, element_end, value_tell, length, length_size, vr = offsets[tag]
+
+            if value is None:  # The whole element is cut out of the file.
+                patches.append((offset, element_end - offset, b""))
+                if tag >> 16 == 0x0002:
+                    meta_growth -= element_end - offset
+                continue
+
+            if vr not in STRING_VRS or length == UNDEFINED_LENGTH:
+                return None
+
+            encoded: bytes | None = self.encode(value, vr, length)
+
+            if encoded is None or (length_size == 2 and len(encoded) > 0xFFFF):
+                return None
+
+            length_field: bytes = struct.pack("<H" if length_size == 2 else "<L", len(encoded))
+            patches.append((value_tell - length_size, length_size + length, length_field + encoded))
+
+            if tag >> 16 == 0x0002:
+                meta_growth += len(encoded) - length
+
+        # If the File Meta Information changes its length, so does its group length:
+        if meta_growth:
+            group_length: int | None = dataset.file_meta.get("FileMetaInformationGroupLength")
+            file_object.seek(META_START)
+
+            if group_length is None or file_object.read(len(GROUP_LENGTH_HEADER)) != GROUP_LENGTH_HEADER:
+                return None
+
+            patches.append((META_START + len(GROUP_LENGTH_HEADER), 4, struct.pack("<L", group_length + meta_growth)))
+
+        return sorted(patches)
+
+    def patch(self, source, replacements_for: Callable[[pydicom.FileDataset], dict[int, str | None]],
+              tags: set[int], target: str | None = None) -> bool:
+        """
+        This function changes the tags of a DICOM file straight in its bytes.
+
+        Parameters:
+        -----------
+            source (path or file): The DICOM file to patch. If it is an already
+                                   opened file, a `target` is needed.
+            replacements_for: |function| Receives the dataset (header only), and
+                              returns the new values:\n
+                              `"key"` --> tag.\n
+                              `"value"` --> the new value (None to remove
+                              the tag).\n
+                              It returns None itself if the file cannot be
+                              patched (e.g. there are changes inside sequences).
+            tags: |set| Every tag that `replacements_for` might change.
+            target (path): Where to write the patched file. If not given, the
+                           file is patched in place.
+
+        Returns:
+        --------
+            patched: |bool| True if the file was patched, False if it has to go
+                     through the full rewrite instead (nothing was written).
+        """
+        in_place: bool = target is None or (isinstance(source, str) and os.path.abspath(source) == os.path.abspath(target))
+        file_object = open(source, "r+b" if in_place else "rb") if isinstance(source, str) else source
+
+        try:
+            patches: list[tuple[int, int, bytes]] | None = self.plan(file_object, replacements_for, tags)
+
+            if patches is None:
+                return False
+
+            fits: bool = all(len(new_bytes) == old_size for offset, old_size, new_bytes in patches)
+
+            if in_place and fits:
+                if patches:
+                    with mmap.mmap(file_object.fileno(), 0) as mapped:
+                        for offset, old_size, new_bytes in patches:
+                            mapped[offset:offset + old_size] = new_bytes
+                        mapped.flush()
+                return True
+
+            self.rewrite_header(file_object, patches, target or source, kernel_copy=isinstance(source, str))
+        finally:
+            if isinstance(source, str):
+                file_object.close()
+
+        return True
+
+    def patch_bytes(self, data: bytes, replacements_for: Callable[[pydicom.FileDataset], dict[int, str | None]],
+                    tags: set[int]) -> bytes | None:
+        """
+        This function does the same as `patch()`, but for a DICOM file that is
+        already in memory (e.g. a member read out of a ZIP file).
+
+        Parameters:
+        -----------
+            data (bytes): The content of the DICOM file.
+            replacements_for: |function| See `patch()`.
+            tags: |set| Every tag that `replacements_for` might change.
+
+        Returns:
+        --------
+            patched: |bytes| The content of the patched file, or None if it has
+                     to go through the full rewrite instead.
+        """
+        patches: list[tuple[int, int, bytes]] | None = self.plan(io.BytesIO(data), replacements_for, tags)
+
+        if patches is None:
+            return None
+
+        view: memoryview = memoryview(data)
+        pieces: list = []
+        position: int = 0
+
+        for offset, old_size, new_bytes in patches:
+            pieces.append(view[position:offset])
+            pieces.append(new_bytes)
+            position = offset + old_size
+
+        pieces.append(view[position:])
+
+        return b"".join(pieces)
+
+    def rewrite_header(self, file_object, patches: list[tuple[int, int, bytes]], target: str, kernel_copy: bool = True) -> None:
+        """
+        This function writes a new file with the patched header, and copies
+        the rest of the original file after it, without reading it into Python
+        when both files are real files.
+
+        Parameters:
+        -----------
+            file_object (file): The original file, opened for reading.
+            patches: |list| (offset, old size, new bytes), sorted by offset.
+            target (path): Where to write the new file. When it is the same as
+                           the original file, a temporary file is renamed over it.
+            kernel_copy (bool): Use `os.copy_file_range` for the rest of the file.
+                                Only for real files (e.g. a spooled ZIP member
+                                would be written to disk just to get its `fileno()`).
+
+        Returns:
+        --------
+
+        """
+        temporary: str = f"{target}.patching"
+        position: int = 0
+
+        with open(temporary, "wb") as output:
+            for offset, old_size, new_bytes in patches:
+                file_object.seek(position)
+                output.write(file_object.read(offset - position))
+                output.write(new_bytes)
+                position = offset + old_size
+
+            self.copy_rest(file_object, output, position, kernel_copy)
+
+        os.replace(temporary, target)
+
+    def stream(self, file_object, anonymize: Callable[[pydicom.FileDataset], pydicom.FileDataset], target,
+               kernel_copy: bool = True) -> bool:
+        """
+        This function rewrites a DICOM file (for the changes `patch()` cannot
+        do), but keeping its pixel data out of memory: only the header is
+        parsed and written again, and the pixel data is copied in chunks of
+        `chunk_size` bytes. So the memory needed does not depend on the size
+        of the file (e.g. multi-frame or whole-slide images). The elements
+        after the pixel data (e.g. trailing private tags) are anonymized along
+        with the header, and written again after the pixel data.
+
+        Parameters:
+        -----------
+            file_object (file): The DICOM file, opened for reading.
+            anonymize: |function| Receives the dataset (header only), and
+                       returns it anonymized (e.g. `Eraser.anonymize_dataset()`).
+            target (path or file): Where to write the new file. A path is
+                                   written through a temporary file, so it
+                                   can be the same as the original file.
+            kernel_copy (bool): See `rewrite_header()`.
+
+        Returns:
+        --------
+            streamed: |bool| True if the file was written, False if it has to
+                      be loaded whole instead (deflated files, broken pixel
+                      data, more than `chunk_size` bytes after the pixel data;
+                      nothing was written).
+        """
+        file_object.seek(0)
+        dataset: pydicom.FileDataset = pydicom.dcmread(file_object, stop_before_pixels=True)
+        # pydicom stops right at the start of the pixel data element (or at the end of the file):
+        position: int = file_object.tell()
+        transfer_syntax = dataset.file_meta.get("TransferSyntaxUID")
+
+        if transfer_syntax is None or transfer_syntax.is_deflated:
+            return False
+
+        end: int | None = self.pixel_data_end(file_object, position, transfer_syntax)
+        file_object.seek(0, os.SEEK_END)
+        file_end: int = file_object.tell()
+
+        if end is None or file_end - end > self.chunk_size:
+            return False
+
+        # The trailing elements go through the same rules as the header (and are written after the pixel data):
+        file_object.seek(end)
+        trailing: pydicom.Dataset = read_dataset(file_object, transfer_syntax.is_implicit_VR,
+                                                 transfer_syntax.is_little_endian, bytelength=file_end - end)
+        trailing_tags: set[int] = set(trailing.keys())
+
+        for tag in trailing_tags:
+            dataset[tag] = trailing.get_item(tag)
+
+        dataset = anonymize(dataset)
+        trailing = pydicom.Dataset()
+
+        for tag in trailing_tags & set(dataset.keys()):
+            trailing[tag] = dataset.get_item(tag)
+            del dataset[tag]
+
+        if not isinstance(target, str):
+            dataset.save_as(target, write_like_original=False)
+            self.copy_rest(file_object, target, position, kernel_copy=False, end=end)
+            self.write_trailing(target, trailing, transfer_syntax, dataset.get("SpecificCharacterSet", "iso8859"))
+            return True
+
+        temporary: str = f"{target}.streaming"
+
+        with open(temporary, "wb") as output:
+            dataset.save_as(output, write_like_original=False)
+            self.copy_rest(file_object, output, position, kernel_copy, end)
+            self.write_trailing(output, trailing, transfer_syntax, dataset.get("SpecificCharacterSet", "iso8859"))
+
+        os.replace(temporary, target)
+
+        return True
+
+    def write_trailing(self, output, trailing: pydicom.Dataset, transfer_syntax: pydicom.uid.UID,
+                       character_set) -> None:
+        """
+        Writes the (already anonymized) elements that follow the pixel data at
+        the end of `output`, with the same encoding as the rest of the file.
+        """
+        if not len(trailing):
+            return
+
+        encoded: DicomBytesIO = DicomBytesIO()
+        encoded.is_little_endian = transfer_syntax.is_little_endian
+        encoded.is_implicit_VR = transfer_syntax.is_implicit_VR
+        write_dataset(encoded, trailing, character_set)
+
+        output.seek(0, os.SEEK_END)
+        output.write(encoded.getvalue())
+
+    def copy_rest(self, file_object, output, position: int, kernel_copy: bool = True, end: int | None = None) -> None:
+        """
+        Copies everything from `position` to `end` (the end of `file_object`,
+        if not given) at the end of `output`, in chunks (by the kernel if
+        `kernel_copy`, see `rewrite_header()`).
+        """
+        output.flush()
+
+        if end is None:
+            file_object.seek(0, os.SEEK_END)
+            end = file_object.tell()
+
+        try:
+            # Kernel side copy, the bytes never go through Python:
+            while kernel_copy and position < end:
+                copied: int = os.copy_file_range(file_object.fileno(), output.fileno(),
+                                                 min(end - position, self.chunk_size), position)
+                if copied == 0:
+                    break
+                position += copied
+        except (AttributeError, OSError, ValueError):
+            # No 'copy_file_range()' (not Linux, in-memory files, different file systems on old kernels...)
+            pass
+
+        if position < end:
+            file_object.seek(position)
+            output.seek(0, os.SEEK_END)
+
+            while position < end:
+                chunk: bytes = file_object.read(min(end - position, self.chunk_size))
+                if not chunk:
+                    break
+                output.write(chunk)
+                position += len(chunk)
+
+
+# %%
+if __name__ == "__main__":
+    dcm_file: str = input("What is the path of the DICOM file? ")
+    anonymized_name: str = input("What is the anonymized tag? ")
+
+    print(Patcher().patch(dcm_file, lambda dataset: {0x00100010: anonymized_name}, [0x00100010]))
+    print(pydicom.dcmread(dcm_file, stop_before_pixels=True).PatientName)
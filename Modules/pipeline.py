@@ -0,0 +1,215 @@
+# %%
+import os
+from concurrent.futures import ProcessPoolExecutor
+from Modules import anonymizer
+from Modules import committer
+from Modules import out_of_folder
+from Modules import journal
+from Modules import memory
+from Modules import metrics
+
+logger = metrics.get_logger("pipeline")
+# How many file results are recorded in the journal at once:
+JOURNAL_BATCH: int = 64
+
+
+class Pipeline:
+    """
+    This program joins the `Eraser` and the `Reorder` classes into a single
+    pass over the DICOM files of a patient.
+    \nThe files are first ordered using only their headers (see `Reorder.get_index()`),
+    and then each file is read once, anonymized, and written straight to its final
+    `{anonymized_tag}/NNN.dcm` location. The original files are left untouched, so
+    they can be removed afterwards.
+    \nIf the `Reorder` class streams from a ZIP file, the files are read straight out
+    of it, and only the anonymized files are written to disk.
+    \nThe files are written into the staging directory of the `committer`, which
+    publishes all of them at once when the patient is finished (see
+    `committer.Committer.publish()`).
+    """
+
+    def __init__(self, eraser: anonymizer.Eraser, reorder: out_of_folder.Reorder,
+                 output: committer.Committer | None = None) -> None:
+        self.eraser: anonymizer.Eraser = eraser
+        self.reorder: out_of_folder.Reorder = reorder
+        self.committer: committer.Committer = output or committer.Committer(reorder)
+        self.eraser.fsync_files = self.committer.fsync_policy == "file"
+
+    def __dir__(self) -> None:
+        return ["jobs", "run", "anonymize", "flush"]
+
+    def jobs(self, journal: journal.Journal | None = None) -> list[tuple[str, str]]:
+        """
+        This function sorts the study (creating the staging directory if
+        needed), and decides the final path of every file.
+
+        Parameters:
+        -----------
+            journal: |journal.Journal| If given, the files already anonymized by
+                     a previous (interrupted) run are left out.
+
+        Returns:
+        --------
+            jobs: |list| (original path, final path) of every file still to be
+                  anonymized, in the order of the study.
+        """
+        self.committer.prepare()
+
+        with metrics.METRICS.timer("sort"):
+            sorted_records: list[out_of_folder.FileRecord] = self.reorder.sort_files()
+        width: int = self.reorder.number_width(len(sorted_records))
+        done: set[str] = set() if journal is None else journal.done_files(self.reorder.root_path, self.committer.staging_target)
+        jobs: list[tuple[str, str]] = [(record.path, self.reorder.target_path(record.path, counter, width))
+                                       for counter, record in enumerate(sorted_records)]
+        self.committer.expected = {os.path.basename(target) for dcm_file, target in jobs}
+
+        if done:
+            logger.info("File(s) already anonymized by a previous run: %d", len(done))
+            metrics.METRICS.count("files_skipped", len(done))
+
+        return [job for job in jobs if job[1] not in done]
+
+    def run(self, workers: int = 1, journal: journal.Journal | None = None) -> list[tuple[str, str]]:
+        """
+        This function anonymizes and sorts all the DICOM files of the patient,
+        into the staging directory of the `committer` (see `publish()`). \n
+            - With `workers` bigger than 1, the files are sent to a pool of
+              processes. \n
+            - The target name of every file is decided before sending it, so
+              the numbered output is the same no matter the number of workers. \n
+            - With a `journal`, the files already anonymized by a previous
+              (interrupted) run are skipped, and every result is recorded
+              (once the batch is flushed to the disk, see `committer.Committer.sync()`).
+
+        Parameters:
+        -----------
+            workers (int): Number of processes used to anonymize the files.
+            journal: |journal.Journal| Where to record the progress of the files.
+
+        Returns:
+        --------
+            failures: |list| (original path, error message) for every file that
+                      could not be anonymized, in the same order as the study.
+        """
+        jobs: list[tuple[str, str]] = self.jobs(journal)
+
+        with metrics.METRICS.timer("anonymize"):
+            failures: list[tuple[str, str]] = self.anonymize(jobs, workers, journal)
+
+        metrics.METRICS.count("files_failed", len(failures))
+
+        return failures
+
+    def anonymize(self, jobs: list[tuple[str, str]], workers: int = 1, journal: journal.Journal | None = None) -> list[tuple[str, str]]:
+        """
+        This function anonymizes the files in `jobs` (see `run()`).
+
+        Parameters:
+        -----------
+            jobs: |list| (original path, final path) of every file (see `jobs()`).
+            workers (int): Number of processes used to anonymize the files.
+            journal: |journal.Journal| Where to record the progress of the files.
+
+        Returns:
+        --------
+            failures: |list| (original path, error message) for every file that
+                      could not be anonymized, in the same order as the study.
+        """
+        dcm_files: list[str] = [job[0] for job in jobs]
+        targets: list[str] = [self.committer.staging_target(job[1]) for job in jobs]
+
+        if self.reorder.stream_zip:
+            task = anonymizer.anonymize_member
+            arguments: list[list] = [[self.eraser] * len(dcm_files),
+                                     [self.reorder.zip_path] * len(dcm_files),
+                                     [self.reorder.member_name(dcm_file) for dcm_file in dcm_files],
+                                     targets]
+        else:
+            task = anonymizer.anonymize_file
+            arguments: list[list] = [[self.eraser] * len(dcm_files), dcm_files, targets]
+
+        executor: ProcessPoolExecutor | None = ProcessPoolExecutor(max_workers=workers, initializer=memory.limit_memory,
+                                                                   initargs=(self.eraser.memory_limit,)) if workers > 1 else None
+
+        try:
+            if executor is not None:
+                # 'map()' gives the results back in the same order the files were sent (along
+                # with the metrics recorded by the workers):
+                results = (merge(*item) for item in executor.map(metrics.collect,
+                                                                 [metrics.METRICS.enabled] * len(jobs),
+                                                                 [task] * len(jobs),
+                                                                 *arguments, chunksize=16))
+            else:
+                results = (task(*task_arguments) for task_arguments in zip(*arguments))
+
+            failures: list[tuple[str, str]] = []
+            batch: list[tuple[str, str, str | None]] = []
+
+            for (dcm_file, target), result in zip(jobs, results):
+                if executor is None:
+                    logger.debug("Current file: %s", dcm_file)
+                if result[1] is not None:
+                    failures.append(result)
+
+                batch.append((dcm_file, target, result[1]))
+                if len(batch) == JOURNAL_BATCH:
+                    self.flush(batch, journal)
+                    batch = []
+
+            self.flush(batch, journal)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        logger.info("File(s) anonymized: %d", len(jobs) - len(failures))
+
+        return failures
+
+    def flush(self, batch: list[tuple[str, str, str | None]], journal: journal.Journal | None = None) -> None:
+        """
+        This function flushes a batch of anonymized files to the disk (see
+        `committer.Committer.sync()`), and only then records them in the
+        `journal`, so the journal never points to files that could be lost.
+
+        Parameters:
+        -----------
+            batch: |list| (source, final path, error message or None) of every file.
+            journal: |journal.Journal| Where to record the progress of the files.
+
+        Returns:
+        --------
+
+        """
+        if not batch:
+            return
+
+        self.committer.sync([self.committer.staging_target(target) for source, target, error in batch if error is None])
+
+        if journal is not None:
+            journal.mark_files(self.reorder.root_path, batch)
+
+
+def merge(result: tuple, snapshot: dict | None) -> tuple:
+    """
+    Adds the metrics sent back by a worker to the ones of this process, and
+    returns the result of the worker.
+    """
+    metrics.METRICS.merge(snapshot)
+
+    return result
+
+
+# %%
+if __name__ == "__main__":
+    root_path: str = input("What is the root of the directory? ")
+    dicom_directory: str = input("What is the name of the DICOM directory? ")
+    anonymized_tag: str = input("What is the anonymized tag? ")
+
+    conveyor = Pipeline(anonymizer.Eraser(f"{root_path}/{dicom_directory}", anonymized_tag),
+                        out_of_folder.Reorder(root_path, dicom_directory, anonymized_tag))
+
+    conveyor.reorder.stream_zip = os.path.isfile(conveyor.reorder.zip_path)
+    conveyor.reorder.unzip_file()
+    conveyor.reorder.check_files_order()
+    conveyor.run()
+    conveyor.committer.publish()
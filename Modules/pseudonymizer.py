@@ -0,0 +1,243 @@
+# %%
+import os
+import re
+import hmac
+import time
+import sqlite3
+import hashlib
+from functools import lru_cache
+
+# Tags that get a pseudonym instead of a constant (see 'Eraser'). The UIDs share the
+# same mapping, so a UID referenced from another tag (or another file) gets the same pseudonym.
+PSEUDONYM_TAGS: list[str] = ["PatientID", "AccessionNumber", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID",
+                             "FrameOfReferenceUID", "ReferencedSOPInstanceUID"]
+# Length of the pseudonyms of the identifiers (AccessionNumber is a SH, 16 characters at most):
+ID_LENGTH: int = 16
+# What the pseudonyms look like (see 'Pseudonymizer.derive()'), so they can be told apart from the original values:
+UID_PATTERN: re.Pattern = re.compile(r"2\.25\.(0|[1-9]\d{0,38})\Z")
+ID_PATTERN: re.Pattern = re.compile(rf"[0-9A-F]{{{ID_LENGTH}}}\Z")
+# Environment variable with the secret key, when no key file is given:
+KEY_VARIABLE: str = "ANONYMIZER_PSEUDONYM_KEY"
+
+# (key, store path) --> the pseudonymizer of this process, so its cache and its connection are kept
+# between the files sent to the workers (see 'Pseudonymizer.__reduce__()'):
+REGISTRY: dict[tuple[bytes, str | None], "Pseudonymizer"] = {}
+
+
+class Pseudonymizer:
+    """
+    This program turns identifiers (PatientID, AccessionNumber...) and UIDs into
+    stable pseudonyms: the same value always gets the same pseudonym, in every
+    file, every worker and every run, so the studies of a patient can still
+    be linked together after the anonymization.
+    \nThe pseudonyms are derived with a keyed hash (HMAC-SHA256) of the original
+    value. Without the secret key they cannot be reversed, nor guessed from
+    the original values.\n
+        - An in-memory LRU cache holds the most recent pseudonyms (the UIDs of
+          a study repeat in every one of its files).\n
+        - Optionally, every pseudonym is also kept in a small SQLite mapping
+          store (WAL mode, one connection per process), which is checked first:
+          mappings already there (e.g. made with an older key) are always
+          reused. It also allows the authorized re-identification of a
+          pseudonym (see `original()`). \n
+        - The new mappings are written in a single transaction per file (see
+          `flush()`), not one by one.
+    """
+
+    def __init__(self, key: bytes, store_path: str | None = None, cache_size: int = 65536) -> None:
+        if not key:
+            raise ValueError("The pseudonymization key cannot be empty.")
+
+        self.key: bytes = key
+        self.store_path: str | None = store_path
+        self.cache_size: int = cache_size
+        self.connection: sqlite3.Connection | None = None
+        self.connection_pid: int | None = None
+        # New mappings still to be written into the store: (kind, original, pseudonym).
+        self.pending: list[tuple[str, str, str]] = []
+        self.cached = lru_cache(maxsize=cache_size)(self.lookup)
+
+        REGISTRY[(key, store_path)] = self
+
+        if store_path is not None:
+            self.create_store()
+
+    def __dir__(self) -> None:
+        return ["from_key_file", "create_store", "connect", "derive", "lookup", "pseudonym", "flush", "original", "originals"]
+
+    def __reduce__(self) -> tuple:
+        # Neither the connection nor the cache can be sent to other processes: each one keeps its
+        # own pseudonymizer (see 'shared()'), which every file sent to it reuses.
+        return shared, (self.key, self.store_path, self.cache_size)
+
+    @classmethod
+    def from_key_file(cls, key_path: str | None, store_path: str | None = None) -> "Pseudonymizer":
+        """
+        This function reads the secret key from `key_path` (or from the
+        `KEY_VARIABLE` environment variable, if no file is given).
+
+        Parameters:
+        -----------
+            key_path (path): The file holding the secret key.
+            store_path (path): The SQLite mapping store (optional).
+
+        Returns:
+        --------
+            pseudonymizer: |Pseudonymizer| The pseudonymizer.
+        """
+        if key_path is None:
+            key: bytes = os.environ.get(KEY_VARIABLE, "").encode()
+        else:
+            with open(key_path, "rb") as key_file:
+                key: bytes = key_file.read().strip()
+
+        return cls(key, store_path)
+
+    def create_store(self) -> None:
+        """
+        Creates the mapping store (and its table) if needed. It is done once,
+        before any worker uses the store, since switching a new database to
+        WAL mode fails if another process has it open.
+        """
+        connection: sqlite3.Connection = sqlite3.connect(self.store_path, timeout=60)
+
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS pseudonyms ("
+                                   "kind TEXT, original TEXT, pseudonym TEXT, created REAL, "
+                                   "PRIMARY KEY (kind, original))")
+                connection.execute("CREATE INDEX IF NOT EXISTS pseudonyms_reverse ON pseudonyms (pseudonym)")
+        finally:
+            connection.close()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Opens (only once per process) the mapping store (see `create_store()`).
+        """
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.store_path, timeout=60)
+            self.connection_pid = os.getpid()
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        return self.connection
+
+    def derive(self, kind: str, value: str) -> str:
+        """
+        This function derives the pseudonym of a value (without the cache, nor the store).
+
+        Parameters:
+        -----------
+            kind (str): What the value is ("UI" for every UID, otherwise the
+                        keyword of the tag, e.g. "PatientID").
+            value (str): The original value.
+
+        Returns:
+        --------
+            pseudonym: |str| A valid UID ('2.25.' followed by 128 bits of the
+                       HMAC) for the UIDs, otherwise `ID_LENGTH` hexadecimal characters.
+        """
+        digest: bytes = hmac.new(self.key, f"{kind}\0{value}".encode(), hashlib.sha256).digest()
+
+        if kind == "UI":
+            return f"2.25.{int.from_bytes(digest[:16], 'big')}"
+
+        return digest.hex()[:ID_LENGTH].upper()
+
+    def lookup(self, kind: str, value: str) -> str:
+        """
+        Returns the pseudonym of a value from the store, or derives a new one
+        (see `pseudonym()`, which caches this function).
+        """
+        if self.store_path is None:
+            return self.derive(kind, value)
+
+        row = self.connect().execute("SELECT pseudonym FROM pseudonyms WHERE kind = ? AND original = ?",
+                                     (kind, value)).fetchone()
+
+        if row is not None:
+            return row[0]
+
+        pseudonym: str = self.derive(kind, value)
+        self.pending.append((kind, value, pseudonym))
+
+        return pseudonym
+
+    def pseudonym(self, kind: str, value: str) -> str:
+        """
+        This function returns the pseudonym of a value.
+
+        Parameters:
+        -----------
+            kind (str): What the value is (see `derive()`).
+            value (str): The original value.
+
+        Returns:
+        --------
+            pseudonym: |str| The pseudonym.
+        """
+        return self.cached(kind, value.strip(" \0"))
+
+    def flush(self) -> None:
+        """
+        This function writes the new mappings into the store, in a single
+        transaction. If several processes wrote the same mapping, only the
+        first one is kept (they are the same anyway, unless the key changed).
+        """
+        if not self.pending:
+            return
+
+        with self.connect() as connection:
+            connection.executemany("INSERT OR IGNORE INTO pseudonyms VALUES (?, ?, ?, ?)",
+                                   [(kind, original, pseudonym, time.time()) for kind, original, pseudonym in self.pending])
+        self.pending = []
+
+    def original(self, pseudonym: str) -> list[tuple[str, str]]:
+        """
+        This function looks a pseudonym up in the store (authorized
+        re-identification).
+
+        Parameters:
+        -----------
+            pseudonym (str): The pseudonym.
+
+        Returns:
+        --------
+            originals: |list| (kind, original value) of every match.
+        """
+        return self.connect().execute("SELECT kind, original FROM pseudonyms WHERE pseudonym = ?", (pseudonym,)).fetchall()
+
+    def originals(self) -> set[str]:
+        """
+        Returns every original value in the store (none of them should be
+        left in the anonymized files, see `verifier.Verifier`).
+        """
+        return {original for original, in self.connect().execute("SELECT original FROM pseudonyms")}
+
+
+def shared(key: bytes, store_path: str | None = None, cache_size: int = 65536) -> Pseudonymizer:
+    """
+    Returns the pseudonymizer of this process for `key` and `store_path`,
+    making it only the first time.
+    """
+    registered: Pseudonymizer | None = REGISTRY.get((key, store_path))
+
+    return registered if registered is not None else Pseudonymizer(key, store_path, cache_size)
+
+
+def is_pseudonym(kind: str, value: str) -> bool:
+    """
+    Tells if a value looks like a pseudonym of the given kind (see
+    `Pseudonymizer.derive()`), without the key: a UID under '2.25.' for the
+    UIDs, `ID_LENGTH` hexadecimal characters otherwise.
+    """
+    return (UID_PATTERN if kind == "UI" else ID_PATTERN).match(value.strip(" \0")) is not None
+
+
+# %%
+if __name__ == "__main__":
+    store_path: str = input("What is the path of the mapping store? ")
+    pseudonym: str = input("What is the pseudonym to look up? ")
+
+    for kind, original in Pseudonymizer(b"lookup only", store_path).original(pseudonym):
+        print(f"kind: {kind} | original: {original}")
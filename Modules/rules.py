@@ -0,0 +1,357 @@
+# %%
+import os
+import json
+import hashlib
+import datetime
+import pydicom
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+from pydicom.tag import BaseTag
+
+# What can be done with the value of a tag:
+#   replace    --> the value is replaced by the one given in the rule.
+#   blank      --> the value is emptied (the tag is kept).
+#   hash       --> the value is replaced by a hash of the original one (same input, same output).
+#   date_shift --> the date is moved by `date_shift_days` days.
+#   remove     --> the tag is deleted from the dataset.
+#   pseudonym  --> the value is replaced by its keyed pseudonym (see 'pseudonymizer.Pseudonymizer').
+ACTIONS: set[str] = {"replace", "blank", "hash", "date_shift", "remove", "pseudonym"}
+# What can be done with the private (vendor) tags (they are removed unless kept on purpose,
+# since vendors often copy names and IDs into them):
+PRIVATE_ACTIONS: set[str] = {"keep", "remove"}
+# Environment variable with the salt of the 'hash' action, when the profile does not set one:
+SALT_VARIABLE: str = "ANONYMIZER_HASH_SALT"
+PIXEL_DATA: BaseTag = BaseTag(0x7FE00010)
+# Every item of a sequence starts with the (FFFE,E000) tag (in little endian):
+ITEM_TAG: bytes = b"\xfe\xff\x00\xe0"
+
+
+class RuleSet:
+    """
+    This program compiles the anonymization rules (keyword --> action) once,
+    into a dictionary keyed by the `BaseTag` integers of the tags. Then,
+    anonymizing a dataset is a single pass over the tags both in the rules and
+    in the dataset, no matter if there are 8 or a few hundred rules.
+    \nWith `recursive=True`, the same rules are applied inside every item of every
+    sequence (e.g. a 'PatientName' inside 'ReferencedPatientSequence'), walking the
+    tree with a stack instead of recursion. The pixel data is never touched.
+    \nThe rules can be given as a dictionary, or loaded from a JSON profile:\n
+     -------------------------------------------------------------------------\n
+        {
+            "name": "Basic Profile",
+            "date_shift_days": -30,
+            "hash_salt": "secret",
+            "recursive": true,
+            "private_tags": "remove",
+            "rules": {"PatientName": {"action": "replace", "value": "Patient"},
+                      "PatientBirthDate": {"action": "blank"}}
+        }
+     -------------------------------------------------------------------------
+    \nA 'hash' rule needs a secret salt (without it, the hashes of the UIDs could be
+    found by hashing guessed values), and a 'date_shift' rule a shift of at least a day.
+    """
+
+    def __init__(self, rules: dict[str, dict], date_shift_days: int = 0, hash_salt: str = "", name: str = "custom",
+                 recursive: bool = True, private_tags: str = "remove") -> None:
+        if private_tags not in PRIVATE_ACTIONS:
+            raise ValueError(f"'{private_tags}' is not a valid action for the private tags. Use one of: {sorted(PRIVATE_ACTIONS)}")
+
+        self.name: str = name
+        self.date_shift_days: int = date_shift_days
+        self.hash_salt: str = hash_salt
+        self.recursive: bool = recursive
+        self.private_tags: str = private_tags
+        # key --> tag, value --> (keyword, action, value)
+        self.compiled: dict[BaseTag, tuple[str, str, str]] = {}
+        # How many tags were changed by the last 'apply()':
+        self.changed: int = 0
+        # Needed by the 'pseudonym' action (see 'pseudonymizer.Pseudonymizer'):
+        self.pseudonymizer = None
+
+        for keyword, rule in rules.items():
+            self.add(keyword, rule.get("action", "replace"), rule.get("value", ""))
+
+    def __dir__(self) -> None:
+        return ["from_values", "from_file", "add", "walk", "changes", "has_nested_changes", "apply"]
+
+    @classmethod
+    def from_values(cls, data_elements: dict[str, str]) -> "RuleSet":
+        """
+        This function builds a rule set where every tag is replaced by the
+        given value (the same format as `Eraser.data_elements`).
+
+        Parameters:
+        -----------
+            data_elements: |dict| `"key"` --> keyword of the tag.\n
+                           `"value"` --> the new value.
+
+        Returns:
+        --------
+            rule_set: |RuleSet| The compiled rules.
+        """
+        return cls({keyword: {"action": "replace", "value": value} for keyword, value in data_elements.items()})
+
+    @classmethod
+    def from_file(cls, profile_path: str) -> "RuleSet":
+        """
+        This function loads and compiles a JSON profile (see the class
+        docstring). Without a "hash_salt", the one in the `SALT_VARIABLE`
+        environment variable is used, so it does not have to be written in the profile.
+
+        Parameters:
+        -----------
+            profile_path (path): The path of the JSON profile.
+
+        Returns:
+        --------
+            rule_set: |RuleSet| The compiled rules.
+        """
+        with open(profile_path, "r") as profile_file:
+            profile: dict = json.load(profile_file)
+
+        return cls(profile["rules"],
+                   date_shift_days=profile.get("date_shift_days", 0),
+                   hash_salt=profile.get("hash_salt", os.environ.get(SALT_VARIABLE, "")),
+                   name=profile.get("name", profile_path),
+                   recursive=profile.get("recursive", True),
+                   private_tags=profile.get("private_tags", "remove"))
+
+    def add(self, keyword: str, action: str, value: str = "") -> None:
+        """
+        This function compiles a single rule, replacing any previous rule for
+        the same tag.
+
+        Parameters:
+        -----------
+            keyword (str): The DICOM keyword of the tag (e.g. 'PatientName').
+            action (str): One of `ACTIONS`.
+            value (str): The new value (only used by the 'replace' action).
+
+        Returns:
+        --------
+
+        """
+        tag: int | None = tag_for_keyword(keyword)
+
+        if tag is None:
+            raise ValueError(f"'{keyword}' is not a DICOM keyword.")
+        if action not in ACTIONS:
+            raise ValueError(f"'{action}' is not a valid action for '{keyword}'. Use one of: {sorted(ACTIONS)}")
+        if action == "hash" and not self.hash_salt:
+            raise ValueError(f"The 'hash' action of '{keyword}' needs a secret 'hash_salt' (or set {SALT_VARIABLE}).")
+        if action == "date_shift" and not self.date_shift_days:
+            raise ValueError(f"The 'date_shift' action of '{keyword}' needs a 'date_shift_days' other than 0.")
+
+        self.compiled[BaseTag(tag)] = (keyword, action, value)
+
+    def new_value(self, tag: BaseTag, action: str, value: str, dataset: pydicom.Dataset) -> str | None:
+        """
+        This function returns the new value of a tag according to its action
+        (None means the tag has to be removed).
+        """
+        if action == "replace":
+            return value
+        elif action == "blank":
+            return ""
+        elif action == "remove":
+            return None
+
+        original: str = str(dataset[tag].value)
+
+        if action == "pseudonym":
+            if self.pseudonymizer is None:
+                raise ValueError("The 'pseudonym' action needs a pseudonymizer (see 'pseudonymizer.Pseudonymizer').")
+            vr: str = dictionary_VR(tag)
+            # Every UID shares the same mapping, so the references between tags (and files) still match:
+            return self.pseudonymizer.pseudonym("UI" if vr == "UI" else self.compiled[tag][0], original)
+
+        if action == "hash":
+            digest: str = hashlib.sha256(f"{self.hash_salt}{original}".encode()).hexdigest()
+            if dictionary_VR(tag) == "UI":
+                return f"2.25.{int(digest[:32], 16)}"  # A valid UID, derived from the hash.
+            return digest[:16].upper()
+
+        # date_shift:
+        try:
+            date: datetime.date = datetime.datetime.strptime(original[:8], "%Y%m%d").date()
+        except ValueError:
+            return ""  # Not a valid date, so nothing can be shifted.
+
+        return (date + datetime.timedelta(days=self.date_shift_days)).strftime("%Y%m%d") + original[8:]
+
+    def walk(self, dataset: pydicom.Dataset, skip: set[BaseTag] | None = None):
+        """
+        This function goes through `dataset` and all the datasets nested in its
+        sequences (at any depth), one after the other. It uses a stack instead
+        of recursion, so deep trees cannot blow up, and it only decodes the
+        sequences (every other element is left as it was read). \n
+        Each dataset is yielded before looking for its sequences, so any change
+        made to it (e.g. removing a sequence) is seen before going deeper. The
+        elements with an unknown VR that hold a sequence (e.g. private tags of
+        implicit VR files) are turned into sequences too (see `parse_unknown()`).
+
+        Parameters:
+        -----------
+            dataset: |pydicom.Dataset| The dataset read from the DICOM file.
+            skip: |set| Tags of `dataset` itself whose sequences are not walked
+                  (e.g. the ones about to be removed).
+
+        Returns:
+        --------
+            datasets: |generator| The datasets, starting with `dataset` itself.
+        """
+        stack: list[pydicom.Dataset] = [dataset]
+        skip = skip or set()
+
+        while stack:
+            current: pydicom.Dataset = stack.pop()
+            yield current
+
+            for tag in list(current.keys()):
+                if tag == PIXEL_DATA or (current is dataset and tag in skip):
+                    continue
+
+                vr: str | None = current.get_item(tag).VR
+
+                if vr is None:  # Implicit VR, still not decoded.
+                    try:
+                        vr = dictionary_VR(tag)
+                    except KeyError:  # Unknown private tag.
+                        vr = "UN"
+
+                if vr == "UN":
+                    element: pydicom.DataElement = current[tag]  # The private dictionary might know it.
+
+                    if element.VR == "UN":
+                        sequence: pydicom.Sequence | None = parse_unknown(element)
+                        if sequence is None:
+                            continue
+                        # Kept as a sequence, so the changes made inside it are written too:
+                        current[tag] = pydicom.DataElement(tag, "SQ", sequence)
+
+                    vr = current[tag].VR
+
+                if vr == "SQ":
+                    stack.extend(reversed(current[tag].value))
+
+    def changes(self, dataset: pydicom.Dataset) -> dict[BaseTag, str | None]:
+        """
+        This function finds all the tags of `dataset` that have a rule, and
+        returns their new values, without modifying the dataset. Tags that are
+        missing or empty are not included (there is nothing to anonymize). \n
+        Only the tags of `dataset` itself are checked, not the nested ones.
+
+        Parameters:
+        -----------
+            dataset: |pydicom.Dataset| The dataset read from the DICOM file.
+
+        Returns:
+        --------
+            changes: |dict| `"key"` --> tag.\n
+                     `"value"` --> the new value (None if it has to be removed).
+        """
+        changes: dict[BaseTag, str | None] = {}
+
+        for tag in self.compiled.keys() & dataset.keys():
+            item = dataset.get_item(tag)
+
+            # Raw (still not decoded) elements know their length, decoded ones their value:
+            if (item.length == 0) if hasattr(item, "length") else not item.value:
+                continue
+
+            keyword, action, value = self.compiled[tag]
+            changes[tag] = self.new_value(tag, action, value, dataset)
+
+        if self.private_tags == "remove":
+            for tag in dataset.keys():
+                if tag.is_private:
+                    changes[tag] = None
+
+        return changes
+
+    def has_nested_changes(self, dataset: pydicom.Dataset, changes: dict[BaseTag, str | None] | None = None) -> bool:
+        """
+        This function checks if any dataset nested in the sequences of
+        `dataset` has to be changed (always False if the rules are not recursive).
+
+        Parameters:
+        -----------
+            dataset: |pydicom.Dataset| The dataset read from the DICOM file.
+            changes: |dict| The changes of the top level, returned by `changes()`.
+                     The sequences removed there (e.g. the private ones) are not
+                     checked, since nothing inside them is kept.
+
+        Returns:
+        --------
+            nested: |bool| True if there is anything to change inside a sequence.
+        """
+        if not self.recursive:
+            return False
+
+        removed: set[BaseTag] = {tag for tag, value in (changes or {}).items() if value is None}
+
+        for current in self.walk(dataset, removed):
+            if current is not dataset and self.changes(current):
+                return True
+
+        return False
+
+    def apply(self, dataset: pydicom.Dataset, changes: dict[BaseTag, str | None] | None = None) -> pydicom.Dataset:
+        """
+        This function anonymizes `dataset` in place (and the datasets inside
+        its sequences, if the rules are recursive).
+
+        Parameters:
+        -----------
+            dataset: |pydicom.Dataset| The dataset read from the DICOM file.
+            changes: |dict| The changes of the top level, returned by `changes()`.
+                     If not given, they are calculated.
+
+        Returns:
+        --------
+            dataset: |pydicom.Dataset| The same dataset, already anonymized.
+        """
+        datasets = self.walk(dataset) if self.recursive else iter([dataset])
+        self.changed = 0
+
+        for current in datasets:
+            if current is not dataset or changes is None:
+                current_changes: dict[BaseTag, str | None] = self.changes(current)
+            else:
+                current_changes = changes
+
+            self.changed += len(current_changes)
+
+            for tag, value in current_changes.items():
+                if value is None:
+                    del current[tag]
+                else:
+                    current[tag].value = value
+
+        return dataset
+
+
+def parse_unknown(element: pydicom.DataElement) -> pydicom.Sequence | None:
+    """
+    Returns the items of an element with an unknown VR ('UN') if its value is
+    really a sequence, or None otherwise. The value of an 'UN' element is
+    always encoded as implicit VR little endian (see DICOM PS3.5 6.2.2).
+    """
+    if element.VR != "UN" or not isinstance(element.value, bytes) or not element.value.startswith(ITEM_TAG):
+        return None
+
+    try:
+        return pydicom.values.convert_SQ(element.value, True, True)
+    except Exception:  # Only looked like a sequence.
+        return None
+
+
+# %%
+if __name__ == "__main__":
+    profile_path: str = input("What is the path of the JSON profile? ")
+    dcm_file: str = input("What is the path of the DICOM file? ")
+
+    rule_set = RuleSet.from_file(profile_path)
+    dataset = pydicom.dcmread(dcm_file, stop_before_pixels=True)
+
+    for tag, value in rule_set.changes(dataset).items():
+        print(f"{dataset[tag]} --> {value!r}")
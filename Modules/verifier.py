@@ -0,0 +1,429 @@
+# %%
+import os
+import re
+import time
+import zipfile
+import pydicom
+from concurrent.futures import ProcessPoolExecutor
+from Modules import anonymizer
+from Modules import batch
+from Modules import metrics
+from Modules import pseudonymizer
+from Modules import rules
+
+# Actions whose result can be checked just by looking at the anonymized value (the
+# hashes, pseudonyms and shifted dates cannot be told apart from an original value):
+CHECKED_ACTIONS: set[str] = {"replace", "blank", "remove"}
+# Problems found by the verification:
+#   not_anonymized    --> a configured tag does not hold the value it should have been given.
+#   not_pseudonymized --> a tag that should hold a pseudonym does not look like one (see 'pseudonymizer.is_pseudonym()').
+#   inconsistent      --> a tag in 'CONSISTENT_TAGS' does not hold the same pseudonym in every file of the patient.
+#   not_removed       --> a tag that should have been removed (or a private tag, if they are removed) is still there.
+#   phi_match         --> a value holds a piece of the personal data of the patient (see 'Verifier.phi_terms()').
+#   phi_suspect       --> a tag without a rule holds a person name, or free text holds a date or a name
+#                         (found without knowing the personal data, see 'looks_personal()').
+#   missing           --> the patient has no anonymized files.
+#   unreadable        --> the file could not be read.
+PROBLEM_KINDS: list[str] = ["not_anonymized", "not_pseudonymized", "inconsistent", "not_removed", "phi_match",
+                            "phi_suspect", "missing", "unreadable"]
+# Pseudonyms that have to be the same in every file of a patient (the UIDs of a study might not be):
+CONSISTENT_TAGS: list[str] = ["PatientID"]
+# Values of these VRs are searched for personal data (and the unknown ones, e.g. private tags
+# read with an implicit VR, as plain text):
+TEXT_VRS: set[str] = {"AE", "AS", "CS", "DA", "DS", "DT", "IS", "LO", "LT", "PN", "SH", "ST", "TM", "UC", "UI", "UR", "UT",
+                      "UN"}
+# Values of these VRs are free text, where dates and names can hide (e.g. comments, private tags):
+FREE_TEXT_VRS: set[str] = {"LO", "LT", "SH", "ST", "UC", "UT", "UN"}
+# A calendar date (e.g. "19700101", "1970-01-01") and a DICOM person name (e.g. "Doe^John"):
+DATE_PATTERN: re.Pattern = re.compile(r"\b(19|20)\d{2}([-./]?)(0[1-9]|1[0-2])\2(0[1-9]|[12]\d|3[01])\b")
+NAME_PATTERN: re.Pattern = re.compile(r"[^\W\d_]+\^[^\W\d_]+")
+# Values are split into pieces (e.g. the family and given names) before looking them up:
+SEPARATORS: re.Pattern = re.compile(r"[\^\\=\s,;/]+")
+# Shorter pieces (e.g. the sex 'M') would be found almost everywhere:
+MIN_TERM_LENGTH: int = 3
+# Files sent at once to every worker process:
+CHUNK_SIZE: int = 64
+# Problems shown as examples in the report:
+EXAMPLES: int = 20
+
+logger = metrics.get_logger("verifier")
+
+
+def split_terms(value: str) -> set[str]:
+    """
+    Returns the pieces of a value that are looked up as personal data: the
+    whole value and every part of it (upper case, `MIN_TERM_LENGTH` at least).
+    """
+    value = value.strip(" \0").upper()
+
+    return {term for term in [value, *SEPARATORS.split(value)] if len(term) >= MIN_TERM_LENGTH}
+
+
+def looks_personal(vr: str, text: str) -> bool:
+    """
+    Tells if the value of a tag without a rule looks like personal data, even
+    when the personal data of the patient is not known: any person name, and
+    dates or names written in free text.
+    """
+    if vr == "PN":
+        return bool(text.strip(" \0"))
+
+    return vr in FREE_TEXT_VRS and (DATE_PATTERN.search(text) is not None or NAME_PATTERN.search(text) is not None)
+
+
+def check_file(rule_set: rules.RuleSet, terms: frozenset[str], dcm_file: str,
+               expected: dict[int, str] | None = None) -> list[tuple[str, str, str]]:
+    """
+    This function checks a single anonymized DICOM file, reading only its
+    header (nothing is changed). Every element is visited, at any depth:\n
+        - The tags with a rule (inside the sequences too, if the rules are
+          recursive) have to hold the expected value, or be gone. The ones
+          with a pseudonym have to look like one (the original values are
+          not known), and the same as in the other files of the patient.\n
+        - The private tags have to be gone, if the rules remove them.\n
+        - No text value can hold any of the `terms` (the personal data of the patient).\n
+        - The tags without a rule cannot look like personal data (see `looks_personal()`).
+
+    Parameters:
+    -----------
+        rule_set: |rules.RuleSet| The rules of the patient.
+        terms: |frozenset| Personal data of the patient (see `split_terms()`).
+        dcm_file (path): The path of the DICOM file.
+        expected: |dict| `"key"` --> tag (see `CONSISTENT_TAGS`).\n
+                  `"value"` --> the pseudonym it holds in every file of the patient.
+
+    Returns:
+    --------
+        problems: |list| (path, tag, kind) of every problem found (see `PROBLEM_KINDS`).
+    """
+    try:
+        dataset: pydicom.FileDataset = pydicom.dcmread(dcm_file, stop_before_pixels=True)
+    except Exception as error:
+        return [(dcm_file, repr(error), "unreadable")]
+
+    problems: list[tuple[str, str, str]] = []
+    expected = expected or {}
+    # (path of the dataset, dataset), so the nested tags can be told apart:
+    stack: list[tuple[str, pydicom.Dataset]] = [("", dataset)]
+
+    while stack:
+        prefix, current = stack.pop()
+
+        for element in current:
+            name: str = prefix + (element.keyword or str(element.tag))
+
+            if element.tag.is_private and rule_set.private_tags == "remove":
+                problems.append((dcm_file, name, "not_removed"))
+                continue
+
+            items: pydicom.Sequence | None = element.value if element.VR == "SQ" else rules.parse_unknown(element)
+
+            if items is not None:
+                stack.extend((f"{name}[{index}].", item) for index, item in enumerate(items))
+                continue
+
+            if element.is_empty:
+                continue
+
+            rule: tuple[str, str, str] | None = rule_set.compiled.get(element.tag)
+
+            if rule is not None and prefix and not rule_set.recursive:
+                rule = None  # The rules did not go into the sequences.
+
+            if rule is not None:
+                keyword, action, value = rule
+                if action == "remove":
+                    problems.append((dcm_file, name, "not_removed"))
+                elif action in CHECKED_ACTIONS and str(element.value) != (value if action == "replace" else ""):
+                    problems.append((dcm_file, name, "not_anonymized"))
+                elif action == "pseudonym" and not pseudonymizer.is_pseudonym("UI" if element.VR == "UI" else keyword,
+                                                                              str(element.value)):
+                    problems.append((dcm_file, name, "not_pseudonymized"))
+
+            if not prefix and element.tag in expected and str(element.value) != expected[element.tag]:
+                problems.append((dcm_file, name, "inconsistent"))
+
+            if element.VR in TEXT_VRS:
+                text: str = element.value.decode("latin-1") if isinstance(element.value, bytes) else str(element.value)
+                if terms and not split_terms(text).isdisjoint(terms):
+                    problems.append((dcm_file, name, "phi_match"))
+                elif rule is None and looks_personal(element.VR, text):
+                    problems.append((dcm_file, name, "phi_suspect"))
+
+    return problems
+
+
+def check_files(rule_set: rules.RuleSet, terms: frozenset[str], dcm_files: list[str],
+                expected: dict[int, str] | None = None) -> list[tuple[str, str, str]]:
+    """
+    Checks several files of the same patient (see `check_file()`). It lives
+    outside of the class so it can be sent to the worker processes, with the
+    rules and the terms only once for all the files.
+    """
+    problems: list[tuple[str, str, str]] = []
+
+    for dcm_file in dcm_files:
+        problems += check_file(rule_set, terms, dcm_file, expected)
+
+    return problems
+
+
+class Verifier:
+    """
+    This program checks, without changing anything, that the anonymized files
+    of every patient of a `batch.Batch` (inside its `{anonymized_tag}`
+    directory) no longer hold any personal data, before they leave the
+    hospital (see `check_file()`).
+    \nThe files are checked in parallel, reading only their headers. The
+    personal data looked for comes from the original files of the patient, if
+    they are still there (see `batch.Batch.keep_sources`), and from the
+    mapping store of the pseudonyms, if there is one (every original value in
+    it). The tags in `pseudonymizer.PSEUDONYM_TAGS` are expected to hold
+    pseudonyms if the patient was anonymized with a pseudonymization key (as
+    recorded in the journal), or if there is a mapping store.
+    """
+
+    def __init__(self, hospital_batch: batch.Batch, store_path: str | None = None) -> None:
+        self.batch: batch.Batch = hospital_batch
+        self.workers: int = hospital_batch.workers
+        self.store_path: str | None = store_path if store_path and os.path.isfile(store_path) else None
+        # Every original value in the mapping store (the same for every patient):
+        self.store_terms: set[str] = set()
+        self.files_checked: int = 0
+        # Patients whose personal data was not known, so only the source-independent checks were done:
+        self.patients_checked: int = 0
+        self.phi_skipped: int = 0
+        self.seconds: float = 0.0
+
+        if self.store_path is not None:
+            # Only reading the mappings, so no key is needed:
+            for original in pseudonymizer.Pseudonymizer(b"lookup only", self.store_path).originals():
+                self.store_terms |= split_terms(original)
+
+    def __dir__(self) -> None:
+        return ["make_rules", "phi_terms", "patient_jobs", "expected_pseudonyms", "run", "report"]
+
+    def make_rules(self, root_paths: str, anonymized_tag: str) -> rules.RuleSet:
+        """
+        Returns the rules the patient was anonymized with (see `batch.Batch.prepare_patient()`).
+        """
+        rule_set: rules.RuleSet = anonymizer.Eraser(root_paths, anonymized_tag, self.batch.profile).rules
+
+        if self.store_path is not None or self.batch.ledger.pseudonymized(root_paths):
+            for keyword in pseudonymizer.PSEUDONYM_TAGS:
+                rule_set.add(keyword, "pseudonym")
+
+        return rule_set
+
+    def phi_terms(self, root_paths: str, dicom_directory: str, rule_set: rules.RuleSet) -> frozenset[str]:
+        """
+        This function gathers the personal data of a patient: the original
+        values of every tag with a rule (names, dates, IDs...), read from the
+        header of one of its original files, and the original values in the
+        mapping store. The values the rules put in their place are left out.
+
+        Parameters:
+        -----------
+            root_paths (path): The patient directory.
+            dicom_directory (str): The name of the DICOM directory (or ZIP
+                                   file), "" if there are no sources left.
+            rule_set: |rules.RuleSet| The rules of the patient.
+
+        Returns:
+        --------
+            terms: |frozenset| The pieces of personal data (see `split_terms()`).
+        """
+        terms: set[str] = set(self.store_terms)
+        dataset: pydicom.Dataset | None = None
+        source_path: str = self.batch.source_path(root_paths, dicom_directory) if dicom_directory else ""
+
+        if source_path.endswith(".zip"):
+            with zipfile.ZipFile(source_path, "r") as zip_ref:
+                members: list[str] = [name for name in zip_ref.namelist() if name.endswith(".dcm")]
+                if members:
+                    with zip_ref.open(members[0]) as member:
+                        dataset = pydicom.dcmread(member, stop_before_pixels=True)
+        elif source_path:
+            for root, dirs, files in sorted(os.walk(source_path)):
+                dcm_files: list[str] = sorted(item for item in files if item.endswith(".dcm"))
+                if dcm_files:
+                    dataset = pydicom.dcmread(os.path.join(root, dcm_files[0]), stop_before_pixels=True)
+                    break
+
+        if dataset is not None:
+            for tag in rule_set.compiled.keys() & dataset.keys():
+                if not dataset[tag].is_empty and dataset[tag].VR != "SQ":
+                    terms |= split_terms(str(dataset[tag].value))
+
+        for keyword, action, value in rule_set.compiled.values():
+            terms -= split_terms(value)
+
+        return frozenset(terms)
+
+    def patient_jobs(self, root_paths: str, dicom_directory: str,
+                     anonymized_tag: str) -> tuple[list[tuple], list[tuple[str, str, str]]]:
+        """
+        This function gets the files of a patient ready to be checked.
+
+        Parameters:
+        -----------
+            root_paths (path): The patient directory.
+            dicom_directory (str): The name of the DICOM directory (or ZIP file).
+            anonymized_tag (str): The anonymized tag of the patient.
+
+        Returns:
+        --------
+            jobs: |list| (rules, terms, files, expected pseudonyms) for every
+                  chunk of `CHUNK_SIZE` files (see `check_file()`).
+            problems: |list| (path, tag, kind) if the patient cannot be checked.
+        """
+        output_path: str = f"{root_paths}/{anonymized_tag}"
+
+        if not os.path.isdir(output_path):
+            return [], [(root_paths, "", "missing")]
+
+        dcm_files: list[str] = [f"{output_path}/{item}" for item in sorted(os.listdir(output_path))
+                                if os.path.splitext(item)[1] == ".dcm"]
+
+        if not dcm_files:
+            return [], [(root_paths, "", "missing")]
+
+        rule_set: rules.RuleSet = self.make_rules(root_paths, anonymized_tag)
+
+        try:
+            terms: frozenset[str] = self.phi_terms(root_paths, dicom_directory, rule_set)
+        except Exception as error:  # The original files are only a source of terms, the check goes on.
+            logger.warning("The original files could not be read: %s | %s", root_paths, repr(error))
+            terms = frozenset(self.store_terms)
+
+        if not terms:
+            logger.warning("No personal data to look for (the sources are gone, and there is no mapping store), "
+                           "only the checks that do not need it are done: %s", root_paths)
+            self.phi_skipped += 1
+
+        expected: dict[int, str] = self.expected_pseudonyms(dcm_files[0], rule_set)
+        self.files_checked += len(dcm_files)
+        self.patients_checked += 1
+
+        return [(rule_set, terms, dcm_files[start:start + CHUNK_SIZE], expected)
+                for start in range(0, len(dcm_files), CHUNK_SIZE)], []
+
+    def expected_pseudonyms(self, dcm_file: str, rule_set: rules.RuleSet) -> dict[int, str]:
+        """
+        This function reads the pseudonyms of `CONSISTENT_TAGS` from one of the
+        anonymized files of a patient, which every other file has to hold too.
+
+        Parameters:
+        -----------
+            dcm_file (path): The first anonymized file of the patient.
+            rule_set: |rules.RuleSet| The rules of the patient.
+
+        Returns:
+        --------
+            expected: |dict| `"key"` --> tag.\n
+                      `"value"` --> its pseudonym. Empty if the patient has no
+                      pseudonyms (or the file cannot be read, which `check_file()` reports).
+        """
+        tags: list[int] = [tag for tag, (keyword, action, value) in rule_set.compiled.items()
+                           if action == "pseudonym" and keyword in CONSISTENT_TAGS]
+
+        if not tags:
+            return {}
+
+        try:
+            dataset: pydicom.FileDataset = pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=tags)
+        except Exception:
+            return {}
+
+        return {tag: str(dataset[tag].value) for tag in tags if tag in dataset and not dataset[tag].is_empty}
+
+    def run(self) -> list[tuple[str, str, str]]:
+        """
+        This function checks every patient of the batch.
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+            problems: |list| (path, tag, kind) of every problem found, in the
+                      same order the patients were found (see `PROBLEM_KINDS`).
+        """
+        start_time: float = time.perf_counter()
+        self.files_checked = self.patients_checked = self.phi_skipped = 0
+        problems: list[tuple[str, str, str]] = []
+        jobs: list[tuple] = []
+
+        with metrics.METRICS.timer("verify"):
+            for patient in self.batch.find_patients():
+                patient_jobs, patient_problems = self.patient_jobs(*patient)
+                jobs += patient_jobs
+                problems += patient_problems
+
+            if self.workers > 1 and len(jobs) > 1:
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    for chunk_problems in executor.map(check_files, *zip(*jobs)):
+                        problems += chunk_problems
+            else:
+                for job in jobs:
+                    problems += check_files(*job)
+
+        self.seconds = time.perf_counter() - start_time
+        metrics.METRICS.count("files_verified", self.files_checked)
+        logger.info("File(s) verified: %d | problems: %d | %.1f s", self.files_checked, len(problems), self.seconds)
+
+        return problems
+
+    def report(self, problems: list[tuple[str, str, str]]) -> dict:
+        """
+        This function summarizes the problems found by `run()`.
+
+        Parameters:
+        -----------
+            problems: |list| (path, tag, kind) of every problem found.
+
+        Returns:
+        --------
+            report: |dict| `"passed"` --> True if nothing was found.\n
+                    `"files"`, `"files_with_problems"`, `"problems"` --> how many.\n
+                    `"kinds"` --> problems of every kind (see `PROBLEM_KINDS`).\n
+                    `"tags"` --> problems of every tag (nested tags by their
+                    keyword, without the sequences around them).\n
+                    `"phi_check"` --> "done" if the personal data of every
+                    patient was looked for, "skipped" if it was not known for
+                    any of them (e.g. the sources were removed and there is no
+                    mapping store), "partial" otherwise.\n
+                    `"seconds"`, `"files_per_second"` --> how long it took.\n
+                    `"examples"` --> the first `EXAMPLES` problems.
+        """
+        kinds: dict[str, int] = {kind: 0 for kind in PROBLEM_KINDS}
+        tags: dict[str, int] = {}
+
+        for path, tag, kind in problems:
+            kinds[kind] += 1
+            if kind not in ("missing", "unreadable"):
+                keyword: str = tag.rsplit(".", 1)[-1]
+                tags[keyword] = tags.get(keyword, 0) + 1
+
+        return {"passed": not problems,
+                "files": self.files_checked,
+                "files_with_problems": len({path for path, tag, kind in problems}),
+                "problems": len(problems),
+                "kinds": kinds,
+                "tags": dict(sorted(tags.items(), key=lambda item: -item[1])),
+                "phi_check": ("done" if not self.phi_skipped else
+                              "skipped" if self.phi_skipped == self.patients_checked else "partial"),
+                "seconds": round(self.seconds, 3),
+                "files_per_second": round(self.files_checked / self.seconds, 1) if self.seconds else 0.0,
+                "examples": [list(problem) for problem in problems[:EXAMPLES]]}
+
+
+# %%
+if __name__ == "__main__":
+    root_path: str = input("What is the root of the directory? ")
+    store_path: str = input("What is the path of the mapping store (if pseudonyms were used)? ")
+
+    hospital_verifier = Verifier(batch.Batch(root_path, r"TAG_DATA_HOSPITAL-\d+\Z"), store_path or None)
+
+    for problem in hospital_verifier.run():
+        print(f"PROBLEM: {problem[0]} | {problem[1]} | {problem[2]}")
@@ -0,0 +1,292 @@
+# %%
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from Modules import batch
+from Modules import journal
+from Modules import memory
+from Modules import metrics
+
+# inotify events (see 'man 7 inotify'):
+IN_MODIFY: int = 0x00000002
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+IN_Q_OVERFLOW: int = 0x00004000
+IN_ISDIR: int = 0x40000000
+WATCH_MASK: int = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER: struct.Struct = struct.Struct("iIII")  # wd, mask, cookie, len
+
+logger = metrics.get_logger("watcher")
+
+
+class Inotify:
+    """
+    This is a minimal wrapper (through `ctypes`, no extra dependencies) around
+    the Linux inotify API. It raises `OSError` when inotify is not available,
+    so the `Watcher` can fall back to polling.
+    """
+
+    def __init__(self) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available.")
+
+        self.fd: int = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed.")
+
+        self.paths: dict[int, str] = {}  # key --> watch descriptor, value --> watched path.
+
+    def __dir__(self) -> None:
+        return ["add_watch", "read", "close"]
+
+    def add_watch(self, path: str) -> None:
+        """
+        Starts watching the directory in `path` (not its sub-directories).
+        """
+        wd: int = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+
+        if wd >= 0:
+            self.paths[wd] = path
+
+    def read(self, timeout: float) -> list[tuple[str, int, str]] | None:
+        """
+        Waits up to `timeout` seconds for events, and returns them as
+        (watched path, mask, name). It returns None if the kernel queue
+        overflowed (some events were lost, everything has to be checked again).
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+
+        if not ready:
+            return []
+
+        try:
+            buffer: bytes = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events: list[tuple[str, int, str]] = []
+        offset: int = 0
+
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name: str = os.fsdecode(buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd in self.paths:
+                events.append((self.paths[wd], mask, name))
+
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    This program runs the `Batch` as a long-running service: it watches the
+    drop directory (`root_path`) and anonymizes every new patient within
+    seconds of its arrival, instead of waiting for a nightly batch.
+    \n    - New files are noticed through inotify (Linux), or by polling the drop
+          directory every `poll_interval` seconds when inotify is not available.\n
+        - A patient is only sent once its source (ZIP file or directory) stopped
+          changing for `settle_time` seconds, so half-copied studies are not read.\n
+        - The patients go to a pool of `batch.workers` processes. At most
+          `queue_size` patients wait for a free worker: when the queue is full,
+          the watcher blocks (backpressure) and the new events wait in the kernel.
+    """
+
+    def __init__(self, hospital_batch: batch.Batch, queue_size: int = 16, poll_interval: float = 10.0,
+                 settle_time: float = 2.0) -> None:
+        self.batch: batch.Batch = hospital_batch
+        self.queue_size: int = queue_size
+        self.poll_interval: float = poll_interval
+        self.settle_time: float = settle_time
+        self.slots: threading.BoundedSemaphore = threading.BoundedSemaphore(hospital_batch.workers + queue_size)
+        self.stop_event: threading.Event = threading.Event()
+        self.lock: threading.Lock = threading.Lock()
+        self.in_flight: set[str] = set()
+        # key --> patient path, value --> (fingerprint, when it was first seen with that fingerprint).
+        self.pending: dict[str, tuple[str, float]] = {}
+        # key --> patient path, value --> fingerprint of the source that was last sent.
+        self.sent: dict[str, str] = {}
+
+    def __dir__(self) -> None:
+        return ["check_patient", "submit", "finished", "run", "stop"]
+
+    def check_patient(self, patient_path: str) -> tuple[str, str, str] | None:
+        """
+        This function returns the patient if it has a source ready to be
+        anonymized (it exists, it did not change for `settle_time` seconds, and
+        it was not sent before). Otherwise, it is kept as pending.
+        """
+        try:
+            entries: list[os.DirEntry] = list(os.scandir(patient_path))
+        except OSError:  # The directory is gone.
+            self.pending.pop(patient_path, None)
+            return None
+
+        patient: tuple[str, str, str] | None = self.batch.find_patient(patient_path,
+                                                                       [entry.name for entry in entries if entry.is_dir()],
+                                                                       [entry.name for entry in entries if entry.is_file()])
+
+        if patient is None or not patient[1]:
+            self.pending.pop(patient_path, None)
+            return None
+
+        try:
+            fingerprint: str = journal.make_fingerprint(self.batch.source_path(patient[0], patient[1]))
+        except OSError:  # Still being moved or removed.
+            return None
+
+        if self.sent.get(patient_path) == fingerprint:
+            self.pending.pop(patient_path, None)
+            return None
+
+        first_seen: tuple[str, float] | None = self.pending.get(patient_path)
+
+        if first_seen is None or first_seen[0] != fingerprint:
+            self.pending[patient_path] = (fingerprint, time.monotonic())
+            return None
+        if time.monotonic() - first_seen[1] < self.settle_time:
+            return None
+
+        del self.pending[patient_path]
+        self.sent[patient_path] = fingerprint
+
+        return patient
+
+    def submit(self, executor: ProcessPoolExecutor, patient: tuple[str, str, str]) -> None:
+        """
+        This function sends a patient to the pool, waiting for a free slot if
+        the queue is full (backpressure).
+        """
+        while not self.slots.acquire(timeout=1.0):
+            if self.stop_event.is_set():
+                return
+
+        with self.lock:
+            self.in_flight.add(patient[0])
+
+        logger.info("New patient: %s", patient[0])
+        future: Future = executor.submit(metrics.collect, metrics.METRICS.enabled, self.batch.process_patient, *patient)
+        future.add_done_callback(lambda done: self.finished(patient, done))
+
+    def finished(self, patient: tuple[str, str, str], future: Future) -> None:
+        """
+        This function is called when a patient is done: it frees its slot, adds
+        its metrics, and logs the failures, if any.
+        """
+        with self.lock:
+            self.in_flight.discard(patient[0])
+        self.slots.release()
+
+        try:
+            failures, snapshot = future.result()
+            with self.lock:
+                metrics.METRICS.merge(snapshot)
+        except Exception as error:
+            failures = [(patient[0], repr(error))]
+            self.sent.pop(patient[0], None)  # Try it again if it changes.
+
+        for failure in failures:
+            logger.error("FAILED: %s | %s", failure[0], failure[1])
+
+    def patient_directories(self) -> set[str]:
+        """
+        Returns all the directories right under `root_path`.
+        """
+        with os.scandir(self.batch.root_path) as entries:
+            return {entry.path for entry in entries if entry.is_dir()}
+
+    def run(self) -> None:
+        """
+        This function runs the service until `stop()` is called (or Ctrl+C).
+
+        Parameters:
+        -----------
+
+        Returns:
+        --------
+
+        """
+        try:
+            notifier: Inotify | None = Inotify()
+            notifier.add_watch(self.batch.root_path)
+            for patient_path in self.patient_directories():
+                notifier.add_watch(patient_path)
+            logger.info("Watching (inotify): %s", self.batch.root_path)
+        except OSError:
+            notifier = None
+            logger.info("Watching (polling every %s seconds): %s", self.poll_interval, self.batch.root_path)
+
+        # Everything that is already there is checked first:
+        candidates: set[str] = self.patient_directories()
+        last_poll: float = time.monotonic()
+
+        with ProcessPoolExecutor(max_workers=self.batch.workers, initializer=memory.limit_memory,
+                                 initargs=(self.batch.memory_limit,)) as executor:
+            try:
+                while not self.stop_event.is_set():
+                    for patient_path in sorted(candidates | set(self.pending)):
+                        with self.lock:
+                            busy: bool = patient_path in self.in_flight
+                        if busy:
+                            continue
+
+                        patient: tuple[str, str, str] | None = self.check_patient(patient_path)
+                        if patient is not None:
+                            self.submit(executor, patient)
+
+                    # Wake up at least often enough to check the pending patients again:
+                    timeout: float = min(self.poll_interval, self.settle_time) if self.pending else self.poll_interval
+                    candidates = set()
+
+                    if notifier is None:
+                        self.stop_event.wait(timeout)
+                        candidates = self.patient_directories()
+                        continue
+
+                    events: list[tuple[str, int, str]] | None = notifier.read(timeout)
+
+                    if events is None or time.monotonic() - last_poll > 10 * self.poll_interval:
+                        # Lost events (or just in case), everything is checked again:
+                        candidates = self.patient_directories()
+                        last_poll = time.monotonic()
+                        continue
+
+                    for watched_path, mask, name in events:
+                        if watched_path == self.batch.root_path:
+                            if mask & IN_ISDIR:
+                                notifier.add_watch(f"{watched_path}/{name}")
+                                candidates.add(f"{watched_path}/{name}")
+                        else:
+                            candidates.add(watched_path)
+            except KeyboardInterrupt:
+                logger.info("Stopping, waiting for the patients in progress...")
+            finally:
+                if notifier is not None:
+                    notifier.close()
+
+    def stop(self) -> None:
+        """
+        Stops the service (the patients in progress are finished first).
+        """
+        self.stop_event.set()
+
+
+# %%
+if __name__ == "__main__":
+    root_path: str = input("What is the drop directory? ")
+
+    Watcher(batch.Batch(root_path, r"TAG_DATA_HOSPITAL-\d+\Z")).run()
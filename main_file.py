@@ -1,73 +1,287 @@
 # %%
-from Modules import anonymizer
-from Modules import out_of_folder
-import shutil
+"""
+Anonymizes (and sorts) every patient dropped inside a main directory.
+
+    python main_file.py scan      /path/to/new_patients
+    python main_file.py dry-run   /path/to/new_patients
+    python main_file.py anonymize /path/to/new_patients --workers 8 --metrics run.prom
+    python main_file.py verify    /path/to/new_patients
+
+Every subcommand finds the patients the same way (see `batch.Batch.find_patients()`).
+"""
+import argparse
 import os
-import re
-from tkinter import messagebox
+import sys
+# Only the standard library is imported up here: the modules (and pydicom) are imported by the
+# subcommands that need them, so a scan, a dry run or a run on an empty folder starts right away.
 # -------------------------------------------------------------------------
 #                             DIRECTORY STRUCTURE
 # -------------------------------------------------------------------------
-# main_directory > name > dicom_directory
+# root_path > TAG_DATA_HOSPITAL-N > dicom_directory
 #
-# main_directory: this is the parent (first) directory in the tree.
-# name: this is the directory with the anonymized name of the patient.
+# root_path: this is the parent (first) directory in the tree, where all the
+#            patients are dropped (the first argument of every subcommand).
+# TAG_DATA_HOSPITAL-N: this is the directory with the anonymized name of the
+#                      patient (it has to match '--pattern').
 # dicom_directory: this could be the directory holding all the smaller
 #                  directories with the DICOM files inside, or a ZIP folder.
 # -------------------------------------------------------------------------
 
-# # Computer:
-# main_directory = "patients"
+# The patient directories, matched against their whole path (e.g. r"new_patients/TAG_DATA_HOSPITAL-\d+\Z"):
+DIR_NAME_PATTERN: str = r"TAG_DATA_HOSPITAL-\d+\Z"
 
-# name: str = input("What is the patient's name: ")
-# dicom_directory: str = input("What is the ZIP file's name: ")
-# anonymized_tag: str = input("What is the anonymized tag: ")
 
-# root_path: str = f"/home/person/Documents/DICOMS/PROJECT_NAME/{main_directory}/{name}"
-# ----------------------------------
-dir_name_pattern: str = r"new_patients/TAG_DATA_HOSPITAL-\d+\Z"
+def notify(failures: list[tuple[str, str]], popup: bool = True) -> None:
+    """
+    Prints the failures, and shows the final pop-up window. The pop-up is only
+    shown when there is a display (it is skipped on headless servers).
+    """
+    for failure in failures:
+        print(f"FAILED: {failure[0]} | {failure[1]}")
 
-main_directory: str = "new_patients"
+    if not popup or (os.name != "nt" and not os.environ.get("DISPLAY")):
+        print("\nAll patients annonymized!\n" if not failures else f"\n{len(failures)} file(s) could not be anonymized.\n")
+        return
 
-root_path: str = f"/home/person/Documents/DICOMS/PROJECT_NAME/{main_directory}"
-# root_path: str = f"/media/person/My Passport/{main_directory}"  # In case you run it from an external hard-drive.
+    from tkinter import messagebox
 
-for root_paths, directories, files in os.walk(root_path):
-    try:
-        path_indexes: tuple[int, int] = re.search(dir_name_pattern, root_paths).span()
-    except AttributeError:
-        # Otherwise, when there are no directories, you will have a
-        # "'NoneType' object", which cannot be used with ".span()"
-        pass
+    if failures:
+        messagebox.showerror(title="Finished with errors!",
+                             message=f"{len(failures)} file(s) could not be anonymized. Their patients were not removed.")
     else:
-        path_slice: str = root_paths[path_indexes[0]:path_indexes[1]]
+        messagebox.showinfo(title="Ready!",
+                            message=f"All patients annonymized!")
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """
+    Builds the parser of the command line: the options shared by every
+    subcommand, and the ones only used to anonymize.
+    """
+    shared = argparse.ArgumentParser(add_help=False)
+    shared.add_argument("root_path", help="The main directory, where all the patients are dropped.")
+    shared.add_argument("--pattern", default=DIR_NAME_PATTERN,
+                        help=f"Regular expression matching the patient directories (default: {DIR_NAME_PATTERN}).")
+    shared.add_argument("--journal", help="What was already done in previous runs, so an interrupted batch can be "
+                                          "resumed (default: ROOT_PATH/.anonymizer_journal.sqlite).")
+    shared.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of processes. When there are several patients, they are processed at the same "
+                             "time, otherwise the files of the patient are.")
+    shared.add_argument("--log-level", default="INFO",
+                        help='What is shown in the console: "DEBUG" (every single file), "INFO" (every patient), "WARNING"...')
+    shared.add_argument("--structured-logs", action="store_true",
+                        help="Write the logs as JSON lines (for log collectors), instead of plain text.")
+    shared.add_argument("--metrics", dest="metrics_path",
+                        help="Save a summary of the run (counters and time per stage) into this file: as JSON, or in "
+                             "the Prometheus text-file format if it ends with '.prom'.")
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("scan", parents=[shared], help="List the patients found, and their state in the journal.")
+
+    for command in ["dry-run", "anonymize"]:
+        options = commands.add_parser(command, parents=[shared],
+                                      help="Show what 'anonymize' would do, without changing anything." if command == "dry-run"
+                                      else "Anonymize and sort every patient.")
+        # Incremental mode: only the new (or changed) patients are anonymized. Each source is recognized
+        # by its fingerprint (size, modification time and, with '--fast-hash', a hash of the beginning and
+        # end of every file).
+        options.add_argument("--no-incremental", dest="incremental", action="store_false",
+                             help="Anonymize every patient again, even the unchanged ones.")
+        options.add_argument("--fast-hash", action="store_true",
+                             help="Also hash the beginning and end of every file, to notice changed sources.")
+
+    verify_options = commands.add_parser("verify", parents=[shared],
+                                         help="Check that the anonymized files no longer hold the personal data.")
+    verify_options.add_argument("--pseudonym-store",
+                                help="The mapping store of the pseudonyms, if they were used: none of its original values "
+                                     "can be left.")
+    verify_options.add_argument("--report", help="Save the report (as JSON) into this file.")
+
+    # 'verify' has to check the files against the same rules they were anonymized with:
+    for command in ["anonymize", "verify"]:
+        commands.choices[command].add_argument("--profile",
+                                               help="JSON profile with the anonymization rules (e.g. "
+                                                    "Modules/profiles/basic_profile.json, whose hashes are salted "
+                                                    "with ANONYMIZER_HASH_SALT). By default, the built-in rules are "
+                                                    "used, and the private tags are removed.")
+
+    anonymize = commands.choices["anonymize"]
+    anonymize.add_argument("--keep-sources", action="store_true",
+                           help="Keep the original ZIP files/directories after anonymizing them.")
+    anonymize.add_argument("--fsync", dest="fsync_policy", default="batch", choices=["none", "batch", "file"],
+                           help="When the anonymized files are flushed to the disk (see 'committer.FSYNC_POLICIES').")
+    anonymize.add_argument("--watch", action="store_true",
+                           help="Run as a service, watching ROOT_PATH for new patients, instead of a single pass.")
+    anonymize.add_argument("--overlap-io", action="store_true",
+                           help="Overlap the reading, anonymizing and writing of the files (and of several patients). "
+                                "Mostly useful on slow storage (network shares, USB drives...).")
+    anonymize.add_argument("--pseudonym-key",
+                           help="File with the secret key of the consistent pseudonyms (or set ANONYMIZER_PSEUDONYM_KEY). "
+                                "Without any key, no pseudonyms are made.")
+    anonymize.add_argument("--pseudonym-store",
+                           help="Every pseudonym made is also kept here, so it can be looked up again (by default, "
+                                "none is kept). It holds the original values, so it cannot be inside ROOT_PATH: "
+                                "keep it as safe as the key.")
+    anonymize.add_argument("--stream-size", type=int, default=256,
+                           help="Files bigger than this (in MB) are never loaded whole, their pixel data is copied in chunks.")
+    anonymize.add_argument("--memory-limit", type=int,
+                           help="Memory ceiling (in MB) of every worker process. A file that goes past it is streamed too. "
+                                "With --overlap-io, the files waiting between the stages add up to half of it at most.")
+    anonymize.add_argument("--no-popup", dest="popup", action="store_false", help="Never show the final pop-up window.")
+
+    return parser
+
+
+def make_batch(arguments: argparse.Namespace):
+    """
+    Builds the `batch.Batch` every subcommand goes through, from the command line.
+    """
+    from Modules import batch
+    from Modules import pseudonymizer
+
+    mapper: pseudonymizer.Pseudonymizer | None = None
+    key_path: str | None = getattr(arguments, "pseudonym_key", None)
+
+    if arguments.command == "anonymize" and (key_path is not None or os.environ.get(pseudonymizer.KEY_VARIABLE)):
+        mapper = pseudonymizer.Pseudonymizer.from_key_file(key_path, arguments.pseudonym_store)
+
+    memory_limit: int | None = getattr(arguments, "memory_limit", None)
+
+    return batch.Batch(arguments.root_path, arguments.pattern, arguments.journal, arguments.workers,
+                       incremental=getattr(arguments, "incremental", True),
+                       fast_hash=getattr(arguments, "fast_hash", False),
+                       keep_sources=getattr(arguments, "keep_sources", False),
+                       fsync_policy=getattr(arguments, "fsync_policy", "batch"),
+                       pseudonymizer=mapper,
+                       memory_limit=None if memory_limit is None else memory_limit * 1024 * 1024,
+                       stream_size=getattr(arguments, "stream_size", 256) * 1024 * 1024,
+                       profile=getattr(arguments, "profile", None),
+                       read_only=arguments.command != "anonymize")
+
+
+def scan(hospital_batch, arguments: argparse.Namespace) -> int:
+    """
+    Lists every patient found, with its state in the journal.
+    """
+    patients: list[tuple[str, str, str]] = hospital_batch.find_patients()
+
+    for root_paths, dicom_directory, anonymized_tag in patients:
+        state: str | None = hospital_batch.ledger.patient_state(root_paths)
+        print(f"{anonymized_tag} | source: {dicom_directory or '-'} | state: {state or 'new'} | {root_paths}")
+
+    print(f"\n{len(patients)} patient(s) found.\n")
+
+    return 0
+
+
+def dry_run(hospital_batch, arguments: argparse.Namespace) -> int:
+    """
+    Shows what 'anonymize' would do with every patient (see `batch.Batch.plan_patient()`).
+    """
+    patients: list[tuple[str, str, str]] = hospital_batch.find_patients()
+    actions: dict[str, int] = {}
+
+    for root_paths, dicom_directory, anonymized_tag in patients:
+        action, fingerprint = hospital_batch.plan_patient(root_paths, dicom_directory)
+        actions[action] = actions.get(action, 0) + 1
+        print(f"{action:8} | {anonymized_tag} | {root_paths}")
+
+    print("\n" + " | ".join(f"{action}: {count}" for action, count in sorted(actions.items())) + "\n")
+
+    return 1 if actions.get("missing") else 0
+
+
+def anonymize(hospital_batch, arguments: argparse.Namespace) -> int:
+    """
+    Anonymizes every patient (once, through the asyncio pipeline, or as a service).
+    """
+    if arguments.watch:
+        from Modules import watcher
+
+        # Long-running service: every new patient is anonymized as soon as it is dropped.
+        watcher.Watcher(hospital_batch).run()
+        return 0
+
+    if arguments.overlap_io:
+        from Modules import async_pipeline
+
+        failures: list[tuple[str, str]] = async_pipeline.AsyncPipeline(hospital_batch).run()
+    else:
+        failures: list[tuple[str, str]] = hospital_batch.run()
+
+    notify(failures, arguments.popup)
+
+    return 1 if failures else 0
+
+
+def verify(hospital_batch, arguments: argparse.Namespace) -> int:
+    """
+    Checks the anonymized files of every patient (see `verifier.Verifier`), and
+    prints a compact report. It fails if anything is found, so every batch can
+    be checked before it leaves the hospital.
+    """
+    import json
+    from Modules import verifier
+
+    hospital_verifier = verifier.Verifier(hospital_batch, arguments.pseudonym_store)
+    report: dict = hospital_verifier.report(hospital_verifier.run())
+
+    print(f"\n{'PASSED' if report['passed'] else 'FAILED'} | files: {report['files']} | "
+          f"with problems: {report['files_with_problems']} | problems: {report['problems']} | "
+          f"phi_check: {report['phi_check']} | {report['files_per_second']} files/s")
+    print(" | ".join(f"{kind}: {count}" for kind, count in report["kinds"].items() if count))
+    print(" | ".join(f"{tag}: {count}" for tag, count in list(report["tags"].items())[:10]))
+
+    for path, tag, kind in report["examples"]:
+        print(f"PROBLEM: {kind} | {tag} | {path}")
+
+    if arguments.report:
+        with open(arguments.report, "w") as report_file:
+            json.dump(report, report_file, indent=4)
+
+    return 0 if report["passed"] else 1
+
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    Runs a subcommand, and returns the exit code of the program (1 if
+    anything failed, or was found still holding personal data).
+    """
+    parser: argparse.ArgumentParser = make_parser()
+    arguments: argparse.Namespace = parser.parse_args(argv)
+    store_path: str | None = getattr(arguments, "pseudonym_store", None)
+
+    # The mapping store would leave the original values next to the anonymized files:
+    if store_path is not None and os.path.commonpath([os.path.realpath(store_path),
+                                                      os.path.realpath(arguments.root_path)]) == os.path.realpath(arguments.root_path):
+        parser.error("--pseudonym-store cannot be inside ROOT_PATH.")
+    if getattr(arguments, "profile", None) is not None:
+        if not os.path.isfile(arguments.profile):
+            parser.error(f"The profile '{arguments.profile}' does not exist.")
 
-        if bool(path_slice):
-            name: str = path_slice[13:]
-            anonymized_tag = name
+        from Modules import rules
 
-            if len(directories) > 0:  # There are no ZIP files, only a directory.
-                dicom_directory: str = directories[0]
-            else:  # There is only a ZIP files and no directories.
-                dicom_directory: str = os.path.splitext(files[0])[0]
+        try:  # Checked once here, instead of failing every single patient:
+            rules.RuleSet.from_file(arguments.profile)
+        except (ValueError, KeyError) as error:
+            parser.error(f"The profile '{arguments.profile}' cannot be used: {error}")
 
-            # ------------------------------------------------
-            men_in_black: anonymizer.Eraser = anonymizer.Eraser(root_paths, anonymized_tag)
+    from Modules import metrics
 
-            wall_e: out_of_folder.Reorder = out_of_folder.Reorder(root_paths, dicom_directory, anonymized_tag)
-            # ------------------------------------------------
-            wall_e.unzip_file()
+    metrics.configure_logging(arguments.log_level.upper(), arguments.structured_logs)
+    metrics.METRICS.enable(arguments.metrics_path is not None)
 
-            men_in_black.anonymize()
+    command = {"scan": scan, "dry-run": dry_run, "anonymize": anonymize, "verify": verify}[arguments.command]
+    exit_code: int = command(make_batch(arguments), arguments)
 
-            wall_e.make_directory()
-            wall_e.check_files_order()
-            wall_e.rename_files()
+    if arguments.metrics_path is not None:
+        metrics.METRICS.export(arguments.metrics_path)
 
-            shutil.rmtree(f"{root_paths}/{dicom_directory}")
-            os.remove(f"{root_paths}/{dicom_directory}.zip")
+    return exit_code
 
-messagebox.showinfo(title="Ready!",
-                    message=f"All patients annonymized!")
 
 # %%
+if __name__ == "__main__":
+    sys.exit(main())
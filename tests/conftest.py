@@ -0,0 +1,40 @@
+import os
+import sys
+import pytest
+
+ROOT_PATH: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules are imported as 'Modules.*' (as 'main_file.py' does), and the synthetic studies
+# come from the benchmarks:
+sys.path[:0] = [ROOT_PATH, os.path.join(ROOT_PATH, "Benchmarks")]
+
+import synthetic_study  # noqa: E402
+from Modules import metrics  # noqa: E402
+
+DIR_NAME_PATTERN: str = r"TAG_DATA_HOSPITAL-\d+\Z"
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    """
+    Every test starts with empty (and enabled) metrics, so the counters can be checked.
+    """
+    metrics.METRICS.reset()
+    metrics.METRICS.enable()
+    yield
+    metrics.METRICS.reset()
+    metrics.METRICS.enable(False)
+
+
+@pytest.fixture
+def make_batch(tmp_path):
+    """
+    Returns a function that creates a small synthetic batch (see
+    `synthetic_study.make_batch()`) and returns its root path.
+    """
+
+    def make(patients: int = 1, **study_options) -> str:
+        options: dict = {"slices": 4, "rows": 8, "columns": 8}
+        options.update(study_options)
+        return synthetic_study.make_batch(str(tmp_path / "batch"), patients, **options)
+
+    return make
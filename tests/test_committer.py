@@ -0,0 +1,102 @@
+import os
+import pytest
+from conftest import DIR_NAME_PATTERN
+from Modules import batch
+from Modules import committer
+from Modules import out_of_folder
+
+PATIENT: str = "TAG_DATA_HOSPITAL-1"
+
+
+@pytest.fixture
+def output(tmp_path) -> committer.Committer:
+    """
+    A committer for a patient expecting 3 files, all of them already in the staging directory.
+    """
+    output: committer.Committer = committer.Committer(out_of_folder.Reorder(str(tmp_path), "study", PATIENT))
+    output.prepare()
+    output.expected = {f"{counter:03}.dcm" for counter in range(3)}
+
+    for name in output.expected:
+        with open(output.staging_target(name), "wb") as staged:
+            staged.write(b"anonymized")
+
+    return output
+
+
+def write_final(output: committer.Committer, names: list[str]) -> None:
+    """
+    Leaves an older `{anonymized_tag}` directory with the files in `names`.
+    """
+    os.makedirs(output.final_path)
+
+    for name in names:
+        with open(f"{output.final_path}/{name}", "wb") as final:
+            final.write(b"older")
+
+
+@pytest.mark.parametrize("older_output", [False, True], ids=["new", "replaced"])
+def test_publish_commits_the_whole_staging_directory(output, older_output):
+    if older_output:
+        write_final(output, ["000.dcm", "999.dcm"])
+
+    assert output.publish()
+
+    assert sorted(os.listdir(output.final_path)) == sorted(output.expected)
+    assert not os.path.exists(output.staging_path)
+    assert not [name for name in os.listdir(output.reorder.root_path) if name.endswith(".old")]
+    # Published already, so publishing again changes nothing:
+    assert output.publish()
+
+
+def test_publish_refuses_missing_files(output):
+    write_final(output, ["000.dcm"])
+    os.remove(output.staging_target("001.dcm"))
+
+    assert not output.publish()
+
+    assert os.listdir(output.final_path) == ["000.dcm"]
+    assert sorted(os.listdir(output.staging_path)) == ["000.dcm", "002.dcm"]
+
+
+def test_publish_never_swaps_an_empty_staging_directory(output):
+    write_final(output, ["000.dcm"])
+    output.expected = None
+
+    for name in os.listdir(output.staging_path):
+        os.remove(output.staging_target(name))
+
+    assert not output.publish()
+    assert os.listdir(output.final_path) == ["000.dcm"]
+
+
+def test_batch_sync_flushes_the_file_system_once(output, monkeypatch):
+    synced: list[str] = []
+    monkeypatch.setattr(committer, "sync_filesystem", lambda path: synced.append(path) or True)
+    monkeypatch.setattr(committer, "sync_path", synced.append)
+
+    output.sync([output.staging_target(name) for name in sorted(output.expected)])
+
+    assert synced == [output.staging_path, output.staging_path]
+
+
+def test_sources_are_kept_when_the_output_is_incomplete(make_batch):
+    root_path: str = make_batch()
+    patient_path: str = f"{root_path}/{PATIENT}"
+    hospital_batch: batch.Batch = batch.Batch(root_path, DIR_NAME_PATTERN, workers=1)
+
+    failures, conveyor = hospital_batch.prepare_patient(patient_path, "study", PATIENT)
+    assert conveyor.run(1, hospital_batch.ledger) == []
+    os.remove(conveyor.committer.staging_target(f"{patient_path}/{PATIENT}/000.dcm"))  # e.g. lost in a crash.
+
+    failures = hospital_batch.finish_patient(conveyor, [])
+
+    assert failures and failures[0][0] == patient_path
+    assert hospital_batch.ledger.patient_state(patient_path) == "failed"
+    assert os.path.isdir(f"{patient_path}/study")
+    assert not os.path.exists(f"{patient_path}/{PATIENT}")
+
+    # The next run anonymizes the missing file again, and only then removes the sources:
+    assert batch.Batch(root_path, DIR_NAME_PATTERN, workers=1).run() == []
+    assert len(os.listdir(f"{patient_path}/{PATIENT}")) == 4
+    assert not os.path.exists(f"{patient_path}/study")
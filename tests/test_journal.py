@@ -0,0 +1,144 @@
+import gc
+import os
+import sqlite3
+import pydicom
+import pytest
+import synthetic_study
+from conftest import DIR_NAME_PATTERN
+import main_file
+from Modules import batch
+from Modules import journal
+from Modules import metrics
+
+PATIENT: str = "TAG_DATA_HOSPITAL-1"
+
+
+def test_files_are_recorded_once_flushed(tmp_path):
+    ledger: journal.Journal = journal.Journal(str(tmp_path / "journal.sqlite"))
+    target: str = str(tmp_path / "000.dcm")
+    open(target, "wb").close()
+
+    ledger.mark_files("patient", [("a.dcm", target, None), ("b.dcm", str(tmp_path / "001.dcm"), "ValueError()")])
+
+    # Only the files anonymized (and still there) count as done:
+    assert ledger.done_files("patient") == {target}
+    os.remove(target)
+    assert ledger.done_files("patient") == set()
+
+
+def test_interrupted_patient_is_resumed(make_batch):
+    root_path: str = make_batch(slices=6)
+    patient_path: str = f"{root_path}/{PATIENT}"
+
+    # The first run anonymizes (and records) only half of the files, then stops:
+    first_run: batch.Batch = batch.Batch(root_path, DIR_NAME_PATTERN, workers=1)
+    failures, conveyor = first_run.prepare_patient(patient_path, "study", PATIENT)
+    jobs: list[tuple[str, str]] = conveyor.jobs(first_run.ledger)
+    assert conveyor.anonymize(jobs[:3], 1, first_run.ledger) == []
+    done_inodes: set[int] = {os.stat(conveyor.committer.staging_target(target)).st_ino for source, target in jobs[:3]}
+
+    second_run: batch.Batch = batch.Batch(root_path, DIR_NAME_PATTERN, workers=1)
+    assert second_run.plan_patient(patient_path, "study")[0] == "resume"
+    metrics.METRICS.reset()
+    assert second_run.run() == []
+
+    # Only the other half was anonymized again, and the output is complete:
+    assert metrics.METRICS.counters["files_skipped"] == 3
+    assert metrics.METRICS.counters["files_read"] == 3
+    output: list[str] = sorted(os.listdir(f"{patient_path}/{PATIENT}"))
+    assert output == [os.path.basename(target) for source, target in jobs]
+    assert done_inodes <= {os.stat(f"{patient_path}/{PATIENT}/{name}").st_ino for name in output}
+    assert second_run.ledger.patient_state(patient_path) == "cleaned"
+    assert second_run.plan_patient(patient_path, "")[0] == "done"
+
+
+def test_scan_and_dry_run_never_create_the_journal(make_batch, capsys):
+    root_path: str = make_batch(patients=2)
+    journal_path: str = f"{root_path}/.anonymizer_journal.sqlite"
+
+    assert main_file.main(["scan", root_path]) == 0
+    assert main_file.main(["dry-run", root_path]) == 0
+
+    assert "new: 2" in capsys.readouterr().out
+    assert not [name for name in os.listdir(root_path) if name.startswith(".anonymizer_journal")]
+
+    # With a journal, it is only read:
+    assert main_file.main(["anonymize", root_path, "--workers", "1", "--keep-sources", "--no-popup"]) == 0
+    gc.collect()  # The last connection of the run closes (and checkpoints the WAL into the journal).
+    modified: int = os.stat(journal_path).st_mtime_ns
+    assert main_file.main(["dry-run", root_path]) == 0
+    assert "done: 2" in capsys.readouterr().out
+    assert os.stat(journal_path).st_mtime_ns == modified
+
+
+def test_read_only_journal_cannot_be_written(tmp_path):
+    journal_path: str = str(tmp_path / "journal.sqlite")
+    journal.Journal(journal_path).mark_patient("patient", "sorted")
+    ledger: journal.Journal = journal.Journal(journal_path, read_only=True)
+
+    assert ledger.patient_state("patient") == "sorted"
+    with pytest.raises(sqlite3.OperationalError):
+        ledger.mark_patient("patient", "cleaned")
+
+
+def test_fingerprint_notices_changed_sources(tmp_path):
+    source: str = str(tmp_path / "study")
+    os.makedirs(f"{source}/series000")
+    with open(f"{source}/series000/00000.dcm", "wb") as dcm_file:
+        dcm_file.write(b"a" * 100)
+    fingerprint: str = journal.make_fingerprint(source)
+
+    assert journal.make_fingerprint(source) == fingerprint
+
+    # Rewritten with the same size and time: only the hash notices it.
+    hashed: str = journal.make_fingerprint(source, fast_hash=True)
+    stat: os.stat_result = os.stat(f"{source}/series000/00000.dcm")
+    with open(f"{source}/series000/00000.dcm", "wb") as dcm_file:
+        dcm_file.write(b"b" * 100)
+    os.utime(f"{source}/series000/00000.dcm", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert journal.make_fingerprint(source) == fingerprint
+    assert journal.make_fingerprint(source, fast_hash=True) != hashed
+
+    # A new file (in a sub-directory too):
+    with open(f"{source}/series000/00001.dcm", "wb") as dcm_file:
+        dcm_file.write(b"c" * 100)
+    assert journal.make_fingerprint(source) != fingerprint
+
+
+def test_unchanged_patient_is_skipped(make_batch):
+    root_path: str = make_batch(patients=2)
+    first_run: batch.Batch = batch.Batch(root_path, DIR_NAME_PATTERN, workers=1, keep_sources=True)
+    assert first_run.run() == []
+    output_path: str = f"{root_path}/{PATIENT}/{PATIENT}"
+    inodes: dict[str, int] = {name: os.stat(f"{output_path}/{name}").st_ino for name in os.listdir(output_path)}
+
+    second_run: batch.Batch = batch.Batch(root_path, DIR_NAME_PATTERN, workers=1, keep_sources=True)
+    assert second_run.plan_patient(f"{root_path}/{PATIENT}", "study")[0] == "done"
+    metrics.METRICS.reset()
+    assert second_run.run() == []
+
+    # Nothing was read, nor written again:
+    assert metrics.METRICS.counters["patients_skipped"] == 2
+    assert "files_read" not in metrics.METRICS.counters
+    assert {name: os.stat(f"{output_path}/{name}").st_ino for name in os.listdir(output_path)} == inodes
+
+    # Without the incremental mode, every patient is anonymized again:
+    assert batch.Batch(root_path, DIR_NAME_PATTERN, incremental=False).plan_patient(f"{root_path}/{PATIENT}", "study")[0] == "resume"
+
+
+def test_changed_patient_starts_all_over_again(make_batch):
+    root_path: str = make_batch(slices=4)
+    patient_path: str = f"{root_path}/{PATIENT}"
+    assert batch.Batch(root_path, DIR_NAME_PATTERN, workers=1, keep_sources=True).run() == []
+
+    # A new series arrives for the same patient:
+    os.makedirs(f"{patient_path}/study/series001")
+    synthetic_study.make_slice(f"{patient_path}/study/series001/00000.dcm", pydicom.uid.generate_uid(), "110000", 1, 8, 8, 2)
+    second_run: batch.Batch = batch.Batch(root_path, DIR_NAME_PATTERN, workers=1, keep_sources=True)
+    assert second_run.plan_patient(patient_path, "study")[0] == "changed"
+    metrics.METRICS.reset()
+    assert second_run.run() == []
+
+    assert metrics.METRICS.counters["files_read"] == 5
+    assert sorted(os.listdir(f"{patient_path}/{PATIENT}")) == [f"{counter:03}.dcm" for counter in range(5)]
+    assert second_run.plan_patient(patient_path, "study")[0] == "done"
@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import subprocess
+import pydicom
+import pytest
+from conftest import ROOT_PATH
+import main_file
+
+PATIENT: str = "TAG_DATA_HOSPITAL-1"
+
+
+def test_scan_lists_every_patient(make_batch, capsys):
+    root_path: str = make_batch(patients=2)
+
+    assert main_file.main(["scan", root_path]) == 0
+
+    out: str = capsys.readouterr().out
+    assert "TAG_DATA_HOSPITAL-1 | source: study | state: new" in out
+    assert "2 patient(s) found." in out
+
+
+def test_dry_run_fails_with_a_patient_without_sources(make_batch, capsys):
+    root_path: str = make_batch()
+    os.makedirs(f"{root_path}/TAG_DATA_HOSPITAL-2")
+
+    assert main_file.main(["dry-run", root_path]) == 1
+    assert "missing: 1 | new: 1" in capsys.readouterr().out
+
+
+def test_anonymize_and_verify(make_batch, tmp_path, capsys):
+    root_path: str = make_batch(patients=2)
+    metrics_path: str = str(tmp_path / "run.json")
+    report_path: str = str(tmp_path / "report.json")
+
+    assert main_file.main(["anonymize", root_path, "--workers", "2", "--no-popup", "--metrics", metrics_path]) == 0
+    assert "All patients annonymized!" in capsys.readouterr().out
+    assert json.load(open(metrics_path))["counters"]["files_written"] == 8
+
+    assert main_file.main(["verify", root_path, "--workers", "2", "--report", report_path]) == 0
+    assert capsys.readouterr().out.startswith("\nPASSED | files: 8")
+
+    # A name left behind is found, and the command fails:
+    dataset: pydicom.FileDataset = pydicom.dcmread(f"{root_path}/{PATIENT}/{PATIENT}/000.dcm")
+    dataset.PatientName = "Doe^John"
+    dataset.save_as(f"{root_path}/{PATIENT}/{PATIENT}/000.dcm")
+
+    assert main_file.main(["verify", root_path, "--workers", "2", "--report", report_path]) == 1
+    assert "FAILED" in capsys.readouterr().out
+    report: dict = json.load(open(report_path))
+    assert report["kinds"]["not_anonymized"] == 1
+    assert report["examples"] == [[f"{root_path}/{PATIENT}/{PATIENT}/000.dcm", "PatientName", "not_anonymized"]]
+
+
+@pytest.mark.parametrize("argv", [["reorder", "root"], [], ["anonymize", "root", "--profile", "missing.json"]],
+                         ids=["reorder", "no_command", "missing_profile"])
+def test_wrong_command_lines_are_refused(argv):
+    with pytest.raises(SystemExit) as error:
+        main_file.main(argv)
+
+    assert error.value.code == 2
+
+
+def test_scan_does_not_load_pydicom(make_batch):
+    root_path: str = make_batch()
+    code: str = f"import sys, main_file; main_file.main(['scan', {root_path!r}]); print('pydicom' in sys.modules)"
+
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT_PATH, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip().endswith("False")
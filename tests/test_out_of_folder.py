@@ -0,0 +1,98 @@
+import os
+import random
+import pytest
+from Modules import out_of_folder
+
+PATIENT: str = "TAG_DATA_HOSPITAL-1"
+
+
+def make_record(path: str, series_time: str = "100000", series_uid: str = "1.2.3", instance_number: int | None = 1,
+                study_date: str = "20200101", series_number: int | None = 1,
+                position: float | None = None) -> out_of_folder.FileRecord:
+    """
+    Returns the index entry of a file that is never read.
+    """
+    return out_of_folder.FileRecord(path, series_time, series_uid, instance_number, 0, study_date, series_number, position)
+
+
+def sorted_paths(reorder: out_of_folder.Reorder, records: list[out_of_folder.FileRecord]) -> list[str]:
+    """
+    Sorts `records` (shuffled first, so the order they were read in does not help) as the study would be.
+    """
+    shuffled: list[out_of_folder.FileRecord] = random.Random(0).sample(records, len(records))
+    reorder.get_index = lambda: shuffled
+
+    return [record.path for record in reorder.sort_files()]
+
+
+@pytest.fixture
+def reorder(tmp_path):
+    return out_of_folder.Reorder(str(tmp_path), "study", PATIENT)
+
+
+def test_files_are_sorted_by_every_key(reorder):
+    records: list[out_of_folder.FileRecord] = [
+        make_record("a", study_date="20190101", series_time="235959"),
+        make_record("b", series_time="090000"),
+        make_record("c", series_number=2, instance_number=1),
+        make_record("d", series_number=2, instance_number=2),
+        make_record("e", series_number=2, instance_number=None),
+        make_record("f", series_number=3, series_uid="1.2.4", instance_number=1, position=-5.0),
+        make_record("g", series_number=3, series_uid="1.2.4", instance_number=1, position=10.0),
+        make_record("h", series_number=None),
+    ]
+
+    assert sorted_paths(reorder, records) == ["a", "b", "c", "d", "e", "f", "g", "h"]
+
+
+def test_series_with_the_same_series_time_keep_every_file(reorder):
+    # Two series acquired at the same time (e.g. a localizer and the main series), with colliding numbers:
+    records: list[out_of_folder.FileRecord] = [make_record(f"{series}/{instance}", series_number=series,
+                                                           series_uid=f"1.2.{series}", instance_number=instance)
+                                               for series in (2, 1) for instance in (2, 1)]
+
+    assert sorted_paths(reorder, records) == ["1/1", "1/2", "2/1", "2/2"]
+
+
+def test_lexsort_gives_the_same_order(reorder, monkeypatch):
+    pytest.importorskip("numpy")
+    rng: random.Random = random.Random(1)
+    records: list[out_of_folder.FileRecord] = [
+        make_record(f"{index:04}", series_time=rng.choice(["100000", "110000"]), series_number=rng.choice([1, 2, None]),
+                    instance_number=rng.choice([1, 2, 3, None]), position=rng.choice([None, -1.5, 0.0, 2.5]))
+        for index in range(200)]
+    expected: list[str] = sorted_paths(reorder, records)
+
+    monkeypatch.setattr(out_of_folder, "LEXSORT_MIN_FILES", 1)
+
+    assert sorted_paths(reorder, records) == expected
+
+
+@pytest.mark.parametrize("file_count, width", [(1, 3), (1000, 3), (1001, 4), (10001, 5)])
+def test_names_get_wider_past_999_files(reorder, file_count, width):
+    assert reorder.number_width(file_count) == width
+
+    last: str = reorder.target_path("study/series000/00000.dcm", file_count - 1, reorder.number_width(file_count))
+    assert os.path.basename(last) == f"{file_count - 1:0{width}d}.dcm"
+
+
+def test_names_sort_in_the_order_of_the_study(reorder):
+    width: int = reorder.number_width(1200)
+    names: list[str] = [os.path.basename(reorder.target_path("study/00000.dcm", counter, width)) for counter in range(1200)]
+
+    assert names[0] == "0000.dcm"
+    assert names[999:1001] == ["0999.dcm", "1000.dcm"]
+    assert sorted(names) == names
+    assert reorder.target_path("study/TEST1/00000.dcm", 7, width).endswith("/0007_t1.dcm")
+
+
+def test_study_is_renamed_in_order(make_batch):
+    root_path: str = make_batch(slices=6, series=2)
+    wall_e: out_of_folder.Reorder = out_of_folder.Reorder(f"{root_path}/{PATIENT}", "study", PATIENT)
+    order: list[tuple[int, int]] = [(record.series_number, record.instance_number) for record in wall_e.sort_files()]
+
+    wall_e.make_directory()
+    wall_e.rename_files()
+
+    assert order == [(1, 1), (1, 2), (1, 3), (2, 1), (2, 2), (2, 3)]
+    assert sorted(os.listdir(f"{root_path}/{PATIENT}/{PATIENT}")) == [f"{counter:03}.dcm" for counter in range(6)]
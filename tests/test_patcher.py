@@ -0,0 +1,220 @@
+import io
+import os
+import shutil
+import struct
+import pytest
+import pydicom
+from pydicom.uid import ImplicitVRLittleEndian
+import synthetic_study
+from Modules import anonymizer
+from Modules import metrics
+from Modules import patcher
+from Modules import pseudonymizer
+
+# Shorter (odd and even length) and longer than the original 'PatientName' ("Doe^John"):
+ANONYMIZED_NAMES: list[str] = ["ODD", "EVEN", "TAG_DATA_HOSPITAL-123456789"]
+
+
+def make_file(path: str, implicit: bool = False, depth: int = 0) -> str:
+    """
+    Writes a single synthetic slice, in explicit or implicit VR little endian.
+    """
+    synthetic_study.make_slice(path, pydicom.uid.generate_uid(), "100000", 1, 8, 8, depth=depth)
+
+    if implicit:
+        dataset: pydicom.FileDataset = pydicom.dcmread(path)
+        dataset.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+        dataset.save_as(path, enforce_file_format=True)
+
+    return path
+
+
+def rewritten(eraser: anonymizer.Eraser, source: str, target: str) -> pydicom.FileDataset:
+    """
+    Anonymizes `source` through the full rewrite (the reference), and reads it back.
+    """
+    anonymizer.rewrite_file(eraser, source, os.path.getsize(source), target)
+
+    return pydicom.dcmread(target)
+
+
+def meta_length(path: str) -> int:
+    """
+    Returns the real length of the File Meta Information of a file, after its group length element.
+    """
+    with open(path, "rb") as dcm_file:
+        data: bytes = dcm_file.read()
+
+    start: int = patcher.META_START + len(patcher.GROUP_LENGTH_HEADER) + 4
+    position: int = start
+
+    while data[position:position + 2] == b"\x02\x00":
+        if data[position + 4:position + 6].decode() in patcher.LONG_LENGTH_VRS:
+            position += 12 + struct.unpack("<L", data[position + 8:position + 12])[0]
+        else:
+            position += 8 + struct.unpack("<H", data[position + 6:position + 8])[0]
+
+    return position - start
+
+
+def assert_same(patched: str, reference: pydicom.FileDataset) -> None:
+    """
+    The patched file holds the same elements, values and pixel data as the full rewrite.
+    """
+    dataset: pydicom.FileDataset = pydicom.dcmread(patched)
+
+    assert dataset == reference
+    assert dataset.PixelData == reference.PixelData
+    assert dataset.file_meta.MediaStorageSOPInstanceUID == reference.file_meta.MediaStorageSOPInstanceUID
+    assert dataset.file_meta.FileMetaInformationGroupLength == meta_length(patched)
+
+
+@pytest.mark.parametrize("implicit", [False, True], ids=["explicit", "implicit"])
+@pytest.mark.parametrize("anonymized_name", ANONYMIZED_NAMES)
+@pytest.mark.parametrize("in_place", [False, True], ids=["target", "in_place"])
+def test_patch_matches_full_rewrite(tmp_path, implicit, anonymized_name, in_place):
+    source: str = make_file(str(tmp_path / "source.dcm"), implicit)
+    original: bytes = open(source, "rb").read()
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), anonymized_name)
+    reference: pydicom.FileDataset = rewritten(eraser, source, str(tmp_path / "reference.dcm"))
+    target: str | None = None if in_place else str(tmp_path / "patched.dcm")
+
+    assert patcher.Patcher().patch(source, eraser.replacements, eraser.patch_tags(), target)
+
+    assert_same(target or source, reference)
+    assert pydicom.dcmread(target or source).PatientName == anonymized_name
+    if not in_place:
+        assert open(source, "rb").read() == original
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".patching")]
+
+
+@pytest.mark.parametrize("anonymized_name", ANONYMIZED_NAMES)
+def test_patch_bytes_matches_full_rewrite(tmp_path, anonymized_name):
+    source: str = make_file(str(tmp_path / "source.dcm"))
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), anonymized_name)
+    reference: pydicom.FileDataset = rewritten(eraser, source, str(tmp_path / "reference.dcm"))
+
+    patched: bytes | None = patcher.Patcher().patch_bytes(open(source, "rb").read(), eraser.replacements, eraser.patch_tags())
+
+    assert patched is not None
+    with open(tmp_path / "patched.dcm", "wb") as patched_file:
+        patched_file.write(patched)
+    assert_same(str(tmp_path / "patched.dcm"), reference)
+
+
+def test_value_that_does_not_fit_is_not_patched_in_place(tmp_path):
+    source: str = make_file(str(tmp_path / "source.dcm"))
+    inode: int = os.stat(source).st_ino
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), ANONYMIZED_NAMES[-1])
+
+    assert patcher.Patcher().patch(source, eraser.replacements, eraser.patch_tags())
+
+    # The header was written again into a new file, renamed over the original one:
+    assert os.stat(source).st_ino != inode
+    assert pydicom.dcmread(source).PatientName == ANONYMIZED_NAMES[-1]
+
+
+@pytest.mark.parametrize("implicit", [False, True], ids=["explicit", "implicit"])
+def test_private_tags_are_cut_out(tmp_path, implicit):
+    source: str = make_file(str(tmp_path / "source.dcm"), implicit)  # With a private block (and sequence).
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), "TAG")
+    target: str = str(tmp_path / "patched.dcm")
+
+    assert anonymizer.anonymize_file(eraser, source, target) == (source, None)
+
+    assert metrics.METRICS.counters["files_patched"] == 1
+    assert not [element for element in pydicom.dcmread(target) if element.tag.is_private]
+    assert_same(target, rewritten(eraser, source, str(tmp_path / "reference.dcm")))
+
+
+def test_nested_changes_fall_back(tmp_path):
+    source: str = make_file(str(tmp_path / "source.dcm"), depth=1)
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), "TAG")
+    target: str = str(tmp_path / "patched.dcm")
+
+    assert not patcher.Patcher().patch(source, eraser.replacements, eraser.patch_tags(), target)
+    assert not os.path.exists(target)
+
+    # The whole file goes through the full rewrite instead:
+    assert anonymizer.anonymize_file(eraser, source, target) == (source, None)
+    assert metrics.METRICS.counters["files_rewritten"] == 1
+    assert_same(target, rewritten(eraser, source, str(tmp_path / "reference.dcm")))
+
+
+@pytest.mark.parametrize("sop_instance_uid", [None, "1.2.3"], ids=["long_uid", "short_uid"])
+def test_pseudonymized_uids_are_patched_with_the_file_meta(tmp_path, sop_instance_uid):
+    source: str = make_file(str(tmp_path / "source.dcm"))
+
+    if sop_instance_uid is not None:  # The pseudonym is longer, so the File Meta Information grows:
+        dataset: pydicom.FileDataset = pydicom.dcmread(source)
+        dataset.SOPInstanceUID = dataset.file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        dataset.save_as(source, enforce_file_format=True)
+
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), "TAG", pseudonymizer=pseudonymizer.Pseudonymizer(b"key"))
+    target: str = str(tmp_path / "patched.dcm")
+
+    assert anonymizer.anonymize_file(eraser, source, target) == (source, None)
+    assert metrics.METRICS.counters["files_patched"] == 1
+
+    dataset: pydicom.FileDataset = pydicom.dcmread(target)
+    assert dataset.SOPInstanceUID.startswith("2.25.")
+    assert dataset.file_meta.MediaStorageSOPInstanceUID == dataset.SOPInstanceUID
+    assert_same(target, rewritten(eraser, source, str(tmp_path / "reference.dcm")))
+
+
+def test_stream_matches_full_rewrite(tmp_path):
+    source: str = make_file(str(tmp_path / "source.dcm"), depth=1)
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), "TAG")
+    reference: pydicom.FileDataset = rewritten(eraser, source, str(tmp_path / "reference.dcm"))
+    shutil.copy(source, tmp_path / "streamed.dcm")
+
+    with open(source, "rb") as source_file:
+        assert patcher.Patcher().stream(source_file, eraser.anonymize_dataset, str(tmp_path / "streamed.dcm"))
+
+    assert_same(str(tmp_path / "streamed.dcm"), reference)
+
+
+@pytest.mark.parametrize("compressed", [False, True], ids=["native", "encapsulated"])
+def test_elements_after_the_pixel_data_are_anonymized(tmp_path, compressed):
+    source: str = str(tmp_path / "source.dcm")
+    synthetic_study.make_slice(source, pydicom.uid.generate_uid(), "100000", 1, 8, 8, compressed=compressed)
+    dataset: pydicom.FileDataset = pydicom.dcmread(source)
+    block = dataset.private_block(0x7FE1, "SYNTHETIC VENDOR", create=True)  # Written after the pixel data.
+    block.add_new(0x01, "LO", "Doe^John")
+    dataset.save_as(source, enforce_file_format=True)
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), "TAG")
+    reference: pydicom.FileDataset = rewritten(eraser, source, str(tmp_path / "reference.dcm"))
+
+    # The patch only parses the header, so it leaves the file to the full rewrite:
+    assert not patcher.Patcher().patch(source, eraser.replacements, eraser.patch_tags(), str(tmp_path / "patched.dcm"))
+    assert patcher.Patcher().patch_bytes(open(source, "rb").read(), eraser.replacements, eraser.patch_tags()) is None
+
+    with open(source, "rb") as source_file:
+        assert patcher.Patcher().stream(source_file, eraser.anonymize_dataset, str(tmp_path / "streamed.dcm"))
+
+    assert_same(str(tmp_path / "streamed.dcm"), reference)
+    assert not [element for element in pydicom.dcmread(tmp_path / "streamed.dcm") if element.tag.is_private]
+    assert b"Doe^John" not in open(tmp_path / "streamed.dcm", "rb").read()
+
+    # Too much after the pixel data to keep it in memory:
+    with open(source, "rb") as source_file:
+        assert not patcher.Patcher(chunk_size=4).stream(source_file, eraser.anonymize_dataset, str(tmp_path / "big.dcm"))
+    assert not os.path.exists(tmp_path / "big.dcm")
+
+
+def test_trailing_elements_kept_by_the_rules_are_written_after_the_pixel_data(tmp_path):
+    source: str = make_file(str(tmp_path / "source.dcm"))
+    dataset: pydicom.FileDataset = pydicom.dcmread(source)
+    dataset.DataSetTrailingPadding = bytes(16)
+    dataset.save_as(source, enforce_file_format=True)
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), "TAG")
+    target = io.BytesIO()
+
+    with open(source, "rb") as source_file:
+        assert patcher.Patcher().stream(source_file, eraser.anonymize_dataset, target)
+
+    target.seek(0)
+    streamed: pydicom.FileDataset = pydicom.dcmread(target)
+    assert streamed.PatientName == "TAG"
+    assert streamed.DataSetTrailingPadding == bytes(16)
+    assert list(streamed.keys())[-2:] == [pydicom.tag.Tag("PixelData"), pydicom.tag.Tag("DataSetTrailingPadding")]
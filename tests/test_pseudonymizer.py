@@ -0,0 +1,98 @@
+import os
+import pickle
+import sqlite3
+import pydicom
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+import main_file
+from Modules import pseudonymizer
+
+PATIENT: str = "TAG_DATA_HOSPITAL-1"
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    """
+    Every test starts with no pseudonymizer registered in this process.
+    """
+    monkeypatch.setattr(pseudonymizer, "REGISTRY", {})
+    return pseudonymizer.REGISTRY
+
+
+def pseudonym_in_worker(mapper: pseudonymizer.Pseudonymizer, value: str) -> tuple[int, int, int]:
+    """
+    Makes a pseudonym in a worker process, and tells which pseudonymizer made it.
+    """
+    mapper.pseudonym("PatientID", value)
+
+    return os.getpid(), id(mapper), mapper.cached.cache_info().currsize
+
+
+def test_pseudonyms_are_stable_and_keyed():
+    mapper: pseudonymizer.Pseudonymizer = pseudonymizer.Pseudonymizer(b"key")
+
+    assert mapper.pseudonym("PatientID", "123456789012 ") == mapper.derive("PatientID", "123456789012")
+    assert mapper.derive("PatientID", "1") != mapper.derive("AccessionNumber", "1")
+    assert mapper.derive("PatientID", "1") != pseudonymizer.Pseudonymizer(b"other key").derive("PatientID", "1")
+    assert pseudonymizer.is_pseudonym("UI", mapper.derive("UI", "1.2.3"))
+    assert pseudonymizer.is_pseudonym("PatientID", mapper.derive("PatientID", "1"))
+    with pytest.raises(ValueError):
+        pseudonymizer.Pseudonymizer(b"")
+
+
+def test_unpickling_reuses_the_pseudonymizer_of_the_process(registry):
+    mapper: pseudonymizer.Pseudonymizer = pseudonymizer.Pseudonymizer(b"key")
+
+    assert pickle.loads(pickle.dumps(mapper)) is mapper
+
+    registry.clear()  # As in a new worker process:
+    copy: pseudonymizer.Pseudonymizer = pickle.loads(pickle.dumps(mapper))
+    assert copy is not mapper
+    assert pickle.loads(pickle.dumps(mapper)) is copy
+    assert copy.derive("PatientID", "1") == mapper.derive("PatientID", "1")
+
+
+def test_workers_keep_their_cache_between_files():
+    mapper: pseudonymizer.Pseudonymizer = pseudonymizer.Pseudonymizer(b"key")
+
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        results: list[tuple[int, int, int]] = list(executor.map(pseudonym_in_worker, [mapper] * 3, ["1", "2", "3"]))
+
+    assert len({(pid, identity) for pid, identity, cached in results}) == 1
+    assert [cached for pid, identity, cached in results] == [1, 2, 3]
+
+
+def test_store_keeps_and_reuses_the_mappings(tmp_path):
+    store_path: str = str(tmp_path / "store.sqlite")
+    mapper: pseudonymizer.Pseudonymizer = pseudonymizer.Pseudonymizer(b"key", store_path)
+
+    pseudonym: str = mapper.pseudonym("PatientID", "123456789012")
+    assert mapper.original(pseudonym) == []  # Only written once the file is done.
+    mapper.flush()
+    assert mapper.original(pseudonym) == [("PatientID", "123456789012")]
+    assert mapper.originals() == {"123456789012"}
+
+    # A mapping already in the store (e.g. made with an older key) always wins:
+    with sqlite3.connect(store_path) as connection:
+        connection.execute("INSERT INTO pseudonyms VALUES ('PatientID', 'old', 'OLD PSEUDONYM', 0)")
+    assert pseudonymizer.Pseudonymizer(b"new key", store_path).pseudonym("PatientID", "old") == "OLD PSEUDONYM"
+
+
+def test_store_cannot_be_inside_the_root_path(make_batch, tmp_path, capsys):
+    root_path: str = make_batch()
+    key_path: str = str(tmp_path / "pseudonym.key")
+    open(key_path, "wb").write(b"secret key")
+
+    with pytest.raises(SystemExit):
+        main_file.main(["anonymize", root_path, "--pseudonym-key", key_path, "--pseudonym-store", f"{root_path}/store.sqlite"])
+    assert "--pseudonym-store cannot be inside ROOT_PATH" in capsys.readouterr().err
+    assert not os.path.exists(f"{root_path}/store.sqlite")
+
+    store_path: str = str(tmp_path / "store.sqlite")
+    assert main_file.main(["anonymize", root_path, "--workers", "1", "--pseudonym-key", key_path,
+                           "--pseudonym-store", store_path, "--no-popup"]) == 0
+
+    dataset: pydicom.FileDataset = pydicom.dcmread(f"{root_path}/{PATIENT}/{PATIENT}/000.dcm")
+    lookup: pseudonymizer.Pseudonymizer = pseudonymizer.Pseudonymizer(b"lookup only", store_path)
+    assert lookup.original(dataset.PatientID) == [("PatientID", "123456789012")]
+    assert main_file.main(["verify", root_path, "--workers", "1", "--pseudonym-store", store_path]) == 0
@@ -0,0 +1,136 @@
+import os
+import pytest
+import pydicom
+from pydicom.dataset import Dataset
+import synthetic_study
+from conftest import ROOT_PATH
+from Modules import anonymizer
+from Modules import rules
+
+PROFILE_PATH: str = os.path.join(ROOT_PATH, "Modules", "profiles", "basic_profile.json")
+
+
+def nested_names(dataset: pydicom.Dataset) -> list[str]:
+    """
+    Returns the 'PatientName' of every dataset nested in the sequences of `dataset`.
+    """
+    return [str(current.PatientName) for current in rules.RuleSet({}).walk(dataset)
+            if current is not dataset and "PatientName" in current]
+
+
+def test_rules_are_applied_at_any_depth():
+    dataset: Dataset = synthetic_study.make_nested_dataset(items=3, depth=4, private_tags=False)
+    rule_set: rules.RuleSet = rules.RuleSet.from_values({"PatientName": "TAG", "InstitutionName": "Hospital"})
+
+    assert rule_set.has_nested_changes(dataset)
+    rule_set.apply(dataset)
+
+    assert dataset.PatientName == "TAG"
+    assert nested_names(dataset) == ["TAG"] * 12
+    assert all(current.InstitutionName == "Hospital" for current in rule_set.walk(dataset) if "InstitutionName" in current)
+
+
+def test_rules_that_are_not_recursive_keep_the_sequences():
+    dataset: Dataset = synthetic_study.make_nested_dataset(items=2, depth=2, private_tags=False)
+    rule_set: rules.RuleSet = rules.RuleSet({"PatientName": {"action": "replace", "value": "TAG"}}, recursive=False)
+
+    assert not rule_set.has_nested_changes(dataset)
+    rule_set.apply(dataset)
+
+    assert dataset.PatientName == "TAG"
+    assert nested_names(dataset) == ["Doe^John"] * 4
+
+
+def test_private_tags_are_removed_at_any_depth():
+    dataset: Dataset = synthetic_study.make_nested_dataset(items=2, depth=1)
+
+    rules.RuleSet.from_values({"PatientName": "TAG"}).apply(dataset)
+
+    assert not [element for current in rules.RuleSet({}).walk(dataset) for element in current if element.tag.is_private]
+
+
+def test_removed_private_sequences_are_not_nested_changes():
+    dataset: Dataset = Dataset()
+    dataset.PatientName = "Doe^John"
+    dataset.private_block(0x0029, "SYNTHETIC VENDOR", create=True).add_new(0x01, "SQ", [synthetic_study.make_personal_item()])
+    rule_set: rules.RuleSet = rules.RuleSet.from_values({"PatientName": "TAG"})
+
+    # Nothing inside the private sequence is kept, so only the top level changes:
+    assert rule_set.has_nested_changes(dataset)
+    assert not rule_set.has_nested_changes(dataset, rule_set.changes(dataset))
+
+
+@pytest.mark.parametrize("rule, options", [("hash", {}), ("hash", {"hash_salt": ""}), ("date_shift", {})],
+                         ids=["no_salt", "empty_salt", "no_shift"])
+def test_rules_that_would_keep_personal_data_are_refused(rule, options):
+    with pytest.raises(ValueError):
+        rules.RuleSet({"StudyInstanceUID" if rule == "hash" else "StudyDate": {"action": rule}}, **options)
+
+
+def test_basic_profile_needs_a_salt(monkeypatch):
+    monkeypatch.delenv(rules.SALT_VARIABLE, raising=False)
+
+    with pytest.raises(ValueError):
+        rules.RuleSet.from_file(PROFILE_PATH)
+
+
+def test_basic_profile_removes_dates_and_hashes_uids(tmp_path, monkeypatch):
+    monkeypatch.setenv(rules.SALT_VARIABLE, "secret")
+    source: str = str(tmp_path / "source.dcm")
+    synthetic_study.make_slice(source, pydicom.uid.generate_uid(), "100000", 1, 8, 8)
+    original: pydicom.FileDataset = pydicom.dcmread(source)
+    eraser: anonymizer.Eraser = anonymizer.Eraser(str(tmp_path), "TAG", PROFILE_PATH)
+
+    assert anonymizer.anonymize_file(eraser, source, str(tmp_path / "anonymized.dcm")) == (source, None)
+
+    dataset: pydicom.FileDataset = pydicom.dcmread(tmp_path / "anonymized.dcm")
+    assert dataset.StudyDate == ""
+    assert dataset.SOPInstanceUID not in ("", original.SOPInstanceUID)
+    assert dataset.file_meta.MediaStorageSOPInstanceUID == dataset.SOPInstanceUID
+    assert dataset.SeriesInstanceUID != original.SeriesInstanceUID
+    assert "InstitutionName" not in dataset
+
+    # Another salt gives other hashes:
+    eraser.rules.hash_salt = "other"
+    assert anonymizer.anonymize_file(eraser, source, str(tmp_path / "other.dcm")) == (source, None)
+    assert pydicom.dcmread(tmp_path / "other.dcm").SOPInstanceUID != dataset.SOPInstanceUID
+
+
+def make_unknown_sequence(path: str) -> None:
+    """
+    Writes an implicit VR file with a private sequence and no private creator,
+    so it is read back as an element with an unknown VR ('UN').
+    """
+    dataset: pydicom.FileDataset = pydicom.FileDataset(path, {}, file_meta=pydicom.dataset.FileMetaDataset(),
+                                                       preamble=b"\0" * 128)
+    dataset.file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
+    dataset.file_meta.MediaStorageSOPClassUID = synthetic_study.CT_IMAGE_STORAGE
+    dataset.file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    dataset.PatientName = "Doe^John"
+    dataset.add_new(0x00291001, "SQ", [synthetic_study.make_personal_item()])
+    dataset.save_as(path, implicit_vr=True, little_endian=True)
+
+
+def test_unknown_vr_sequences_are_parsed(tmp_path):
+    make_unknown_sequence(str(tmp_path / "implicit.dcm"))
+    dataset: pydicom.FileDataset = pydicom.dcmread(tmp_path / "implicit.dcm")
+
+    element: pydicom.DataElement = dataset[0x00291001]
+    assert element.VR == "UN"
+    assert [str(item.PatientName) for item in rules.parse_unknown(element)] == ["Doe^John"]
+    assert rules.parse_unknown(pydicom.DataElement(0x00291002, "UN", b"\x01\x02\x03\x04")) is None
+    assert rules.parse_unknown(pydicom.DataElement(0x00100010, "PN", "Doe^John")) is None
+
+
+def test_unknown_vr_sequences_are_anonymized(tmp_path):
+    make_unknown_sequence(str(tmp_path / "implicit.dcm"))
+    dataset: pydicom.FileDataset = pydicom.dcmread(tmp_path / "implicit.dcm")
+    rule_set: rules.RuleSet = rules.RuleSet({"PatientName": {"action": "replace", "value": "TAG"}}, private_tags="keep")
+
+    assert rule_set.has_nested_changes(dataset)
+    rule_set.apply(dataset)
+    dataset.save_as(tmp_path / "anonymized.dcm")
+
+    anonymized: pydicom.FileDataset = pydicom.dcmread(tmp_path / "anonymized.dcm")
+    assert anonymized.PatientName == "TAG"
+    assert [str(item.PatientName) for item in rules.parse_unknown(anonymized[0x00291001])] == ["TAG"]
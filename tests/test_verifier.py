@@ -0,0 +1,131 @@
+import os
+import pydicom
+import pytest
+from conftest import DIR_NAME_PATTERN
+import main_file
+from Modules import batch
+from Modules import metrics
+from Modules import pseudonymizer
+from Modules import verifier
+
+PATIENT: str = "TAG_DATA_HOSPITAL-1"
+
+
+def output_files(root_path: str) -> list[str]:
+    """
+    Returns the anonymized files of the first patient.
+    """
+    output_path: str = f"{root_path}/{PATIENT}/{PATIENT}"
+
+    return [f"{output_path}/{item}" for item in sorted(os.listdir(output_path))]
+
+
+def change_tag(path: str, keyword: str, value: str) -> None:
+    """
+    Changes a single tag of an anonymized file, as if it had been left behind.
+    """
+    dataset: pydicom.FileDataset = pydicom.dcmread(path)
+    setattr(dataset, keyword, value)
+    dataset.save_as(path)
+
+
+def verify(root_path: str) -> dict:
+    """
+    Verifies the batch in `root_path`, and returns the report.
+    """
+    hospital_verifier: verifier.Verifier = verifier.Verifier(batch.Batch(root_path, DIR_NAME_PATTERN, workers=1,
+                                                                         read_only=True))
+
+    return hospital_verifier.report(hospital_verifier.run())
+
+
+@pytest.fixture
+def key_path(tmp_path, monkeypatch):
+    monkeypatch.delenv(pseudonymizer.KEY_VARIABLE, raising=False)
+    path = tmp_path / "pseudonym.key"
+    path.write_bytes(b"secret key")
+
+    return str(path)
+
+
+def test_pseudonyms_without_a_store_are_verified(make_batch, key_path, capsys):
+    root_path: str = make_batch()
+
+    assert main_file.main(["anonymize", root_path, "--workers", "1", "--pseudonym-key", key_path, "--no-popup"]) == 0
+    assert main_file.main(["verify", root_path, "--workers", "1"]) == 0
+    assert "PASSED" in capsys.readouterr().out
+
+    dataset: pydicom.FileDataset = pydicom.dcmread(output_files(root_path)[0])
+    assert pseudonymizer.is_pseudonym("PatientID", dataset.PatientID)
+    assert pseudonymizer.is_pseudonym("UI", dataset.SeriesInstanceUID)
+
+
+def test_values_that_are_not_pseudonyms_are_found(make_batch, key_path):
+    root_path: str = make_batch()
+    assert main_file.main(["anonymize", root_path, "--workers", "1", "--pseudonym-key", key_path, "--no-popup"]) == 0
+    first, second = output_files(root_path)[:2]
+
+    change_tag(first, "SeriesInstanceUID", "1.2.3.4")  # The original UID was left.
+    change_tag(second, "PatientID", pseudonymizer.Pseudonymizer(b"other key").derive("PatientID", "123456789012"))
+    report: dict = verify(root_path)
+
+    assert not report["passed"]
+    assert report["kinds"]["not_pseudonymized"] == 1
+    assert report["kinds"]["inconsistent"] == 1
+    assert report["tags"] == {"SeriesInstanceUID": 1, "PatientID": 1}
+
+
+def test_unpseudonymized_batch_is_not_checked_for_pseudonyms(make_batch, key_path):
+    root_path: str = make_batch()
+    assert main_file.main(["anonymize", root_path, "--workers", "1", "--no-popup"]) == 0
+
+    assert verify(root_path)["passed"]
+
+
+def test_phi_check_is_reported_as_skipped_without_personal_data(make_batch, caplog, monkeypatch):
+    root_path: str = make_batch()
+    assert main_file.main(["anonymize", root_path, "--workers", "1", "--no-popup"]) == 0  # The sources are removed.
+    monkeypatch.setattr(metrics.get_logger(), "propagate", True)  # So the warnings get to 'caplog'.
+
+    report: dict = verify(root_path)
+
+    assert report["passed"]
+    assert report["phi_check"] == "skipped"
+    assert "No personal data to look for" in caplog.text
+
+
+def test_personal_data_is_found_without_the_sources(make_batch):
+    root_path: str = make_batch()
+    assert main_file.main(["anonymize", root_path, "--workers", "1", "--no-popup"]) == 0
+    first, second, third = output_files(root_path)[:3]
+
+    change_tag(first, "ReferringPhysicianName", "Doe^Jane")  # A name no rule covers.
+    change_tag(second, "ImageComments", "Scanned on 2020-01-01")
+    change_tag(third, "StudyDescription", "CT of Doe^John")
+    report: dict = verify(root_path)
+
+    assert report["phi_check"] == "skipped"
+    assert report["kinds"]["phi_suspect"] == 3
+    assert report["tags"] == {"ReferringPhysicianName": 1, "ImageComments": 1, "StudyDescription": 1}
+
+
+def test_personal_data_is_found_with_the_sources(make_batch):
+    root_path: str = make_batch()
+    assert main_file.main(["anonymize", root_path, "--workers", "1", "--keep-sources", "--no-popup"]) == 0
+    change_tag(output_files(root_path)[0], "StudyID", "123456789012")  # The original PatientID.
+
+    report: dict = verify(root_path)
+
+    assert report["phi_check"] == "done"
+    assert report["kinds"]["phi_match"] == 1
+    assert report["tags"] == {"StudyID": 1}
+
+
+def test_missing_output_is_reported(make_batch):
+    root_path: str = make_batch(patients=2)
+
+    report: dict = verify(root_path)
+
+    assert not report["passed"]
+    assert report["kinds"]["missing"] == 2
+    assert report["files"] == 0
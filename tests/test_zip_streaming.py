@@ -0,0 +1,135 @@
+import os
+import asyncio
+import time
+import zipfile
+import pytest
+import pydicom
+from conftest import DIR_NAME_PATTERN
+from Modules import anonymizer
+from Modules import async_pipeline
+from Modules import batch
+from Modules import metrics
+
+PATIENT: str = "TAG_DATA_HOSPITAL-1"
+
+
+def members(zip_path: str) -> list[str]:
+    """
+    Returns the names of the DICOM files inside a ZIP file.
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        return sorted(name for name in archive.namelist() if name.endswith(".dcm"))
+
+
+@pytest.mark.parametrize("overlap_io", [False, True], ids=["pipeline", "async"])
+@pytest.mark.parametrize("stream_size", [256 * 1024 * 1024, 1], ids=["in_memory", "streamed"])
+def test_zip_is_anonymized_without_extracting_it(make_batch, overlap_io, stream_size):
+    root_path: str = make_batch(zipped=True)
+    patient_path: str = f"{root_path}/{PATIENT}"
+    hospital_batch: batch.Batch = batch.Batch(root_path, DIR_NAME_PATTERN, workers=2, stream_size=stream_size)
+
+    failures = async_pipeline.AsyncPipeline(hospital_batch).run() if overlap_io else hospital_batch.run()
+
+    assert failures == []
+    # Only the anonymized files ever landed on the disk:
+    assert os.listdir(patient_path) == [PATIENT]
+    output: list[str] = sorted(os.listdir(f"{patient_path}/{PATIENT}"))
+    assert output == ["000.dcm", "001.dcm", "002.dcm", "003.dcm"]
+    for name in output:
+        dataset: pydicom.FileDataset = pydicom.dcmread(f"{patient_path}/{PATIENT}/{name}")
+        assert dataset.PatientName == PATIENT
+        assert dataset.PatientID != "123456789012"
+    assert metrics.METRICS.counters["files_written"] == 4
+
+
+def test_member_matches_extracted_file(make_batch, tmp_path):
+    root_path: str = make_batch(zipped=True)
+    zip_path: str = f"{root_path}/{PATIENT}/study.zip"
+    member: str = members(zip_path)[0]
+    eraser: anonymizer.Eraser = anonymizer.Eraser(root_path, PATIENT)
+
+    with zipfile.ZipFile(zip_path) as archive:
+        extracted: str = archive.extract(member, tmp_path / "extracted")
+
+    assert anonymizer.anonymize_member(eraser, zip_path, member, str(tmp_path / "member.dcm")) == (member, None)
+    assert anonymizer.anonymize_file(eraser, extracted, str(tmp_path / "file.dcm")) == (extracted, None)
+
+    with open(tmp_path / "member.dcm", "rb") as from_member, open(tmp_path / "file.dcm", "rb") as from_file:
+        assert from_member.read() == from_file.read()
+
+
+def test_replaced_zip_is_opened_again(tmp_path):
+    zip_path: str = str(tmp_path / "study.zip")
+
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        archive.writestr("000.dcm", b"old")
+    assert anonymizer.read_source(zip_path, "000.dcm") == b"old"
+    old_archive: zipfile.ZipFile = anonymizer.open_archive(zip_path)
+
+    time.sleep(0.01)
+    with zipfile.ZipFile(f"{zip_path}.new", "w") as archive:
+        archive.writestr("000.dcm", b"new content")
+    os.replace(f"{zip_path}.new", zip_path)
+
+    assert anonymizer.read_source(zip_path, "000.dcm") == b"new content"
+    assert anonymizer.source_size(zip_path, "000.dcm") == len(b"new content")
+    assert old_archive.fp is None  # Closed.
+
+
+def test_only_a_few_zip_files_are_kept_open(tmp_path):
+    archives: list[zipfile.ZipFile] = []
+
+    for index in range(anonymizer.OPEN_ARCHIVES + 2):
+        zip_path: str = str(tmp_path / f"study{index}.zip")
+        with zipfile.ZipFile(zip_path, "w") as archive:
+            archive.writestr("000.dcm", b"data")
+        archives.append(anonymizer.open_archive(zip_path))
+
+    assert len(anonymizer.ARCHIVES) <= anonymizer.OPEN_ARCHIVES
+    assert archives[0].fp is None
+    assert archives[-1].fp is not None
+
+
+def test_files_in_flight_are_bounded_by_bytes(make_batch, monkeypatch):
+    root_path: str = make_batch(patients=2, zipped=True)
+    file_size: int = os.path.getsize(f"{root_path}/{PATIENT}/study.zip")  # Bigger than any of its files.
+    hospital_batch: batch.Batch = batch.Batch(root_path, DIR_NAME_PATTERN, workers=2)
+    pipeline = async_pipeline.AsyncPipeline(hospital_batch, queue_bytes=file_size)
+    peaks: list[int] = []
+    acquire = async_pipeline.ByteBudget.acquire
+
+    async def acquire_and_record(budget: async_pipeline.ByteBudget, size: int) -> int:
+        reserved: int = await acquire(budget, size)
+        peaks.append(budget.used)
+        return reserved
+
+    monkeypatch.setattr(async_pipeline.ByteBudget, "acquire", acquire_and_record)
+
+    assert pipeline.run() == []
+
+    # Every file was read, but never more than the budget at the same time:
+    assert len(peaks) == 8
+    assert max(peaks) <= file_size
+    assert metrics.METRICS.counters["files_written"] == 8
+
+
+def test_memory_limit_sizes_the_byte_budget(make_batch):
+    hospital_batch: batch.Batch = batch.Batch(make_batch(), DIR_NAME_PATTERN, memory_limit=64 * 1024 * 1024)
+
+    assert async_pipeline.AsyncPipeline(hospital_batch).queue_bytes == 32 * 1024 * 1024
+    hospital_batch.memory_limit = None
+    assert async_pipeline.AsyncPipeline(hospital_batch).queue_bytes == async_pipeline.QUEUE_BYTES
+
+
+def test_file_bigger_than_the_byte_budget_still_goes_through():
+    async def run() -> list[int]:
+        budget: async_pipeline.ByteBudget = async_pipeline.ByteBudget(100)
+        first: int = await budget.acquire(60)
+        waiting: asyncio.Task = asyncio.create_task(budget.acquire(1000))  # Waits until nothing else is in flight.
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        await budget.release(first)
+        second: int = await waiting
+        return [first, second, budget.used]
+
+    assert asyncio.run(run()) == [60, 100, 100]